@@ -5,44 +5,48 @@ from datetime import (
 
 from django_multitenant.utils import set_current_tenant
 
-from bot.api.messages import (
-    ClientHaveNegativeBalance, UsersToManagerBirthday, UserToUserBirthday,
-)
 from bot.tasks import notify_clients_about_future_event
-from crm.models import Client, Company, INTERNAL_COMPANY, Manager
+from crm.models import Client, INTERNAL_COMPANY
+from gcp.tasks import enqueue_many
 
 
 def receivables():
-
-    for client in Client.objects.filter(balance__lt=0):
-        set_current_tenant(client.company)
-        ClientHaveNegativeBalance(client, personalized=False).send_message()
+    # Job runs for all companies, tasks set tenant of their company
+    set_current_tenant(None)
+    company_ids = (
+        Client.objects
+        .filter(balance__lt=0)
+        .order_by('company_id')
+        .values_list('company_id', flat=True)
+        .distinct()
+    )
+    enqueue_many(
+        'notify_company_receivables',
+        [(company_id,) for company_id in company_ids]
+    )
 
 
 def birthday():
     current_date = date.today()
-    month = current_date.month
-    day = current_date.day
-
-    companies = Company.objects.exclude(display_name=INTERNAL_COMPANY)
 
-    for company in companies:
-        set_current_tenant(company)
-        clients = Client.objects.filter(
-            birthday__month=month, birthday__day=day, company_id=company.id
+    # Job runs for all companies, tasks set tenant of their company
+    set_current_tenant(None)
+    # Skip companies without any client with birthday
+    company_ids = (
+        Client.objects
+        .filter(
+            birthday__month=current_date.month,
+            birthday__day=current_date.day
         )
-
-        # skip, if there no any client with birthday
-        if not clients.count():
-            continue
-
-        clients_list = list(clients)
-        UserToUserBirthday(clients_list, personalized=True).send_message()
-
-        managers = list(Manager.objects.filter(company_id=company.id))
-        UsersToManagerBirthday(
-            managers, personalized=True, clients=clients_list
-        ).send_message()
+        .exclude(company__display_name=INTERNAL_COMPANY)
+        .order_by('company_id')
+        .values_list('company_id', flat=True)
+        .distinct()
+    )
+    enqueue_many(
+        'notify_company_birthdays',
+        [(company_id, current_date.isoformat()) for company_id in company_ids]
+    )
 
 
 def future_event():
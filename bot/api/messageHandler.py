@@ -2,6 +2,7 @@ from typing import Tuple, Optional
 from bot.api.commands import allowed_commands
 from bot.api.commands.base import InvalidCommand
 from bot.api.vkapi import send_message
+from gcp.registry import task
 
 
 def get_answer(body, user_id):
@@ -16,6 +17,7 @@ def get_answer(body, user_id):
     return message, attachment
 
 
+@task
 def create_answer(data, token):
     user_id = data['from_id']
     message, attachment = get_answer(data['text'].lower(), user_id)
@@ -1,3 +1,4 @@
+from .base import Message
 from .birthday import UsersToManagerBirthday, UserToUserBirthday
 from .clients_info import (
     ClientHaveNegativeBalance, ClientSubscriptionBuy, ClientSubscriptionExtend,
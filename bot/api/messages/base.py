@@ -2,14 +2,16 @@ from __future__ import annotations
 
 from enum import IntEnum
 from dataclasses import dataclass
-from typing import Any, Dict, Sequence, Union
+from collections import defaultdict
+from functools import lru_cache
+from typing import Any, Dict, List, Sequence, Union
 from uuid import UUID, uuid5
 
 from django.template import Context, Template
 
-from bot.api.vkapi import send_bulk_message, send_message
+from bot.api.vkapi import SendResult, get_vk_sender, send_bulk_message
 from bot.const import SPORTCRM_NAMESPACE
-from bot.models import MessageMeta
+from bot.message_meta import get_message_settings
 from bot.template import EasyEngine, EasyTemplate
 from crm.models import Client, Coach, Manager
 
@@ -167,25 +169,26 @@ class Message:
         return f'{cls.__module__}.{cls.__qualname__}'
 
     @classmethod
+    @lru_cache(maxsize=None)
     def uuid(cls) -> UUID:
         return uuid5(SPORTCRM_NAMESPACE, cls.__full_qualname__())
 
     @classmethod
     def is_enabled_message(cls) -> bool:
-        try:
-            return MessageMeta.objects.only('is_enabled').get(
-                uuid=cls.uuid()
-            ).is_enabled
-        except MessageMeta.DoesNotExist:
-            return True
+        return get_message_settings(cls).is_enabled
+
+    def send_message(self) -> List[SendResult]:
+        """
+        Send message to recipients.
 
-    def send_message(self):
+        :return: Result of sending for every recipient with VK account
+        """
         if not self.is_enabled_message():
-            return
+            return []
 
         if not len(self.recipients):
             # Early check for empty list, for skip message generation
-            return
+            return []
 
         try:
             self.message = self.prepare_generalized_message()
@@ -194,14 +197,16 @@ class Message:
 
         if not len(self.message):
             # Don't send any messages, if it was empty
-            return
+            return []
 
         if self.personalized:
-            self._send_personalized_message()
+            return self._send_personalized_message()
         else:
-            self._send_bulk_message()
+            return self._send_bulk_message()
 
-    def _send_personalized_message(self):
+    def _send_personalized_message(self) -> List[SendResult]:
+        # Messages are sent by sender of token, which limits request rate
+        messages_by_token = defaultdict(list)
         for recipient in self.recipients:
             vk_id = recipient.get_vk_id()
             vk_message_token = recipient.get_vk_message_token()
@@ -210,12 +215,61 @@ class Message:
                 continue
 
             personalized_message = self.personalize(self.message, recipient)
+            messages_by_token[vk_message_token].append(
+                (vk_id, personalized_message, ''))
 
-            send_message(vk_id, vk_message_token, personalized_message)
+        results = []
+        for token, messages in messages_by_token.items():
+            results.extend(get_vk_sender(token).send_many(messages))
+        return results
 
-    def _send_bulk_message(self):
-        send_bulk_message(
-            [x.get_vk_id() for x in self.recipients],
+    @staticmethod
+    def send_combined(messages: Sequence[Message]) -> List[SendResult]:
+        """
+        Send several messages as one VK message for every recipient.
+
+        Texts of messages are joined in order of messages. Only the first
+        text of recipient is personalized, if its message is personalized.
+
+        :return: Result of sending for every recipient with VK account
+        """
+        # Texts and personalization by token and VK id of recipient
+        combined = {}
+        for message in messages:
+            if not message.is_enabled_message():
+                continue
+            try:
+                text = message.prepare_generalized_message()
+            except NotImplementedError:
+                continue
+            if not text:
+                continue
+
+            for recipient in message.recipients:
+                vk_id = recipient.get_vk_id()
+                vk_message_token = recipient.get_vk_message_token()
+                if not vk_id or not vk_message_token:
+                    # Skip users without vk params
+                    continue
+
+                texts = combined.setdefault((vk_message_token, vk_id), [])
+                if not texts and message.personalized:
+                    texts.append(message.personalize(text, recipient))
+                else:
+                    texts.append(text)
+
+        messages_by_token = defaultdict(list)
+        for (token, vk_id), texts in combined.items():
+            messages_by_token[token].append((vk_id, '\n\n'.join(texts), ''))
+
+        results = []
+        for token, token_messages in messages_by_token.items():
+            results.extend(get_vk_sender(token).send_many(token_messages))
+        return results
+
+    def _send_bulk_message(self) -> List[SendResult]:
+        return send_bulk_message(
+            [x.get_vk_id() for x in self.recipients if x.get_vk_id()],
             # TODO: to dispute what to do if in recipients list accidentally
             #  was added users from different company. Possible resolutions:
             #  1. Check in message init and raise ValueError
@@ -249,16 +303,7 @@ class Message:
 
     @classmethod
     def get_template(cls) -> Template:
-        try:
-            template_data = MessageMeta.objects.only('template').get(
-                uuid=cls.uuid()
-            ).template
-            if not template_data:
-                template_data = cls.default_template
-        except MessageMeta.DoesNotExist:
-            template_data = cls.default_template
-
-        return EasyTemplate(template_data, engine=EasyEngine())
+        return get_message_settings(cls).template
 
     @staticmethod
     def personalize(msg: str, recipient: Recipient) -> str:
@@ -22,9 +22,9 @@ def test_empty_list(
             3, birthday=date(2019, 1, 2), company=company)
 
     mock_user_to_user = mocker.patch(
-        'bot.api.cron.cron_client_events.UserToUserBirthday')
+        'bot.api.messages.UserToUserBirthday')
     mock_users_to_manager = mocker.patch(
-        'bot.api.cron.cron_client_events.UsersToManagerBirthday')
+        'bot.api.messages.UsersToManagerBirthday')
     with freeze_time(date(2019, 1, 1)):
         birthday()
 
@@ -47,9 +47,9 @@ def test_one_company_with_birthday(
         manager_factory.create_batch(3, user__company=company)
 
     mock_user_to_user = mocker.patch(
-        'bot.api.cron.cron_client_events.UserToUserBirthday', autospec=True)
+        'bot.api.messages.UserToUserBirthday', autospec=True)
     mock_users_to_manager = mocker.patch(
-        'bot.api.cron.cron_client_events.UsersToManagerBirthday', autospec=True)
+        'bot.api.messages.UsersToManagerBirthday', autospec=True)
 
     with freeze_time(date(2019, 1, 1)):
         birthday()
@@ -73,9 +73,9 @@ def test_all_companies_with_birthday(
         manager_factory.create_batch(3, user__company=company)
 
     mock_user_to_user = mocker.patch(
-        'bot.api.cron.cron_client_events.UserToUserBirthday', autospec=True)
+        'bot.api.messages.UserToUserBirthday', autospec=True)
     mock_users_to_manager = mocker.patch(
-        'bot.api.cron.cron_client_events.UsersToManagerBirthday', autospec=True)
+        'bot.api.messages.UsersToManagerBirthday', autospec=True)
 
     with freeze_time(date(2019, 1, 1)):
         birthday()
@@ -1,7 +1,7 @@
 import pytest
 from hamcrest import (
-    assert_that, calling, contains, contains_inanyorder,
-    has_length, is_, raises,
+    assert_that, calling, contains, contains_inanyorder, has_entries,
+    has_length, has_properties, is_, raises,
 )
 from pytest_mock import MockFixture
 
@@ -93,32 +93,33 @@ def test_send_empty_message(client_factory, mocker: MockFixture):
     sm.assert_not_called()
 
 
-def test_send_to_non_vk_user(client_factory, mocker: MockFixture):
+def test_send_to_non_vk_user(client_factory, vk_api, mocker: MockFixture):
     mocker.patch(
         'bot.api.messages.base.Message.prepare_generalized_message',
         return_value='Test'
     )
-    sm = mocker.patch('bot.api.messages.base.send_message')
-    msg_sender = Message(client_factory())
-    msg_sender.send_message()
+    msg_sender = Message(client_factory(company__vk_access_token='token'))
+    results = msg_sender.send_message()
 
-    sm.assert_not_called()
+    assert_that(results, has_length(0))
+    assert_that(vk_api.calls_of('messages.send'), has_length(0))
 
 
-def test_send(client_factory, mocker: MockFixture):
+def test_send(client_factory, vk_api, mocker: MockFixture):
     mocker.patch(
         'bot.api.messages.base.Message.prepare_generalized_message',
         return_value='Test'
     )
-    sm = mocker.patch('bot.api.messages.base.send_message')
-    msg_sender = Message(client_factory(vk_user_id=1))
+    msg_sender = Message(client_factory(
+        vk_user_id=1, company__vk_access_token='token'))
     msg_sender.send_message()
 
-    sm.assert_called_once_with(1, mocker.ANY, 'Test')
+    assert_that(vk_api.calls_of('messages.send'), contains(has_entries(
+        access_token='token', user_ids='1', message='Test')))
 
 
-def test_send_personalized(client_factory, mocker: MockFixture):
-    client = client_factory(vk_user_id=1)
+def test_send_personalized(client_factory, vk_api, mocker: MockFixture):
+    client = client_factory(vk_user_id=1, company__vk_access_token='token')
     mocker.patch(
         'bot.api.messages.base.Message.prepare_generalized_message',
         return_value='Test'
@@ -127,27 +128,65 @@ def test_send_personalized(client_factory, mocker: MockFixture):
     msg_sender = Message(client, personalized=True)
 
     spy = mocker.spy(msg_sender, 'personalize')
-    sm = mocker.patch('bot.api.messages.base.send_message')
 
     msg_sender.send_message()
 
-    spy.assert_called_once_with('Test', client)
-    sm.assert_called_once_with(1, mocker.ANY, mocker.ANY)
+    spy.assert_called_once_with('Test', msg_sender.recipients[0])
+    assert_that(vk_api.calls_of('messages.send'), contains(has_entries(
+        access_token='token', user_id='1')))
 
 
-def test_send_personalized_multiple(client_factory, mocker: MockFixture):
-    client = client_factory.create_batch(3, vk_user_id=1)
+def test_send_personalized_multiple(
+    client_factory,
+    company_factory,
+    vk_api,
+    mocker: MockFixture
+):
+    company = company_factory(vk_access_token='token')
+    clients = [
+        client_factory(company=company, vk_user_id=vk_user_id)
+        for vk_user_id in (1, 2, 3)
+    ]
+    vk_api.deny_messages(2)
     mocker.patch(
         'bot.api.messages.base.Message.prepare_generalized_message',
         return_value='Test'
     )
 
-    msg_sender = Message(client, personalized=True)
+    msg_sender = Message(clients, personalized=True)
 
     spy = mocker.spy(msg_sender, 'personalize')
-    sm = mocker.patch('bot.api.messages.base.send_message')
 
-    msg_sender.send_message()
+    results = msg_sender.send_message()
 
     assert_that(spy.call_count, is_(3))
-    assert_that(sm.call_count, is_(3))
+    assert_that(vk_api.calls_of('messages.send'), has_length(3))
+    # Messages of one token are sent with one execute request
+    assert_that(vk_api.calls_of('execute'), has_length(1))
+    # Failed message doesn't prevent sending of others
+    assert_that(results, contains_inanyorder(
+        has_properties(user_id=1, ok=True),
+        has_properties(user_id=2, ok=False),
+        has_properties(user_id=3, ok=True),
+    ))
+
+
+def test_send_combined(client_factory, vk_api, mocker: MockFixture):
+    client = client_factory(
+        name='Иван', vk_user_id=1, company__vk_access_token='token')
+    mocker.patch(
+        'bot.api.messages.base.Message.prepare_generalized_message',
+        side_effect=['Первое', 'Второе']
+    )
+
+    results = Message.send_combined([
+        Message(client, personalized=True),
+        Message(client, personalized=True),
+    ])
+
+    assert_that(results, contains(has_properties(user_id=1, ok=True)))
+    assert_that(vk_api.calls_of('messages.send'), contains(has_entries(
+        access_token='token',
+        user_id='1',
+        message='Иван, первое\n\nВторое'
+    )))
@@ -0,0 +1,71 @@
+import pytest
+from django.core.cache import cache
+from django.template import Context
+from hamcrest import assert_that, is_
+
+from bot.api.messages.clients_info import ClientUpdateBalance
+from bot.message_meta import invalidate_message_settings
+from bot.models import MessageMeta
+
+pytestmark = pytest.mark.django_db
+
+
+def render(message_type) -> str:
+    return message_type.get_template().render(Context({'BALANCE': 10}))
+
+
+def test_settings_loaded_once(company_factory, django_assert_num_queries):
+    company_factory()
+
+    with django_assert_num_queries(1):
+        assert_that(ClientUpdateBalance.is_enabled_message(), is_(True))
+        assert_that(render(ClientUpdateBalance), is_(
+            'Ваш баланс составляет: 10 ₽'))
+        assert_that(
+            ClientUpdateBalance.get_template(),
+            is_(ClientUpdateBalance.get_template())
+        )
+
+
+def test_settings_invalidated_on_save(company_factory):
+    company_factory()
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(True))
+
+    meta = MessageMeta.objects.create(
+        uuid=ClientUpdateBalance.uuid(),
+        template='Баланс: {{BALANCE}}',
+    )
+    assert_that(render(ClientUpdateBalance), is_('Баланс: 10'))
+
+    meta.is_enabled = False
+    meta.save()
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(False))
+
+
+def test_settings_by_company(company_factory):
+    company_factory(name='first')
+    MessageMeta.objects.create(
+        uuid=ClientUpdateBalance.uuid(), template='', is_enabled=False)
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(False))
+
+    company_factory(name='second')
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(True))
+
+
+def test_settings_invalidated_by_other_instance(company_factory):
+    company = company_factory()
+    MessageMeta.objects.create(
+        uuid=ClientUpdateBalance.uuid(), template='', is_enabled=False)
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(False))
+
+    # Update without save keeps settings, cached by process
+    MessageMeta.objects.update(is_enabled=True)
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(False))
+
+    # Other instance drops them through shared cache on save
+    invalidate_message_settings(company.id)
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(True))
+
+    MessageMeta.objects.update(is_enabled=False)
+    cache.clear()
+    assert_that(ClientUpdateBalance.is_enabled_message(), is_(False))
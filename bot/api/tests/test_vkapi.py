@@ -0,0 +1,110 @@
+import vk
+from hamcrest import (
+    assert_that, close_to, contains, contains_inanyorder, has_entries,
+    has_length,
+    has_properties, is_,
+)
+from pytest_mock import MockFixture
+
+from bot.api.vkapi import (
+    RateLimiter, get_vk_sender, send_bulk_message, send_message,
+)
+
+
+def test_sender_is_shared_by_token(vk_api):
+    for user_id in (1, 2):
+        send_message(user_id, 'token', 'Test')
+    send_message(1, 'other', 'Test')
+
+    assert_that(get_vk_sender('token'), is_(get_vk_sender('token')))
+    # vk.API is replaced by mock, returning stub
+    assert_that(vk.API.call_count, is_(2))
+    assert_that(vk_api.calls_of('messages.send'), has_length(3))
+
+
+def test_send_message_result(vk_api):
+    vk_api.deny_messages(2)
+
+    assert_that(
+        send_message(1, 'token', 'Test'),
+        has_properties(user_id=1, ok=True, message_id=1)
+    )
+    assert_that(
+        send_message(2, 'token', 'Test'),
+        has_properties(user_id=2, ok=False, message_id=None)
+    )
+    assert_that(send_message(1, 'token', ''), is_(None))
+
+
+def test_send_many(vk_api):
+    vk_api.deny_messages(3)
+    messages = [(user_id, f'Test {user_id}', '') for user_id in range(1, 11)]
+
+    results = get_vk_sender('token').send_many(messages)
+
+    assert_that(results, has_length(10))
+    assert_that(
+        [result.user_id for result in results if not result.ok],
+        contains(3)
+    )
+    assert_that(
+        vk_api.calls_of('messages.send'),
+        has_length(10)
+    )
+    # All messages are sent with one request
+    assert_that(vk_api.calls_of('execute'), has_length(1))
+
+
+def test_send_many_by_execute_chunks(vk_api, mocker: MockFixture):
+    mocker.patch('bot.api.vkapi.VK_EXECUTE_LIMIT', 2)
+    messages = [
+        (1, 'Иван, "привет" })];', ''),
+        (2, 'Петр, привет', 'photo1_1'),
+        (3, 'Анна, привет', ''),
+    ]
+
+    results = get_vk_sender('token').send_many(messages)
+
+    assert_that(results, contains(
+        has_properties(user_id=1, ok=True),
+        has_properties(user_id=2, ok=True),
+        has_properties(user_id=3, ok=True),
+    ))
+    assert_that(vk_api.calls_of('execute'), has_length(1))
+    assert_that(vk_api.calls_of('messages.send'), contains_inanyorder(
+        has_entries(user_id=1, message='Иван, "привет" })];'),
+        has_entries(user_id=2, attachment='photo1_1'),
+        has_entries(message='Анна, привет'),
+    ))
+
+
+def test_send_bulk_message(vk_api, mocker: MockFixture):
+    mocker.patch('bot.api.vkapi.VK_BULK_RECIPIENTS_LIMIT', 2)
+    vk_api.deny_messages(2)
+
+    results = send_bulk_message([1, 2, 3], 'token', 'Test')
+
+    assert_that(vk_api.calls_of('messages.send'), contains(
+        has_entries(user_ids='1,2'),
+        has_entries(user_ids='3'),
+    ))
+    assert_that(results, contains(
+        has_properties(user_id=1, ok=True),
+        has_properties(user_id=2, ok=False),
+        has_properties(user_id=3, ok=True),
+    ))
+
+
+def test_rate_limiter(mocker: MockFixture):
+    sleep = mocker.patch('bot.api.vkapi.time.sleep')
+    rate_limiter = RateLimiter(10)
+
+    for _ in range(5):
+        rate_limiter.wait()
+
+    # First call is made at once, every next one waits for its slot
+    assert_that(sleep.call_count, is_(4))
+    assert_that(
+        sum(call[0][0] for call in sleep.call_args_list),
+        close_to(1.0, 0.1)
+    )
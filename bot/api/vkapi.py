@@ -1,28 +1,242 @@
-from typing import List, Sized
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Sized, Tuple
 
+import requests
 import vk
 import vk.exceptions
 
+logger = logging.getLogger('bot.api.vkapi')
+
+VK_API_VERSION = 5.90
+# VK allows 20 requests per second with community token
+VK_REQUESTS_PER_SECOND = 20
+# Messages of one token are sent by this number of threads
+VK_SEND_WORKERS = 4
+# VK accepts no more than 100 recipients in one messages.send request
+VK_BULK_RECIPIENTS_LIMIT = 100
+# VK executes no more than 25 API calls in one execute request
+VK_EXECUTE_LIMIT = 25
+
+# Recipient VK id, message, attachment
+OutgoingMessage = Tuple[int, str, str]
+
 
 def chunks(items: Sized, count: int):
     return [items[i:i + count] for i in range(0, len(items), count)]
 
 
-def send_message(user_id: int, token: str, message: str, attachment: str = ''):
-    if not message:
-        # Silently fail if no message was provided
-        return
+@dataclass
+class SendResult:
+    user_id: int
+    message_id: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class RateLimiter:
+    """
+    Allows no more than `rate` calls of `wait` per second, shared by all
+    threads.
+    """
+
+    def __init__(self, rate: int):
+        self.interval = 1 / rate
+        self._next_call = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            call_at = max(now, self._next_call)
+            self._next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+
+class VkSender:
+    """
+    Message sender for one token.
 
-    session = vk.Session()
-    api = vk.API(session, v=5.90)
+    Sender keeps one VK session, so HTTP connection is reused between
+    requests, and sends messages from thread pool, not exceeding VK
+    request rate of token.
+    """
 
-    try:
-        api.messages.send(
-            access_token=token, user_id=str(user_id), message=message,
-            attachment=attachment
+    def __init__(self, token: str):
+        self.token = token
+        self.api = vk.API(vk.Session(), v=VK_API_VERSION)
+        self.rate_limiter = RateLimiter(VK_REQUESTS_PER_SECOND)
+
+    def call(self, method: str, **params):
+        """Call API method with token of sender, within request rate"""
+        self.rate_limiter.wait()
+        api_method = self.api
+        for name in method.split('.'):
+            api_method = getattr(api_method, name)
+        return api_method(access_token=self.token, **params)
+
+    def _send(self, message: OutgoingMessage) -> SendResult:
+        user_id, text, attachment = message
+        try:
+            message_id = self.call(
+                'messages.send',
+                user_id=str(user_id),
+                message=text,
+                attachment=attachment
+            )
+        except (vk.exceptions.VkAPIError, requests.RequestException) as exc:
+            logger.warning('Message to %s is not sent: %s', user_id, exc)
+            return SendResult(user_id, error=str(exc))
+        return SendResult(user_id, message_id=message_id)
+
+    def _send_execute(
+        self,
+        messages: Sequence[OutgoingMessage]
+    ) -> List[SendResult]:
+        if len(messages) == 1:
+            return [self._send(messages[0])]
+
+        calls = ','.join(
+            'API.messages.send({})'.format(json.dumps({
+                'user_id': user_id,
+                'message': text,
+                'attachment': attachment,
+            }, ensure_ascii=False))
+            for user_id, text, attachment in messages
         )
-    except vk.exceptions.VkAPIError:
-        pass
+        try:
+            response = self.call('execute', code=f'return [{calls}];')
+        except (vk.exceptions.VkAPIError, requests.RequestException) as exc:
+            logger.warning('Messages are not sent: %s', exc)
+            return [
+                SendResult(user_id, error=str(exc))
+                for user_id, _, _ in messages
+            ]
+
+        # Failed call of execute returns false instead of message id
+        response = list(response or [])
+        response += [False] * (len(messages) - len(response))
+        results = []
+        for (user_id, _, _), message_id in zip(messages, response):
+            if message_id is False:
+                logger.warning('Message to %s is not sent', user_id)
+                results.append(SendResult(user_id, error='Not sent'))
+            else:
+                results.append(SendResult(user_id, message_id=message_id))
+        return results
+
+    def send_many(
+        self,
+        messages: Sequence[OutgoingMessage]
+    ) -> List[SendResult]:
+        """
+        Send personal messages.
+
+        Messages are packed into execute requests, by 25 messages per
+        request.
+
+        :param messages: Recipient VK id, message and attachment of every
+            message
+        :return: Result of every message, in order of messages
+        """
+        message_chunks = chunks(list(messages), VK_EXECUTE_LIMIT)
+        if len(message_chunks) <= 1:
+            return [
+                result
+                for chunk in message_chunks
+                for result in self._send_execute(chunk)
+            ]
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(message_chunks), VK_SEND_WORKERS)
+        ) as executor:
+            chunk_results = executor.map(self._send_execute, message_chunks)
+            return [result for results in chunk_results for result in results]
+
+    def _send_bulk(
+        self,
+        user_ids: Sequence[int],
+        message: str,
+        attachment: str
+    ) -> List[SendResult]:
+        try:
+            response = self.call(
+                'messages.send',
+                user_ids=','.join(str(x) for x in user_ids),
+                message=message,
+                attachment=attachment
+            )
+        except (vk.exceptions.VkAPIError, requests.RequestException) as exc:
+            logger.warning('Bulk message is not sent: %s', exc)
+            return [SendResult(user_id, error=str(exc)) for user_id in user_ids]
+
+        # For several recipients VK returns result of every recipient
+        by_user = {item.get('peer_id'): item for item in response or []}
+        results = []
+        for user_id in user_ids:
+            item = by_user.get(user_id)
+            if item is None:
+                results.append(SendResult(user_id, error='No result'))
+            elif item.get('error'):
+                results.append(SendResult(user_id, error=str(item['error'])))
+            else:
+                results.append(
+                    SendResult(user_id, message_id=item.get('message_id')))
+        return results
+
+    def send_bulk(
+        self,
+        user_ids: Sequence[int],
+        message: str,
+        attachment: str = ''
+    ) -> List[SendResult]:
+        """
+        Send same message to many users, up to 100 users per request.
+
+        :return: Result of every recipient, in order of user ids
+        """
+        user_id_chunks = chunks(list(user_ids), VK_BULK_RECIPIENTS_LIMIT)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(len(user_id_chunks), VK_SEND_WORKERS))
+        ) as executor:
+            chunk_results = executor.map(
+                lambda chunk: self._send_bulk(chunk, message, attachment),
+                user_id_chunks
+            )
+            return [result for results in chunk_results for result in results]
+
+
+_senders: Dict[str, VkSender] = {}
+_senders_lock = threading.Lock()
+
+
+def get_vk_sender(token: str) -> VkSender:
+    """Sender of token, shared by all threads of process"""
+    with _senders_lock:
+        if token not in _senders:
+            _senders[token] = VkSender(token)
+        return _senders[token]
+
+
+def send_message(
+    user_id: int,
+    token: str,
+    message: str,
+    attachment: str = ''
+) -> Optional[SendResult]:
+    if not message:
+        # Silently fail if no message was provided
+        return None
+
+    return get_vk_sender(token).send_many([(user_id, message, attachment)])[0]
 
 
 def send_bulk_message(
@@ -30,19 +244,9 @@ def send_bulk_message(
     token: str,
     message: str,
     attachment: str = ''
-):
+) -> List[SendResult]:
     if not message:
         # Silently fail if no message was provided
-        return
-
-    session = vk.Session()
-    api = vk.API(session, v=5.90)
+        return []
 
-    for user_id_chunk in chunks(user_ids, 100):
-        try:
-            api.messages.send(
-                access_token=token, user_ids=[str(x) for x in user_id_chunk],
-                message=message, attachment=attachment
-            )
-        except vk.exceptions.VkAPIError:
-            pass
+    return get_vk_sender(token).send_bulk(user_ids, message, attachment)
@@ -0,0 +1,91 @@
+from typing import Dict, Optional, Tuple, Type
+from uuid import UUID, uuid4
+
+from django.core.cache import cache
+from django.template import Template
+from django.utils.functional import cached_property
+from django_multitenant.utils import get_current_tenant
+
+from bot.models import MessageMeta
+from bot.template import EasyEngine, EasyTemplate
+
+
+class MessageSettings:
+    def __init__(
+        self,
+        message_type: Type,
+        is_enabled: bool,
+        template_data: str
+    ):
+        self.message_type = message_type
+        self.is_enabled = is_enabled
+        self.template_data = template_data
+
+    @cached_property
+    def template(self) -> Template:
+        """Template, compiled on first use"""
+        return EasyTemplate(
+            self.template_data or self.message_type.default_template,
+            engine=EasyEngine()
+        )
+
+
+SettingsKey = Tuple[Optional[int], UUID]
+
+# Settings of messages, loaded by this process, by company id and message
+# uuid. Every entry keeps version of company settings it was loaded with.
+_local_settings: Dict[SettingsKey, Tuple[str, MessageSettings]] = {}
+
+
+def _version_key(company_id: Optional[int]) -> str:
+    return f'message_meta_version_{company_id}'
+
+
+def _company_version(company_id: Optional[int]) -> str:
+    """
+    Version of message settings of company, shared by all instances.
+
+    Version is random, not counter, so settings, cached by process, are
+    not used again after shared cache is cleared.
+    """
+    key = _version_key(company_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_message_settings(company_id: Optional[int]):
+    """Drop message settings of company, cached by all instances"""
+    cache.set(_version_key(company_id), uuid4().hex, timeout=None)
+
+
+def get_message_settings(message_type: Type) -> MessageSettings:
+    """
+    Settings of message type for current company, with compiled template.
+
+    Settings are loaded with one query and cached by process, until they
+    are changed by any instance.
+
+    :param message_type: Subclass of `bot.api.messages.base.Message`
+    """
+    tenant = get_current_tenant()
+    company_id = tenant.id if tenant else None
+    key = (company_id, message_type.uuid())
+    version = _company_version(company_id)
+
+    cached = _local_settings.get(key)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    meta = MessageMeta.objects.only('is_enabled', 'template').filter(
+        uuid=message_type.uuid()
+    ).first()
+    settings = MessageSettings(
+        message_type,
+        is_enabled=meta.is_enabled if meta else True,
+        template_data=meta.template if meta else ''
+    )
+    _local_settings[key] = (version, settings)
+    return settings
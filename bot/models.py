@@ -13,3 +13,14 @@ class MessageMeta(CompanyObjectModel):
 
     class Meta:
         unique_together = ['company', 'uuid']
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        from bot.message_meta import invalidate_message_settings
+        invalidate_message_settings(self.company_id)
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        from bot.message_meta import invalidate_message_settings
+        invalidate_message_settings(self.company_id)
+        return result
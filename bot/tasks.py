@@ -1,65 +1,153 @@
+from datetime import date
+from typing import List, Optional, Tuple
+
 from django.db.models import Prefetch
 from django_multitenant.utils import set_current_tenant
 
 from bot.api import messages
-from crm.models import Client, ClientSubscriptions, Event, Manager, EventClass
-
-
-def notify_event_cancellation(event_id: int):
+from crm.client_import import ClientImporter
+from crm.models import (
+    Client, ClientImport, ClientSubscriptions, Company, Event, Manager,
+    EventClass,
+)
+from crm.vk_avatars import fetch_vk_avatars
+from gcp.registry import task
+
+
+@task
+def notify_event_cancellation(
+    event_id: int,
+    client_ids: Optional[List[int]] = None
+):
     try:
         event = Event.objects.get(id=event_id)
     except Event.DoesNotExist:
         # Invalid event id passed
         return
 
-    clients = list(Client.objects.with_active_subscription_to_event(event))
+    if client_ids is None:
+        clients = list(
+            Client.objects.with_active_subscription_to_event(event))
+    else:
+        # Clients of cancelled event are notified by chunks
+        clients = list(Client.objects.filter(id__in=client_ids))
     messages.CancelledEvent(clients, event=event).send_message()
 
 
-def notify_client_buy_subscription(subscription_id: int):
+def _client_subscription(subscription_id: int) -> Optional[ClientSubscriptions]:
     try:
-        client_sub = ClientSubscriptions.objects.get(id=subscription_id)
+        return ClientSubscriptions.objects.get(id=subscription_id)
     except ClientSubscriptions.DoesNotExist:
-        # Invalid event id passed
-        return
+        # Invalid subscription id passed
+        return None
 
-    messages.ClientSubscriptionBuy(
-        client_sub.client, personalized=True, clientsub=client_sub
-    ).send_message()
 
+def client_buy_subscription_message(
+    subscription_id: int
+) -> Optional[messages.Message]:
+    client_sub = _client_subscription(subscription_id)
+    if not client_sub:
+        return None
 
-def notify_client_subscription_visit(subscription_id: int):
-    try:
-        client_sub = ClientSubscriptions.objects.get(id=subscription_id)
-    except ClientSubscriptions.DoesNotExist:
-        # Invalid event id passed
-        return
+    return messages.ClientSubscriptionBuy(
+        client_sub.client, personalized=True, clientsub=client_sub)
 
-    messages.ClientSubscriptionVisit(
-        client_sub.client, personalized=True, clientsub=client_sub
-    ).send_message()
 
+def client_subscription_visit_message(
+    subscription_id: int
+) -> Optional[messages.Message]:
+    client_sub = _client_subscription(subscription_id)
+    if not client_sub:
+        return None
 
-def notify_client_subscription_extend(subscription_id: int):
-    try:
-        client_sub = ClientSubscriptions.objects.get(id=subscription_id)
-    except ClientSubscriptions.DoesNotExist:
-        # Invalid event id passed
-        return
+    return messages.ClientSubscriptionVisit(
+        client_sub.client, personalized=True, clientsub=client_sub)
 
-    messages.ClientSubscriptionExtend(
-        client_sub.client, personalized=True, clientsub=client_sub
-    ).send_message()
 
+def client_subscription_extend_message(
+    subscription_id: int
+) -> Optional[messages.Message]:
+    client_sub = _client_subscription(subscription_id)
+    if not client_sub:
+        return None
 
-def notify_client_balance(client_id: int):
+    return messages.ClientSubscriptionExtend(
+        client_sub.client, personalized=True, clientsub=client_sub)
+
+
+def client_balance_message(client_id: int) -> Optional[messages.Message]:
     try:
         client = Client.objects.get(id=client_id)
     except Client.DoesNotExist:
-        # Invalid event id passed
-        return
+        # Invalid client id passed
+        return None
+
+    return messages.ClientUpdateBalance(client, personalized=True)
+
+
+# Messages of client notification tasks, which can be combined
+CLIENT_MESSAGES = {
+    'notify_client_buy_subscription': client_buy_subscription_message,
+    'notify_client_subscription_visit': client_subscription_visit_message,
+    'notify_client_subscription_extend': client_subscription_extend_message,
+    'notify_client_balance': client_balance_message,
+}
+
+
+@task
+def notify_client_buy_subscription(subscription_id: int):
+    message = client_buy_subscription_message(subscription_id)
+    if message:
+        message.send_message()
+
+
+@task
+def notify_client_subscription_visit(subscription_id: int):
+    message = client_subscription_visit_message(subscription_id)
+    if message:
+        message.send_message()
+
 
-    messages.ClientUpdateBalance(client, personalized=True).send_message()
+@task
+def notify_client_subscription_visits(subscription_ids: List[int]):
+    client_subs = (
+        ClientSubscriptions.objects
+        .filter(id__in=subscription_ids)
+        .select_related('client', 'subscription')
+    )
+    for client_sub in client_subs:
+        messages.ClientSubscriptionVisit(
+            client_sub.client, personalized=True, clientsub=client_sub
+        ).send_message()
+
+
+@task
+def notify_client_subscription_extend(subscription_id: int):
+    message = client_subscription_extend_message(subscription_id)
+    if message:
+        message.send_message()
+
+
+@task
+def notify_client_balance(client_id: int):
+    message = client_balance_message(client_id)
+    if message:
+        message.send_message()
+
+
+@task
+def notify_client(calls: List[Tuple[str, List]]):
+    """
+    Send client notifications, combined by enqueue_coalesced, as one
+    message.
+
+    :param calls: Names and arguments of client notification tasks
+    """
+    client_messages = [
+        CLIENT_MESSAGES[method](*args) for method, args in calls
+    ]
+    messages.Message.send_combined(
+        [message for message in client_messages if message])
 
 
 def notify_clients_about_future_event(dt):
@@ -106,6 +194,50 @@ def notify_clients_about_future_event(dt):
             messages.LastFutureEvent(last_visit_clients, date=dt, event_class=event_class).send_message()
 
 
+@task
+def notify_company_birthdays(company_id: int, day: str):
+    """
+    Congratulate clients of company with birthday and notify managers.
+
+    :param day: Date of birthdays, in ISO format
+    """
+    try:
+        company = Company.objects.get(id=company_id)
+    except Company.DoesNotExist:
+        # Invalid company id passed
+        return
+
+    set_current_tenant(company)
+    day = date.fromisoformat(day)
+    clients = list(Client.objects.filter(
+        birthday__month=day.month, birthday__day=day.day, company_id=company.id
+    ))
+    if not clients:
+        return
+
+    messages.UserToUserBirthday(clients, personalized=True).send_message()
+
+    managers = list(Manager.objects.filter(company_id=company.id))
+    messages.UsersToManagerBirthday(
+        managers, personalized=True, clients=clients
+    ).send_message()
+
+
+@task
+def notify_company_receivables(company_id: int):
+    try:
+        company = Company.objects.get(id=company_id)
+    except Company.DoesNotExist:
+        # Invalid company id passed
+        return
+
+    set_current_tenant(company)
+    for client in Client.objects.filter(balance__lt=0, company_id=company.id):
+        messages.ClientHaveNegativeBalance(
+            client, personalized=False).send_message()
+
+
+@task
 def notify_manager_event_closed(event_id: int):
     try:
         event = Event.objects.get(id=event_id)
@@ -117,6 +249,7 @@ def notify_manager_event_closed(event_id: int):
     messages.ClosedEvent(managers, event=event, personalized=True).send_message()
 
 
+@task
 def notify_manager_event_opened(event_id: int):
     try:
         event = Event.objects.get(id=event_id)
@@ -128,6 +261,7 @@ def notify_manager_event_opened(event_id: int):
     messages.OpenedEvent(managers, event=event, personalized=True).send_message()
 
 
+@task
 def notify_manager_about_signup(event_id: int, client_id: int):
     try:
         event = Event.objects.get(id=event_id)
@@ -140,6 +274,7 @@ def notify_manager_about_signup(event_id: int, client_id: int):
     messages.SignupClient(managers, event=event, client=client).send_message()
 
 
+@task
 def notify_manager_about_unsignup(event_id: int, client_id: int):
     try:
         event = Event.objects.get(id=event_id)
@@ -150,3 +285,23 @@ def notify_manager_about_unsignup(event_id: int, client_id: int):
 
     managers = list(Manager.objects.all())
     messages.UnsignupClient(managers, event=event, client=client).send_message()
+
+
+@task
+def refresh_vk_avatars(vk_user_ids: List[int]):
+    fetch_vk_avatars(vk_user_ids)
+
+
+@task
+def import_clients(client_import_id: int):
+    try:
+        client_import = ClientImport.objects.get(id=client_import_id)
+    except ClientImport.DoesNotExist:
+        # Invalid import id passed
+        return
+
+    if client_import.is_finished:
+        # Retry of failed import: the file is already removed
+        return
+
+    ClientImporter(client_import).run()
@@ -1,6 +1,10 @@
+import pytest
+from django.core.cache import cache
 from pytest_factoryboy import register
 
+from contrib.vk_stub import VkApiStub
 from crm.tests import factories
+from gcp.cloud_tasks_stub import CloudTasksStub
 
 
 register(factories.CompanyFactory)
@@ -15,3 +19,43 @@ register(factories.ClientFactory, 'client_model')
 register(factories.ClientSubscriptionFactory)
 register(factories.ExtensionHistoryFactory)
 
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def run_on_commit(request, mocker):
+    """
+    Run on commit callbacks, like outbox dispatch, at once in tests
+    wrapped in transaction, as it is never committed.
+    """
+    marker = request.node.get_closest_marker('django_db')
+    if marker and marker.kwargs.get('transaction'):
+        return
+    mocker.patch(
+        'django.db.transaction.on_commit', side_effect=lambda func: func())
+
+
+@pytest.fixture
+def vk_api(mocker) -> VkApiStub:
+    api = VkApiStub()
+    mocker.patch('vk.API', return_value=api)
+    # Senders keep API objects, created before the stub
+    mocker.patch.dict('bot.api.vkapi._senders', clear=True)
+    return api
+
+
+@pytest.fixture
+def cloud_tasks(mocker, settings) -> CloudTasksStub:
+    settings.USE_GOOGLE_TASKS = True
+    settings.GCP_TASK_PROJECT = 'project'
+    settings.GCP_TASK_LOCATION = 'location'
+    settings.GCP_TASK_QUEUE = 'queue'
+    stub = CloudTasksStub()
+    mocker.patch(
+        'gcp.tasks.tasks_v2beta3.CloudTasksClient', return_value=stub)
+    # Clients of queues are kept by process, like senders of VK
+    mocker.patch.dict('gcp.tasks._queues', clear=True)
+    return stub
@@ -0,0 +1,46 @@
+from typing import Iterable, List
+
+from django.db.models import Case, Model, QuerySet, Value, When
+from django.db.models.functions import Cast
+
+
+def bulk_update(
+    queryset: QuerySet,
+    objs: Iterable[Model],
+    fields: List[str]
+) -> int:
+    """
+    Update fields of many objects with one UPDATE query.
+
+    Simplified version of `QuerySet.bulk_update` from Django 2.2: each field
+    is set with CASE expression by object primary key. Signals are not sent,
+    and `save` methods of objects are not called.
+
+    :param queryset: Queryset through which update will be performed
+    :param objs: Objects with already changed values
+    :param fields: Names of fields to update
+    :return: Amount of updated rows
+    """
+    objs = list(objs)
+    if not objs:
+        return 0
+
+    updates = {}
+    for name in fields:
+        field = queryset.model._meta.get_field(name)
+        updates[field.attname] = Cast(
+            Case(
+                *[
+                    When(
+                        pk=obj.pk,
+                        then=Value(
+                            getattr(obj, field.attname), output_field=field)
+                    )
+                    for obj in objs
+                ],
+                output_field=field
+            ),
+            output_field=field
+        )
+
+    return queryset.filter(pk__in=[obj.pk for obj in objs]).update(**updates)
@@ -0,0 +1,146 @@
+import itertools
+import json
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+from vk.exceptions import VkAPIError
+
+# Error of messages.send to user, who doesn't allow messages from community
+CANT_SEND_MESSAGES_ERROR = {
+    'error_code': 901,
+    'error_msg': "Can't send messages for users without permission",
+}
+
+
+class VkApiStub:
+    """
+    Local replacement of `vk.API` for tests.
+
+    Any API method can be called, calls are recorded in `calls`. Users
+    for `users.get` are registered with `add_user`. `messages.send`
+    succeeds, unless user is forbidden to receive messages with
+    `deny_messages`. `execute` runs API calls of code, made as
+    `return [API.method({...}), ...];`. Other methods return None.
+
+    Usage::
+
+        api = VkApiStub()
+        mocker.patch('vk.API', return_value=api)
+        api.add_user(1, screen_name='durov')
+    """
+
+    def __init__(self):
+        self.calls: List[Tuple[str, Dict]] = []
+        self._users: Dict[int, Dict] = {}
+        self._message_ids = itertools.count(1)
+        self._denied_messages: Set[int] = set()
+
+    def add_user(
+        self,
+        vk_user_id: int,
+        first_name: str = 'Иван',
+        last_name: str = 'Иванов',
+        screen_name: Optional[str] = None,
+        **fields
+    ) -> Dict:
+        """
+        Register VK user, which will be returned by `users.get`.
+
+        :param vk_user_id: VK user id
+        :param screen_name: Short name of user page, `idNNN` by default
+        :param fields: Any other user fields, like `bdate`
+        :return: User information, as VK will return it
+        """
+        screen_name = screen_name or f'id{vk_user_id}'
+        user = {
+            'id': vk_user_id,
+            'first_name': first_name,
+            'last_name': last_name,
+            'screen_name': screen_name,
+            'domain': screen_name,
+            'photo_50': f'https://vk.test/photo_50_{vk_user_id}.jpg',
+            'photo_100': f'https://vk.test/photo_100_{vk_user_id}.jpg',
+            **fields
+        }
+        self._users[vk_user_id] = user
+        return user
+
+    def deny_messages(self, vk_user_id: int):
+        """Make `messages.send` to user fail, as if user forbade messages"""
+        self._denied_messages.add(vk_user_id)
+
+    def calls_of(self, method: str) -> List[Dict]:
+        """Arguments of all calls of API method, like `users.get`"""
+        return [kwargs for name, kwargs in self.calls if name == method]
+
+    def __getattr__(self, name: str) -> '_VkMethodStub':
+        return _VkMethodStub(self, name)
+
+    def _call(self, method: str, kwargs: Dict):
+        self.calls.append((method, kwargs))
+        # Look up handlers on class, as __getattr__ makes any attribute exist
+        handler = getattr(type(self), '_' + method.replace('.', '_'), None)
+        return handler(self, **kwargs) if handler else None
+
+    def _execute(self, code: str = '', **kwargs) -> List:
+        # Failed calls return false, like in VK, and don't fail execute
+        results = []
+        decoder = json.JSONDecoder()
+        pos = 0
+        while True:
+            match = _EXECUTE_CALL_REGEXP.search(code, pos)
+            if not match:
+                break
+            params, pos = decoder.raw_decode(code, match.end())
+            try:
+                results.append(self._call(match.group('method'), params))
+            except VkAPIError:
+                results.append(False)
+        return results
+
+    def _users_get(self, user_ids='', **kwargs) -> List[Dict]:
+        by_name = {user['screen_name']: user for user in self._users.values()}
+        found = []
+        for user_id in str(user_ids).split(','):
+            user_id = user_id.strip()
+            if user_id.isdigit():
+                user = self._users.get(int(user_id))
+            elif user_id.startswith('id') and user_id[2:].isdigit():
+                user = self._users.get(int(user_id[2:]))
+            else:
+                user = by_name.get(user_id)
+            if user:
+                found.append(dict(user))
+        return found
+
+    def _messages_send(self, user_id=None, user_ids=None, **kwargs):
+        if user_id is not None:
+            if int(user_id) in self._denied_messages:
+                raise VkAPIError(CANT_SEND_MESSAGES_ERROR)
+            return next(self._message_ids)
+
+        # Several recipients get result for every one of them
+        results = []
+        for peer_id in map(int, str(user_ids).split(',')):
+            if peer_id in self._denied_messages:
+                results.append(
+                    {'peer_id': peer_id, 'error': CANT_SEND_MESSAGES_ERROR})
+            else:
+                results.append(
+                    {'peer_id': peer_id, 'message_id': next(self._message_ids)})
+        return results
+
+
+_EXECUTE_CALL_REGEXP = re.compile(r'API\.(?P<method>[\w.]+)\(')
+
+
+class _VkMethodStub:
+    def __init__(self, api: VkApiStub, name: str):
+        self._api = api
+        self._name = name
+
+    def __getattr__(self, name: str) -> '_VkMethodStub':
+        return _VkMethodStub(self._api, f'{self._name}.{name}')
+
+    def __call__(self, **kwargs):
+        return self._api._call(self._name, kwargs)
@@ -1,12 +1,21 @@
 import functools
 import re
-from typing import Optional, Dict, Sequence, Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Union
 
 import vk
 from django.conf import settings
 
+from bot.api.vkapi import get_vk_sender
+
 VK_PAGE_REGEXP = re.compile('(https?://)?vk.com/(?P<user_id>([A-Za-z0-9_])+)')
 
+# VK accepts no more than 1000 user ids in one users.get request
+VK_USERS_GET_LIMIT = 1000
+# Chunks are requested by small pool of threads, request rate of token is
+# limited by its sender
+VK_CONCURRENT_REQUESTS = 3
+
 
 def get_vk_id_from_link(vk_link) -> Optional[str]:
     """
@@ -83,6 +92,114 @@ def get_vk_user_info(
     return ret
 
 
+@use_vk_api
+def get_vk_small_photos(
+    vk_user_ids: Sequence[Union[int, str]],
+    vk_api: vk.API
+) -> Dict[int, str]:
+    """
+    Get small (50px) photos of list of users with one request.
+
+    :param vk_user_ids: VK user ids, no more than 1000
+    :param vk_api: VK API object
+    :return: Photo URL by VK user id, for found users only
+    """
+    results = vk_api.users.get(
+        access_token=settings.VK_GROUP_TOKEN,
+        user_ids=','.join([str(x) for x in vk_user_ids]),
+        fields='photo_50'
+    )
+
+    return {result['id']: result.get('photo_50', '') for result in results}
+
+
+def get_vk_users_chunk(
+    vk_user_domains: Sequence[str],
+    fields: str
+) -> List[Dict]:
+    """
+    Get information about users with one request.
+
+    Request is made by sender of group token, so it shares request rate
+    of token with messages sent at the same time.
+
+    :param vk_user_domains: VK user ids or domains, no more than 1000
+    :param fields: Comma separated user fields to request
+    :return: Found users, in any order
+    """
+    return get_vk_sender(settings.VK_GROUP_TOKEN).call(
+        'users.get',
+        user_ids=','.join(vk_user_domains),
+        fields=fields
+    )
+
+
+def _vk_user_keys(user: Dict) -> List[str]:
+    # User can be requested by id, idNNN, screen name or domain
+    keys = [str(user['id']), f'id{user["id"]}']
+    keys += [
+        user[field] for field in ('screen_name', 'domain') if field in user
+    ]
+    return [key.lower() for key in keys]
+
+
+def resolve_vk_users(
+    vk_user_domains: Iterable[Union[int, str]],
+    fields: str = 'domain,screen_name'
+) -> Dict[str, Dict]:
+    """
+    Get information about any number of users.
+
+    Domains are requested by chunks of 1000, several chunks at once.
+    Results are matched to requested domains through the index of all
+    names of every found user.
+
+    :param vk_user_domains: VK user ids or domains, like `idNNN` or
+        screen name
+    :param fields: Comma separated user fields to request
+    :return: User information by requested domain, for found users only
+    """
+    domains = list(dict.fromkeys(str(x) for x in vk_user_domains if x))
+    chunks = [
+        domains[i:i + VK_USERS_GET_LIMIT]
+        for i in range(0, len(domains), VK_USERS_GET_LIMIT)
+    ]
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(
+            max_workers=min(len(chunks), VK_CONCURRENT_REQUESTS)
+        ) as executor:
+            results = list(executor.map(
+                lambda chunk: get_vk_users_chunk(chunk, fields), chunks))
+    else:
+        results = [get_vk_users_chunk(chunk, fields) for chunk in chunks]
+
+    users = {}
+    for chunk_results in results:
+        for user in chunk_results:
+            users.update({key: user for key in _vk_user_keys(user)})
+
+    return {
+        domain: users[domain.lower()]
+        for domain in domains if domain.lower() in users
+    }
+
+
+def resolve_vk_user_ids(
+    vk_user_domains: Iterable[Union[int, str]]
+) -> Dict[str, int]:
+    """
+    Get ids of any number of users by their domains.
+
+    :param vk_user_domains: VK user ids or domains, like `idNNN` or
+        screen name
+    :return: VK user id by requested domain, for found users only
+    """
+    return {
+        domain: user['id']
+        for domain, user in resolve_vk_users(vk_user_domains).items()
+    }
+
+
 def get_vk_id_from_page_link(vk_page: str) -> Union[None, int]:
     if not vk_page:
         return
@@ -0,0 +1,210 @@
+import re
+from datetime import datetime
+from io import BytesIO
+from typing import Dict, List, Set, Tuple
+
+import openpyxl
+from openpyxl.utils import cell
+
+from contrib.vk_utils import resolve_vk_user_ids
+from crm import utils
+from crm.enums import IMPORT_STATUS
+from crm.models import Client, ClientImport
+from crm.templatetags.html_helper import (
+    allowed_date_formats_ru, try_parse_date,
+)
+
+# Ученики создаются и прогресс сохраняется пачками по столько строк
+IMPORT_CHUNK_SIZE = 1000
+
+
+def try_parse_phone(raw_value):
+    phone = re.sub(r'\D', '', str(raw_value))[0:14]
+    return phone
+
+
+def try_parse_balance(raw_value):
+    if isinstance(raw_value, float):
+        return raw_value
+    balance = float(raw_value.replace(',', '.'))
+    return balance
+
+
+def open_workbook(file):
+    """
+    Открыть книгу Excel только для чтения: строки читаются из файла
+    по мере обхода, а не загружаются в память целиком.
+    """
+    return openpyxl.load_workbook(file, read_only=True)
+
+
+class ClientImporter:
+    """
+    Загрузка учеников из файла Excel.
+
+    Строки читаются потоком, дубли проверяются по заранее загруженным
+    ключам учеников компании, а ученики создаются пачками через
+    `bulk_create`. Прогресс загрузки сохраняется после каждой пачки.
+    """
+
+    def __init__(self, client_import: ClientImport):
+        self.client_import = client_import
+        self.phone_field = Client._meta.get_field('phone_number')
+
+        self.rows_processed = 0
+        self.added = 0
+        self.skipped = 0
+        self.errors: Dict[str, str] = {}
+
+        self.clients_to_add: List[Tuple[Client, str]] = []
+        self.existing_keys: Set[tuple] = set()
+        self.existing_names: Set[str] = set()
+
+    def _key(self, name, phone, birthday) -> tuple:
+        if isinstance(birthday, datetime):
+            birthday = birthday.date()
+        return name, self.phone_field.get_prep_value(phone), birthday
+
+    def _load_existing(self):
+        self.existing_keys = {
+            self._key(*values)
+            for values in Client.objects.values_list(
+                'name', 'phone_number', 'birthday').iterator()
+        }
+        # Имя ученика уникально в компании, в том числе среди архивных
+        self.existing_names = set(
+            Client.all_objects.values_list('name', flat=True).iterator())
+
+    def _save_progress(self, **kwargs):
+        ClientImport.objects.filter(id=self.client_import.id).update(
+            rows_processed=self.rows_processed,
+            added=self.added,
+            skipped=self.skipped,
+            **kwargs
+        )
+
+    def _flush(self):
+        domains = [domain for _, domain in self.clients_to_add if domain]
+        if domains:
+            vk_user_ids = resolve_vk_user_ids(domains)
+            for client, domain in self.clients_to_add:
+                if domain:
+                    client.vk_user_id = vk_user_ids.get(domain)
+
+        Client.objects.bulk_create(
+            [client for client, _ in self.clients_to_add])
+        self.clients_to_add = []
+        self._save_progress()
+
+    def _value(self, row, col: str):
+        return row[cell.column_index_from_string(col) - 1].value
+
+    def _add_row(self, row, row_number: int):
+        params = self.client_import
+        try:
+            name = self._value(row, params.name_col)
+        except (IndexError, ValueError):
+            self.errors[f'{params.name_col}{row_number}'] = (
+                'Ошибка в имени или имя пустое.')
+            return False
+        if name is None:
+            self.errors[f'{params.name_col}{row_number}'] = 'Имя пустое.'
+            return False
+        name = str(name)
+
+        try:
+            phone = try_parse_phone(self._value(row, params.phone_col))
+        except IndexError:
+            phone = self.phone_field.get_default()
+        except ValueError:
+            self.errors[f'{params.phone_col}{row_number}'] = (
+                'Неверный формат номера.')
+            return False
+
+        try:
+            birthday = try_parse_date(self._value(row, params.birthday_col))
+        except (IndexError, TypeError):
+            birthday = Client._meta.get_field('birthday').get_default()
+        except ValueError:
+            self.errors[f'{params.birthday_col}{row_number}'] = (
+                'Неверный формат даты. Допустимые форматы: ' +
+                allowed_date_formats_ru
+            )
+            return False
+
+        try:
+            balance = try_parse_balance(self._value(row, params.balance_col))
+        except (IndexError, AttributeError):
+            balance = Client._meta.get_field('balance').get_default()
+        except (ValueError, TypeError):
+            self.errors[f'{params.balance_col}{row_number}'] = (
+                'Неверный формат числа. Допустимые форматы: целые числа, '
+                'дробные разделенные точкой или запятой.'
+            )
+            return False
+
+        try:
+            match = re.search(
+                utils.VK_PAGE_REGEXP, self._value(row, params.vk_col))
+            vk_domain = match.group('user_id')
+        except (IndexError, TypeError, AttributeError):
+            vk_domain = None
+        except ValueError:
+            self.errors[f'{params.vk_col}{row_number}'] = (
+                'Неверный формат ссылки. Допустимые форматы: '
+                'vk.com/user_id или https://vk.com/user_id'
+            )
+            return False
+
+        key = self._key(name, phone, birthday)
+        if key in self.existing_keys:
+            return False
+        if name in self.existing_names:
+            self.errors[f'{params.name_col}{row_number}'] = (
+                'Ученик с таким именем уже есть.')
+            return False
+
+        client = Client(name=name, phone_number=phone, birthday=birthday)
+        if balance:
+            client.balance = balance
+        self.clients_to_add.append((client, vk_domain))
+        self.existing_keys.add(key)
+        self.existing_names.add(name)
+        return True
+
+    def run(self):
+        params = self.client_import
+        self._save_progress(status=IMPORT_STATUS.RUNNING)
+        self._load_existing()
+
+        workbook = None
+        try:
+            workbook = open_workbook(BytesIO(bytes(params.file)))
+            rows = workbook.worksheets[0].iter_rows()
+            first_row = 1
+            if params.ignore_first_row:
+                next(rows, None)
+                first_row = 2
+
+            for row_number, row in enumerate(rows, start=first_row):
+                if self._add_row(row, row_number):
+                    self.added += 1
+                else:
+                    self.skipped += 1
+                self.rows_processed += 1
+
+                if self.rows_processed % IMPORT_CHUNK_SIZE == 0:
+                    self._flush()
+            self._flush()
+        except Exception:
+            # Файл не нужен и после ошибки, повторно он не загружается
+            self._save_progress(
+                status=IMPORT_STATUS.FAILED, errors=self.errors, file=b'')
+            raise
+        finally:
+            if workbook is not None:
+                workbook.close()
+
+        # Файл больше не нужен, не храним его в базе
+        self._save_progress(
+            status=IMPORT_STATUS.DONE, errors=self.errors, file=b'')
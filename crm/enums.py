@@ -14,3 +14,10 @@ BALANCE_REASON = Choices(
     ('ERROR_FIX', 'Исправление ошибки', 'Исправление ошибки'),
     ('OTHER', 'Иное', 'Иное'),
 )
+
+IMPORT_STATUS = Choices(
+    ('PENDING', 'pending', 'Ожидает загрузки'),
+    ('RUNNING', 'running', 'Загружается'),
+    ('DONE', 'done', 'Загружен'),
+    ('FAILED', 'failed', 'Ошибка загрузки'),
+)
@@ -158,6 +158,28 @@ def next_day(
         current += timedelta(days=next(rr_deltas))
 
 
+def count_days(start: date, stop: date, days: Weekdays) -> int:
+    """
+    Count dates in period, which are in allowed week days. Calculated
+    without iteration over period, so it's constant for any period length.
+
+    :param start: Date of initial period
+    :param stop: Date of end period, including it
+    :param days: List of allowed week days
+    :return: Amount of event dates
+    """
+    if start > stop or not len(days):
+        return 0
+
+    weeks, rest = divmod((stop - start).days + 1, 7)
+    start_wd = start.weekday()
+    allowed = set(days)
+
+    return weeks * len(allowed) + sum(
+        1 for x in range(rest) if (start_wd + x) % 7 in allowed
+    )
+
+
 def range_days(start: date, stop: date) -> Generator[date, None, None]:
     if start > stop:
         raise ValueError('Start of period is greater than end date')
@@ -3,6 +3,7 @@ from datetime import datetime, timedelta, date
 import django_filters
 from dateutil.relativedelta import relativedelta
 from django import forms
+from django.db.models import DateField, OuterRef, Subquery
 from django.http import QueryDict
 from django.utils import dateformat
 from phonenumber_field import modelfields
@@ -197,19 +198,23 @@ class ClientFilter(ArchivableFilterSet):
         return queryset.filter(balance__lt=0)
 
     def filter_long_time_not_go(self, queryset, name, value):
-        long_time_not_go_ids = []
         month_ago = date.today() - relativedelta(months=1)
+        # Дата окончания последнего абонемента, как в Client.last_sub
+        last_sub_end_date = (
+            models.ClientSubscriptions.objects
+            .exclude_onetime()
+            .filter(
+                client=OuterRef('pk'),
+                subscription__deleted__isnull=True
+            )
+            .order_by('-purchase_date')
+            .values('end_date')[:1]
+        )
 
-        for client in queryset.filter(
-            clientsubscriptions__end_date__lt=month_ago
-        ):
-            last_sub = client.last_sub()
-            if not last_sub:
-                continue
-            if last_sub.end_date < month_ago:
-                long_time_not_go_ids.append(client.id)
-
-        return queryset.filter(id__in=long_time_not_go_ids)
+        return queryset.annotate(
+            last_sub_end_date=Subquery(
+                last_sub_end_date, output_field=DateField())
+        ).filter(last_sub_end_date__lt=month_ago)
 
     def __init__(self, data=None, queryset=None, *, request=None, prefix=None):
         super().__init__(data, queryset, request=request, prefix=prefix)
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+
+from crm.models import ClientSubscriptions
+
+
+class Command(BaseCommand):
+    help = (
+        'Проверить счетчики посещений абонементов по фактическим '
+        'посещениям и, при необходимости, пересчитать их.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Пересчитать счетчики расходящихся абонементов',
+        )
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='rebuild_all',
+            help='Пересчитать счетчики всех абонементов, без проверки',
+        )
+
+    def handle(self, *args, rebuild, rebuild_all, **options):
+        if rebuild_all:
+            count = ClientSubscriptions.objects.update_visits_counters()
+            self.stdout.write(f'Пересчитано абонементов: {count}')
+            return
+
+        mismatched = [
+            row for row in (
+                ClientSubscriptions.objects
+                .with_actual_visits()
+                .order_by('id')
+                .values_list(
+                    'id',
+                    'visits_used', 'actual_visits_used',
+                    'last_visit_date', 'actual_last_visit_date',
+                )
+                .iterator()
+            )
+            if row[1] != row[2] or row[3] != row[4]
+        ]
+        for sub_id, used, actual_used, last, actual_last in mismatched:
+            self.stdout.write(
+                f'Абонемент {sub_id}: посещений {used} вместо {actual_used}, '
+                f'последнее посещение {last} вместо {actual_last}'
+            )
+
+        if not mismatched:
+            self.stdout.write('Расхождений нет')
+            return
+
+        if rebuild:
+            count = ClientSubscriptions.objects.filter(
+                id__in=[row[0] for row in mismatched]
+            ).update_visits_counters()
+            self.stdout.write(f'Пересчитано абонементов: {count}')
+        else:
+            self.stdout.write(
+                f'Абонементов с расхождениями: {len(mismatched)}. '
+                f'Для пересчета запустите с --rebuild'
+            )
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from crm.models import Event
+
+
+class Command(BaseCommand):
+    help = (
+        'Удалить сохраненные тренировки, с которыми ничего не делали. '
+        'Они будут показываться в расписании как виртуальные.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество тренировок, удаляемых за один запрос',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только посчитать тренировки, без удаления',
+        )
+
+    def handle(self, *args, batch_size, dry_run, **options):
+        if dry_run:
+            count = Event.objects.untouched().count()
+            self.stdout.write(f'Тренировок к удалению: {count}')
+            return
+
+        deleted = 0
+        while True:
+            ids = list(
+                Event.objects.untouched()
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+
+            with transaction.atomic():
+                # Повторная проверка на случай, если с тренировкой что-то
+                # сделали между выборкой и удалением
+                count, _ = (
+                    Event.objects.untouched().filter(id__in=ids).delete())
+            deleted += count
+
+        self.stdout.write(f'Удалено тренировок: {deleted}')
@@ -0,0 +1,44 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+# Historical tenant models can't build joins through tenant foreign keys,
+# so counters are filled with plain SQL
+FILL_VISITS_COUNTERS = """
+UPDATE crm_clientsubscriptions cs
+SET visits_used = (
+        SELECT COUNT(*) FROM crm_attendance a WHERE a.subscription_id = cs.id
+    ),
+    last_visit_date = (
+        SELECT MAX(e.date)
+        FROM crm_attendance a
+        JOIN crm_event e ON e.id = a.event_id
+        WHERE a.subscription_id = cs.id
+    )
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0011_auto_20190508_0008'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clientsubscriptions',
+            name='last_visit_date',
+            field=models.DateField(blank=True, null=True, verbose_name='Дата последнего посещения'),
+        ),
+        migrations.AddField(
+            model_name='clientsubscriptions',
+            name='visits_used',
+            field=models.PositiveIntegerField(default=0, verbose_name='Использовано посещений'),
+        ),
+        migrations.AddIndex(
+            model_name='clientsubscriptions',
+            index=models.Index(fields=['company', 'start_date', 'end_date'], name='crm_clients_company_ad6570_idx'),
+        ),
+        migrations.RunSQL(FILL_VISITS_COUNTERS, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0012_visits_counters'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='clientsubscriptions',
+            index=models.Index(fields=['company', 'client', 'purchase_date'], name='crm_clients_company_6f6bd2_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:27
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django_multitenant.mixins
+import django_multitenant.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0013_client_subscription_purchase_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClientImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.BinaryField(verbose_name='Файл Excel')),
+                ('ignore_first_row', models.BooleanField(default=False, verbose_name='Не учитывать первую строку')),
+                ('name_col', models.CharField(max_length=3, verbose_name='Столбец с ФИО')),
+                ('phone_col', models.CharField(max_length=3, verbose_name='Столбец с номером телефона')),
+                ('birthday_col', models.CharField(max_length=3, verbose_name='Столбец с датой рождения')),
+                ('vk_col', models.CharField(max_length=3, verbose_name='Столбец со ссылкой вк')),
+                ('balance_col', models.CharField(max_length=3, verbose_name='Столбец с балансом')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает загрузки'), ('running', 'Загружается'), ('done', 'Загружен'), ('failed', 'Ошибка загрузки')], default='pending', max_length=16, verbose_name='Состояние')),
+                ('rows_processed', models.PositiveIntegerField(default=0, verbose_name='Обработано строк')),
+                ('added', models.PositiveIntegerField(default=0, verbose_name='Создано записей')),
+                ('skipped', models.PositiveIntegerField(default=0, verbose_name='Пропущено записей')),
+                ('errors', django.contrib.postgres.fields.jsonb.JSONField(default=dict, verbose_name='Ошибки по ячейкам')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')),
+                ('company', models.ForeignKey(default=django_multitenant.utils.get_current_tenant, on_delete=django.db.models.deletion.PROTECT, to='crm.Company')),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(django_multitenant.mixins.TenantModelMixin, models.Model),
+        ),
+        migrations.AlterUniqueTogether(
+            name='clientimport',
+            unique_together={('id', 'company')},
+        ),
+    ]
@@ -12,9 +12,14 @@ import reversion
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser, UserManager
 from django.core.exceptions import ValidationError
+from django.contrib.postgres.fields import JSONField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models, transaction, utils
-from django.db.models import Q, Model, Count, F, Sum
+from django.db.models import (
+    Case, Q, Model, Count, ExpressionWrapper, F, OuterRef, Subquery, Sum,
+    IntegerField, Value, When,
+)
+from django.db.models.functions import Coalesce
 from django.db.models.manager import BaseManager
 from django.forms import forms
 from django.shortcuts import get_object_or_404
@@ -32,11 +37,16 @@ from safedelete.managers import (
 from safedelete.models import SafeDeleteModel
 from transliterate import translit
 
-from crm.enums import GRANULARITY
-from crm.events import get_nearest_to, next_day, Weekdays, extend_range_distance
+from crm.enums import GRANULARITY, IMPORT_STATUS
+from crm.events import (
+    count_days, extend_range_distance, get_nearest_to, next_day, Weekdays,
+)
+from contrib.db_utils import bulk_update
 from contrib.text_utils import pluralize
 
 INTERNAL_COMPANY = 'INTERNAL'
+# Столько учеников получают уведомление об отмене тренировки одной задачей
+CANCELLATION_NOTIFY_CHUNK = 100
 
 logger = logging.getLogger('crm.models')
 
@@ -319,14 +329,14 @@ class Manager(ScrmSafeDeleteModel, CompanyObjectModel):
         return reverse('crm:manager:manager:update', kwargs={'pk': self.pk})
 
 
-class EventClassManager(TenantManagerMixin, models.Manager):
+class EventClassQuerySet(TenantQuerySet):
     def active(self):
-        return self.get_queryset().filter(
+        return self.filter(
             Q(date_to__isnull=True) | Q(date_to__gte=date.today())
         )
 
     def in_range(self, day_start, day_end):
-        return self.get_queryset().filter(
+        return self.filter(
             (
                 Q(date_from__isnull=False) & Q(date_to__isnull=False) &
                 Q(date_from__lte=day_end) & Q(date_to__gte=day_start)
@@ -341,6 +351,115 @@ class EventClassManager(TenantManagerMixin, models.Manager):
             )
         )
 
+    def get_calendar(self, start_date: date, end_date: date) -> List[Event]:
+        """
+        Build calendar of all event classes from queryset at once.
+
+        Result is the same as joined results of `EventClass.get_calendar`
+        for each event class, but it's requested with fixed amount of
+        queries: event classes, weekdays of event classes and real events.
+
+        :param start_date: Начальная дата календаря
+        :param end_date: Конечная дата календаря
+        :return: Список реальных и виртуальных тренировок, по дате
+        """
+        if start_date is None or end_date is None:
+            raise ValueError(
+                'Calendar can be calculated only for fixed date range')
+
+        event_classes = {ec.id: ec for ec in self}
+        if not event_classes:
+            return []
+
+        days_time = {}
+        weekdays = (
+            DayOfTheWeekClass.objects
+            .filter(event_id__in=event_classes.keys())
+            .values('event_id', 'day', 'start_time', 'end_time')
+        )
+        for x in weekdays:
+            days_time.setdefault(x['event_id'], {})[x['day']] = (
+                x['start_time'], x['end_time'])
+
+        events = {ec_id: {} for ec_id in event_classes}
+        real_events = Event.objects.filter(
+            event_class_id__in=event_classes.keys(),
+            date__range=(start_date, end_date)
+        )
+        for event in real_events:
+            event.event_class = event_classes[event.event_class_id]
+            events[event.event_class_id][event.date] = event
+
+        calendar = []
+        for ec_id, event_class in event_classes.items():
+            calendar.extend(fill_calendar(
+                event_class,
+                events[ec_id],
+                days_time.get(ec_id, {}),
+                start_date,
+                end_date
+            ).values())
+
+        return sorted(calendar, key=lambda x: x.date)
+
+
+class EventClassManager(
+    ScrmTenantManagerMixin,
+    BaseManager.from_queryset(EventClassQuerySet)
+):
+    def active(self):
+        return self.get_queryset().active()
+
+    def in_range(self, day_start, day_end):
+        return self.get_queryset().in_range(day_start, day_end)
+
+    def get_calendar(self, start_date: date, end_date: date) -> List[Event]:
+        return self.get_queryset().get_calendar(start_date, end_date)
+
+
+def fill_calendar(
+    event_class: EventClass,
+    events: Dict[date, Event],
+    days_time: Dict[int, tuple],
+    start_date: date,
+    end_date: date
+) -> Dict[date, Event]:
+    """
+    Дополнить реальные тренировки виртуальными, по расписанию типа
+    тренировки.
+
+    :param event_class: Тип тренировки
+    :param events: Реальные тренировки в диапазоне дат, по дате
+    :param days_time: Время начала и окончания тренировок по дням недели
+    :param start_date: Начальная дата календаря
+    :param end_date: Конечная дата календаря
+    :return: Словарь из даты и возможной тренировки
+    """
+    if event_class.date_from and start_date < event_class.date_from:
+        start_date = event_class.date_from
+
+    if event_class.date_to and event_class.date_to < end_date:
+        end_date = event_class.date_to
+
+    weekdays = Weekdays(sorted(days_time))
+    for event_date in next_day(start_date, end_date, weekdays):
+        if event_date not in events:
+            event = Event(
+                date=event_date,
+                event_class=event_class
+            )
+            events[event_date] = event
+        else:
+            event = events[event_date]
+
+        # Pre-set data to event can reduce response time in ten times
+        # For example non-optimized response of full calendar for one month
+        # is running for 929ms, after optimization only 80ms
+        event.event_class_name = event_class.name
+        event.start_time, event.end_time = days_time[event_date.weekday()]
+
+    return events
+
 
 @reversion.register()
 class EventClass(CompanyObjectModel):
@@ -425,6 +544,30 @@ class EventClass(CompanyObjectModel):
         except ValueError:
             return None
 
+    def nearest_extended_date(
+        self,
+        end_date: date,
+        days: Weekdays = None
+    ) -> date:
+        """
+        Дата ближайшей тренировки после окончания абонемента. Если
+        тренировок после этой даты нет - возвращается сама дата окончания.
+
+        :param end_date: Дата окончания абонемента
+        :param days: Дни недели тренировки, если уже были получены
+        :return: Новая дата окончания абонемента
+        """
+        if self.date_to is not None and self.date_to <= end_date:
+            return end_date
+
+        if days is None:
+            days = Weekdays(self.days())
+
+        try:
+            return get_nearest_to(end_date, days, self.date_to)
+        except ValueError:
+            return end_date
+
     def get_calendar(
         self,
         start_date: date,
@@ -451,12 +594,6 @@ class EventClass(CompanyObjectModel):
             self.event_set.filter(date__range=(start_date, end_date))
         }
 
-        if self.date_from and start_date < self.date_from:
-            start_date = self.date_from
-
-        if self.date_to and self.date_to < end_date:
-            end_date = self.date_to
-
         days_time = {
             x['day']: (x['start_time'], x['end_time'])
             for x in
@@ -465,27 +602,7 @@ class EventClass(CompanyObjectModel):
                 .values('day', 'start_time', 'end_time')
         }
 
-        for event_date in next_day(start_date, end_date, Weekdays(self.days())):
-            if event_date not in events:
-                event = Event(
-                    date=event_date,
-                    event_class=self
-                )
-                events[event_date] = event
-            else:
-                event = events[event_date]
-
-            # Pre-set data to event can reduce response time in ten times
-            # For example non-optimized response of full calendar for one month
-            # is running for 929ms, after optimization only 80ms
-            event.event_class_name = self.name
-            try:
-                event.start_time = days_time[event_date.weekday()][0]
-                event.end_time = days_time[event_date.weekday()][1]
-            except KeyError:
-                pass
-
-        return events
+        return fill_calendar(self, events, days_time, start_date, end_date)
 
     # TODO: Нужны методы:
     #   - Создание нового event
@@ -671,6 +788,88 @@ class SubscriptionsType(ScrmSafeDeleteModel, CompanyObjectModel):
             key=lambda x: x.date
         )
 
+    def events_count_to_date(
+        self, *,
+        to_date: date,
+        from_date: date = None,
+        filter_runner: Callable[[Event], bool] =
+        SubscriptionsTypeEventFilter.ACTIVE
+    ) -> int:
+        """
+        Get amount of events that can be visited by this subscription type.
+        Same as length of `events_to_date`, but calculated without creating
+        events: scheduled days are counted by week days, and only real
+        events are requested from database, to count canceled events and
+        events out of schedule.
+
+        :param to_date: End date of calendar
+        :param from_date: Start date of calendar, if not provided date.today()
+        will be used
+        :param filter_runner: One of `SubscriptionsTypeEventFilter` criteria.
+        Default criteria count only active events.
+
+        :return: Amount of events
+        """
+        if to_date is None:
+            raise ValueError(
+                'Calendar can be calculated only for fixed date range')
+        if filter_runner not in (
+            SubscriptionsTypeEventFilter.ALL,
+            SubscriptionsTypeEventFilter.ACTIVE,
+            SubscriptionsTypeEventFilter.CANCELED,
+        ):
+            raise TypeError('Only SubscriptionsTypeEventFilter can be counted')
+
+        from_date = from_date or date.today()
+
+        schedule = {}
+        weekdays = (
+            DayOfTheWeekClass.objects
+            .filter(event__subscriptionstype=self)
+            .values_list(
+                'event_id', 'day', 'event__date_from', 'event__date_to')
+        )
+        for ec_id, day, ec_from, ec_to in weekdays:
+            ec_days = schedule.setdefault(ec_id, (
+                max(from_date, ec_from) if ec_from else from_date,
+                min(to_date, ec_to) if ec_to else to_date,
+                set()
+            ))
+            ec_days[2].add(day)
+
+        all_count = sum(
+            count_days(start, stop, Weekdays(list(days)))
+            for start, stop, days in schedule.values()
+        )
+        canceled_count = 0
+
+        # Real events are in calendar, even if they are out of schedule of
+        # event class, or event class has no schedule at all
+        real_events = (
+            Event.objects
+            .filter(
+                event_class__subscriptionstype=self,
+                date__range=(from_date, to_date)
+            )
+            .values_list('event_class_id', 'date', 'canceled_at')
+        )
+        for ec_id, event_date, canceled_at in real_events:
+            start, stop, days = schedule.get(ec_id, (None, None, ()))
+            if not (
+                event_date.weekday() in days and start <= event_date <= stop
+            ):
+                all_count += 1
+            if canceled_at is not None:
+                canceled_count += 1
+
+        if filter_runner is SubscriptionsTypeEventFilter.ALL:
+            return all_count
+
+        if filter_runner is SubscriptionsTypeEventFilter.CANCELED:
+            return canceled_count
+
+        return all_count - canceled_count
+
     @property
     def duration_postfix(self):
         return pluralize(
@@ -758,8 +957,20 @@ class Client(ScrmSafeDeleteModel, CompanyObjectModel):
         self.balance = self.balance + decimal.Decimal(top_up_amount)
         self.save()
         if not skip_notification:
-            from gcp.tasks import enqueue
-            enqueue('notify_client_balance', self.id)
+            self.enqueue_notification('notify_client_balance', self.id)
+
+    def enqueue_notification(self, method: str, *args):
+        """
+        Поставить в очередь уведомление ученика.
+
+        Уведомления ученика, поставленные вместе, например, при продаже
+        и отметке, объединяются и приходят одним сообщением.
+
+        :param method: Задача уведомления из `bot.tasks.CLIENT_MESSAGES`
+        """
+        from gcp.tasks import enqueue_coalesced
+        enqueue_coalesced(
+            f'client-{self.id}', 'notify_client', method, *args)
 
     def add_balance_in_history(
         self,
@@ -785,8 +996,7 @@ class Client(ScrmSafeDeleteModel, CompanyObjectModel):
 
     def signup_for_event(self, event: Event):
         with transaction.atomic():
-            if not event.id:
-                event.save()
+            event.save_virtual()
             Attendance.objects.update_or_create(
                 event=event,
                 client=self,
@@ -796,34 +1006,108 @@ class Client(ScrmSafeDeleteModel, CompanyObjectModel):
     def cancel_signup_for_event(self, event):
         with transaction.atomic():
             attendance = Attendance.objects.get(client=self, event=event)
-            if attendance.subscription and attendance.marked:
+            if attendance.subscription:
+                attendance.subscription.lock()
+            # Посещение могли вернуть, пока ждали блокировки абонемента
+            marked = (
+                Attendance.objects
+                .select_for_update()
+                .values_list('marked', flat=True)
+                .get(pk=attendance.pk)
+            )
+            if attendance.subscription and marked:
                 attendance.subscription.restore_visit()
             attendance.delete()
 
-    def mark_visit(self, event, subscription: ClientSubscriptions):
-        subscription.mark_visit(event)
+    def mark_visit(self, event, subscription: ClientSubscriptions) -> int:
+        return subscription.mark_visit(event)
 
     def restore_visit(self, event):
         attendance = Attendance.objects.get(client=self, event=event)
         attendance.restore_visit()
 
 
+class ClientImport(CompanyObjectModel):
+    """
+    Загрузка учеников из файла Excel. Выполняется фоновой задачей, а
+    страница отчета следит за ее прогрессом.
+    """
+    file = models.BinaryField('Файл Excel')
+    ignore_first_row = models.BooleanField(
+        'Не учитывать первую строку', default=False)
+    name_col = models.CharField('Столбец с ФИО', max_length=3)
+    phone_col = models.CharField('Столбец с номером телефона', max_length=3)
+    birthday_col = models.CharField(
+        'Столбец с датой рождения', max_length=3)
+    vk_col = models.CharField('Столбец со ссылкой вк', max_length=3)
+    balance_col = models.CharField('Столбец с балансом', max_length=3)
+
+    status = models.CharField(
+        'Состояние',
+        max_length=16,
+        choices=IMPORT_STATUS,
+        default=IMPORT_STATUS.PENDING
+    )
+    rows_processed = models.PositiveIntegerField(
+        'Обработано строк', default=0)
+    added = models.PositiveIntegerField('Создано записей', default=0)
+    skipped = models.PositiveIntegerField('Пропущено записей', default=0)
+    errors = JSONField('Ошибки по ячейкам', default=dict)
+    created_at = models.DateTimeField('Дата загрузки', auto_now_add=True)
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (IMPORT_STATUS.DONE, IMPORT_STATUS.FAILED)
+
+    def get_absolute_url(self):
+        return reverse(
+            'crm:manager:client:import-report', kwargs={'pk': self.pk})
+
+
 class ClientSubscriptionQuerySet(TenantQuerySet):
-    def active_subscriptions_to_event(self, event: Event):
-        """Get all active subscriptions for selected event"""
-        return self.annotate(
-            counted_visits_left=F('visits_on_by_time') - Count(
-                'attendance',
-                filter=Q(attendance__event__date__lt=event.date) &
-                       Q(attendance__subscription_id=F('id'))
+    def _counted_visits_left(self, to_date: date):
+        """
+        Остаток посещений абонемента без учета посещений начиная с указанной
+        даты.
+
+        Остаток берется из счетчика `visits_used`, к которому возвращаются
+        посещения начиная с даты. Такие посещения есть лишь у немногих
+        абонементов, поэтому они считаются заранее одним запросом, а не
+        подзапросом для каждого абонемента.
+        """
+        visits_from_date = (
+            Attendance.objects
+            .filter(
+                subscription__in=self.filter(
+                    last_visit_date__gte=to_date).order_by().values('pk'),
+                event__date__gte=to_date
             )
-        ).filter(
-            subscription__event_class=event.event_class,
-            start_date__lte=event.date,
-            end_date__gte=event.date,
-            counted_visits_left__gt=0
+            .order_by()
+            .values('subscription_id')
+            .annotate(count=Count('id'))
+            .values_list('subscription_id', 'count')
+        )
+        ids_by_count = {}
+        for subscription_id, visits_count in visits_from_date:
+            ids_by_count.setdefault(visits_count, []).append(subscription_id)
+
+        return ExpressionWrapper(
+            F('visits_on_by_time') - F('visits_used') + Case(
+                *[
+                    When(id__in=ids, then=Value(visits_count))
+                    for visits_count, ids in ids_by_count.items()
+                ],
+                default=Value(0)
+            ),
+            output_field=IntegerField()
         )
 
+    def active_subscriptions_to_event(self, event: Event):
+        """Get all active subscriptions for selected event"""
+        return self.filter(
+            subscription__event_class=event.event_class
+        ).active_subscriptions_to_date(event.date)
+
     def active_subscriptions_to_date(self, to_date: date):
         """
         Get all subscriptions, active at particular date
@@ -831,18 +1115,62 @@ class ClientSubscriptionQuerySet(TenantQuerySet):
         :param to_date: Date to test activity
         :return:
         """
-        return self.annotate(
-            counted_visits_left=F('visits_on_by_time') - Count(
-                'attendance',
-                filter=Q(attendance__event__date__lt=to_date) &
-                       Q(attendance__subscription_id=F('id'))
-            )
-        ).filter(
+        active = self.filter(
             start_date__lte=to_date,
             end_date__gte=to_date,
+        )
+        return active.annotate(
+            counted_visits_left=active._counted_visits_left(to_date)
+        ).filter(
             counted_visits_left__gt=0
         )
 
+    @staticmethod
+    def _actual_visits():
+        """Выражения количества и даты последнего посещения абонемента"""
+        attendances = (
+            Attendance.objects
+            .filter(subscription_id=OuterRef('pk'))
+            .order_by()
+        )
+        return {
+            'visits_used': Coalesce(
+                Subquery(
+                    attendances
+                    .values('subscription_id')
+                    .annotate(count=Count('id'))
+                    .values('count'),
+                    output_field=IntegerField()
+                ),
+                0
+            ),
+            'last_visit_date': Subquery(
+                attendances
+                .order_by('-event__date')
+                .values('event__date')[:1],
+                output_field=models.DateField()
+            ),
+        }
+
+    def with_actual_visits(self):
+        """
+        Аннотировать количество посещений и дату последнего посещения,
+        посчитанные по посещениям, а не по счетчикам абонемента.
+        """
+        return self.annotate(**{
+            f'actual_{name}': expression
+            for name, expression in self._actual_visits().items()
+        })
+
+    def update_visits_counters(self) -> int:
+        """
+        Пересчитать счетчики посещений `visits_used` и `last_visit_date`
+        по посещениям абонементов одним запросом.
+
+        :return: Количество обновленных абонементов
+        """
+        return self.update(**self._actual_visits())
+
     def active_subscriptions(self):
         today = date.today()
         return self.filter(
@@ -870,9 +1198,159 @@ class ClientSubscriptionsManager(
     def active_subscriptions(self):
         return self.get_queryset().active_subscriptions()
 
+    def with_actual_visits(self):
+        return self.get_queryset().with_actual_visits()
+
+    def update_visits_counters(self) -> int:
+        return self.get_queryset().update_visits_counters()
+
+    def mark_visits(
+        self,
+        event: Event,
+        visits: Dict[int, int]
+    ) -> List[ClientSubscriptions]:
+        """
+        Отметить посещения нескольких учеников тренировки.
+
+        Все посещения отмечаются в одной транзакции за постоянное количество
+        запросов: абонементы блокируются и проверяются одним запросом,
+        новые посещения создаются через `bulk_create`, а остатки посещений
+        уменьшаются одним UPDATE. Уведомления ученикам отправляются одной
+        задачей.
+
+        :param event: Тренировка, в том числе виртуальная
+        :param visits: Идентификаторы абонементов по идентификатору ученика
+        :return: Абонементы с остатком посещений после отметки
+        :raises InvalidVisits: Если хотя бы одно посещение нельзя отметить.
+            Тогда не отмечается ни одно
+        """
+        if not visits:
+            return []
+
+        with transaction.atomic():
+            # Как и при отметке одного посещения, абонементы блокируются
+            # раньше посещений
+            subscriptions = {
+                sub.id: sub for sub in (
+                    self.get_queryset()
+                    .filter(
+                        id__in=visits.values(),
+                        subscription__event_class=event.event_class_id
+                    )
+                    .select_for_update(of=('self',))
+                    .order_by('id')
+                )
+            }
+            attendances = {}
+            if event.id:
+                attendances = {
+                    attendance.client_id: attendance for attendance in (
+                        Attendance.objects
+                        .select_for_update()
+                        .filter(event=event, client_id__in=list(visits))
+                    )
+                }
+
+            errors = {}
+            for client_id, sub_id in visits.items():
+                sub = subscriptions.get(sub_id)
+                attendance = attendances.get(client_id)
+                if sub is None or sub.client_id != client_id:
+                    errors[client_id] = 'Абонемент не подходит к тренировке'
+                elif not sub.is_active_at_date_without_events(event.date):
+                    errors[client_id] = 'Абонемент закончился'
+                elif attendance and attendance.marked:
+                    errors[client_id] = 'Посещение уже отмечено'
+            if errors:
+                raise InvalidVisits(errors)
+
+            event.save_virtual()
+
+            # Посещения записанных учеников уже есть, их только отмечаем
+            new_attendances = []
+            for client_id, sub_id in visits.items():
+                attendance = attendances.get(client_id)
+                if attendance is None:
+                    attendance = Attendance(
+                        company_id=event.company_id,
+                        event=event,
+                        client_id=client_id
+                    )
+                    new_attendances.append(attendance)
+                attendance.subscription_id = sub_id
+                attendance.marked = True
+
+            Attendance.objects.bulk_create(new_attendances)
+            bulk_update(
+                Attendance.objects.all(),
+                attendances.values(),
+                ['subscription', 'marked']
+            )
+            # Массовое сохранение не попадает в историю изменений само
+            if reversion.is_active():
+                for attendance in new_attendances + list(attendances.values()):
+                    reversion.add_to_revision(attendance)
+
+            # Счетчики посещений абонементов пересчитываются при создании
+            # и изменении посещений
+            self.get_queryset().filter(id__in=subscriptions).update(
+                visits_left=F('visits_left') - 1)
+
+            for sub in subscriptions.values():
+                sub.visits_left -= 1
+
+            from gcp.tasks import enqueue
+            enqueue('notify_client_subscription_visits', list(subscriptions))
+
+        from crm.scanner import invalidate_event_scanner_roster
+        invalidate_event_scanner_roster(event)
+        return list(subscriptions.values())
+
     def extend_by_cancellation(self, cancelled_event: Event):
-        for subscription in self.active_subscriptions_to_event(cancelled_event):
-            subscription.extend_by_cancellation(cancelled_event)
+        """
+        Extend all subscriptions, active to cancelled event, to next event
+        of the same event class.
+
+        New end dates are calculated in memory from event class schedule,
+        and saved with one update and one insert of extension history.
+        """
+        subscriptions = list(
+            self.active_subscriptions_to_event(cancelled_event))
+        if not subscriptions:
+            return
+
+        event_class = cancelled_event.event_class
+        days = Weekdays(event_class.days())
+        reason = f'В связи с отменой тренировки {cancelled_event}'
+
+        extended = []
+        history = []
+        for subscription in subscriptions:
+            new_end_date = event_class.nearest_extended_date(
+                subscription.end_date, days)
+            if new_end_date == subscription.end_date:
+                # Don't extend if there is no more future events for this
+                # event class
+                continue
+
+            history.append(ExtensionHistory(
+                client_subscription=subscription,
+                reason=reason,
+                added_visits=0,
+                related_event=cancelled_event,
+                extended_from=subscription.end_date,
+                extended_to=new_end_date
+            ))
+            subscription.end_date = new_end_date
+            extended.append(subscription)
+
+        with transaction.atomic():
+            bulk_update(self.get_queryset(), extended, ['end_date'])
+            ExtensionHistory.objects.bulk_create(history)
+
+        # Продленные абонементы подходят к другим тренировкам
+        from crm.scanner import invalidate_company_scanner_rosters
+        invalidate_company_scanner_rosters(cancelled_event.company_id)
 
     def revoke_extending(self, activated_event: Event):
         # Don't try revoke on non-active events or non-canceled evens
@@ -884,8 +1362,73 @@ class ClientSubscriptionsManager(
         subs_ids = activated_event.extensionhistory_set.all().values_list(
             'client_subscription_id', flat=True)
 
-        for subscription in self.get_queryset().filter(id__in=subs_ids):
-            subscription.revoke_extending(activated_event)
+        # Load all extension chains of affected subscriptions at once,
+        # chain rebuilding is same as in ClientSubscriptions.revoke_extending
+        chains = {}
+        extensions = (
+            ExtensionHistory.objects
+            .filter(client_subscription_id__in=subs_ids)
+            .select_related('client_subscription')
+            .order_by('client_subscription_id', 'date_extended')
+        )
+        for extension in extensions:
+            chains.setdefault(extension.client_subscription_id, []).append(
+                extension)
+
+        if not chains:
+            return
+
+        changed_extensions = []
+        changed_subscriptions = []
+        extensions_to_delete = []
+        for chain in chains.values():
+            for idx, extension_to_delete in enumerate(chain):
+                if extension_to_delete.related_event_id == activated_event.id:
+                    break
+            else:
+                continue
+
+            prev_from = extension_to_delete.extended_from
+            prev_to = extension_to_delete.extended_to
+            for chained_extension in chain[idx + 1:]:
+                if chained_extension.date_extended == \
+                        extension_to_delete.date_extended:
+                    continue
+
+                current_from = chained_extension.extended_from
+                current_to = chained_extension.extended_to
+
+                chained_extension.extended_from = prev_from
+                chained_extension.extended_to = prev_to
+                changed_extensions.append(chained_extension)
+
+                prev_from = current_from
+                prev_to = current_to
+
+            if prev_from:
+                subscription = extension_to_delete.client_subscription
+                subscription.end_date = prev_from
+                changed_subscriptions.append(subscription)
+            else:
+                logger.error(
+                    'Subscription date extension with empty extended_from found'
+                )
+
+            extensions_to_delete.append(extension_to_delete.id)
+
+        with transaction.atomic():
+            bulk_update(
+                ExtensionHistory.objects.all(),
+                changed_extensions,
+                ['extended_from', 'extended_to']
+            )
+            bulk_update(
+                self.get_queryset(), changed_subscriptions, ['end_date'])
+            ExtensionHistory.objects.filter(
+                id__in=extensions_to_delete).delete()
+
+        from crm.scanner import invalidate_company_scanner_rosters
+        invalidate_company_scanner_rosters(activated_event.company_id)
 
     def exclude_onetime(self):
         return self.get_queryset().filter(subscription__one_time=False)
@@ -895,6 +1438,16 @@ class ClientAttendanceExists(Exception):
     pass
 
 
+class InvalidVisits(ValueError):
+    """
+    Посещения, которые нельзя отметить. Причины в `errors` по идентификатору
+    ученика
+    """
+    def __init__(self, errors: Dict[int, str]):
+        super().__init__('; '.join(errors.values()))
+        self.errors = errors
+
+
 @reversion.register()
 class ClientSubscriptions(CompanyObjectModel):
     """Абонементы клиента"""
@@ -927,6 +1480,13 @@ class ClientSubscriptions(CompanyObjectModel):
         "Количество визитов на момент покупки"
     )
     visits_left = models.PositiveIntegerField("Остаток посещений")
+    # Счетчики посещений, поддерживаются при сохранении и удалении
+    # посещений, их массовых изменениях и при смене даты тренировки.
+    # Проверить и пересчитать: manage.py check_visits_counters
+    visits_used = models.PositiveIntegerField(
+        "Использовано посещений", default=0)
+    last_visit_date = models.DateField(
+        "Дата последнего посещения", null=True, blank=True)
 
     objects = ClientSubscriptionsManager()
 
@@ -947,6 +1507,9 @@ class ClientSubscriptions(CompanyObjectModel):
         if to_date < self.start_date:
             return 0
 
+        if self.last_visit_date is None or self.last_visit_date <= to_date:
+            return self.visits_on_by_time - self.visits_used
+
         return self.visits_on_by_time - self.attendance_set.filter(
             event__date__lte=to_date
         ).count()
@@ -979,22 +1542,37 @@ class ClientSubscriptions(CompanyObjectModel):
         today = date.today()
         return min(
             self.visits_to_date(today),
-            len(self.subscription.events_to_date(
+            self.subscription.events_count_to_date(
                 from_date=today + timedelta(days=1),
                 to_date=self.end_date
-            ))
+            )
         )
 
     def save(self, *args, **kwargs):
+        # Сохранение отдельных полей - это отметки посещений, они сбрасывают
+        # карты сканера только своих тренировок
+        changes_subscription = kwargs.get('update_fields') is None
         # Prevent change end date for extended client subscription
         if not self.id:
             self.start_date = self.subscription.start_date(self.start_date)
             self.end_date = self.subscription.end_date(self.start_date)
             # Save original provided client visits limit
             self.visits_on_by_time = self.visits_left
+        elif kwargs.get('update_fields') is None:
+            # Visits counters are changed only by update_visits_counters,
+            # so saving of outdated instance must not overwrite them
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and
+                field.name not in ('visits_used', 'last_visit_date')
+            ]
 
         super().save(*args, **kwargs)
 
+        if changes_subscription:
+            from crm.scanner import invalidate_company_scanner_rosters
+            invalidate_company_scanner_rosters(self.company_id)
+
     def next_event_date(
         self,
         start_date: date,
@@ -1097,8 +1675,8 @@ class ClientSubscriptions(CompanyObjectModel):
             self.visits_left = new_visits_limit
             self.end_date = new_end_date
             self.save()
-            from gcp.tasks import enqueue
-            enqueue('notify_client_subscription_extend', self.id)
+            self.client.enqueue_notification(
+                'notify_client_subscription_extend', self.id)
 
     def extend_by_cancellation(self, cancelled_event: Event):
         possible_extension_date = self.nearest_extended_end_date(
@@ -1225,9 +1803,9 @@ class ClientSubscriptions(CompanyObjectModel):
         """
         from_date = self.start_date if start_date is None else start_date
         try:
-            return len(self.subscription.events_to_date(
+            return self.subscription.events_count_to_date(
                 from_date=from_date, to_date=self.end_date
-            )) < visits_amount
+            ) < visits_amount
         except ValueError:
             return False
 
@@ -1247,10 +1825,8 @@ class ClientSubscriptions(CompanyObjectModel):
         """
         from_date = self.start_date if start_date is None else start_date
 
-        return visits_amount - (
-            len(self.subscription.events_to_date(
-                from_date=from_date, to_date=self.end_date
-            ))
+        return visits_amount - self.subscription.events_count_to_date(
+            from_date=from_date, to_date=self.end_date
         )
 
     def is_overlapping(self) -> bool:
@@ -1273,11 +1849,11 @@ class ClientSubscriptions(CompanyObjectModel):
         canceled events is greater that remaining visits minus active events
         """
         try:
-            return len(self.subscription.events_to_date(
+            return self.subscription.events_count_to_date(
                 from_date=self.start_date,
                 to_date=self.end_date,
                 filter_runner=SubscriptionsTypeEventFilter.ALL
-            )) < self.visits_left
+            ) < self.visits_left
         except ValueError:
             return False
 
@@ -1296,6 +1872,10 @@ class ClientSubscriptions(CompanyObjectModel):
             return []
 
     def last_visited_event(self):
+        # Может быть заранее заполнено для списка абонементов, см. crm.roster
+        if hasattr(self, '_last_visited_event'):
+            return self._last_visited_event
+
         last = self.attendance_set.select_related('event').filter(
             marked=True,
             event__canceled_at__isnull=True,
@@ -1306,7 +1886,14 @@ class ClientSubscriptions(CompanyObjectModel):
             return last.event
 
     def canceled_events_count(self):
-        return len(self.canceled_events())
+        try:
+            return self.subscription.events_count_to_date(
+                from_date=self.start_date,
+                to_date=self.end_date,
+                filter_runner=SubscriptionsTypeEventFilter.CANCELED
+            )
+        except ValueError:
+            return 0
 
     def is_active_at_date_without_events(self, check_date) -> bool:
         """
@@ -1341,12 +1928,12 @@ class ClientSubscriptions(CompanyObjectModel):
             return False
 
         # Extract one day - to check if subscriptions ends before date
-        future_events = self.subscription.events_to_date(
+        future_events_count = self.subscription.events_count_to_date(
             to_date=(to_date - timedelta(days=1)))
 
         # If visits limit ends before date, we are sure that subscription is
         # no more active
-        return not (self.visits_left - len(future_events) <= 0)
+        return not (self.visits_left - future_events_count <= 0)
 
     def is_active(self) -> bool:
         return self.is_active_to_date(date.today())
@@ -1356,36 +1943,93 @@ class ClientSubscriptions(CompanyObjectModel):
         delta = self.end_date - date.today()
         return delta.days <= 7 or self.visits_left == 1
 
-    def mark_visit(self, event):
-        """Отметить посещение по абонементу"""
+    def lock(self) -> int:
+        """
+        Заблокировать строку абонемента до конца транзакции и обновить
+        остаток посещений этого экземпляра.
+
+        Отметки и возвраты посещений одного абонемента блокируют его раньше
+        посещения, поэтому выполняются по очереди и видят изменения друг
+        друга, в том числе в счетчиках посещений.
+
+        :return: Текущий остаток посещений
+        """
+        self.visits_left = (
+            ClientSubscriptions.objects
+            .select_for_update()
+            .values_list('visits_left', flat=True)
+            .get(pk=self.pk)
+        )
+        return self.visits_left
+
+    def _change_visits_left(self, delta: int) -> int:
+        """
+        Изменить остаток посещений абонемента, уже заблокированного `lock`
+        в текущей транзакции.
+
+        :param delta: На сколько изменить остаток
+        :return: Новый остаток посещений
+        """
+        self.visits_left += delta
+        self.save(update_fields=['visits_left'])
+        return self.visits_left
+
+    def mark_visit(self, event) -> int:
+        """
+        Отметить посещение по абонементу
+
+        :return: Остаток посещений после отметки
+        """
         if not self.is_active_at_date_without_events(event.date):
             raise ValueError('Subscription or event is incorrect')
 
         with transaction.atomic():
+            self.lock()
+            event.save_virtual()
             attendance, created = Attendance.objects.get_or_create(
                 event=event,
                 client=self.client,
                 defaults={'subscription': self, 'marked': False})
 
-            if not created and attendance.marked:
-                raise ClientAttendanceExists(
-                    'Client attendance for this event already exists')
+            if not created:
+                # Параллельная отметка того же ученика дождется окончания
+                # этой и увидит уже отмеченное посещение
+                attendance = (
+                    Attendance.objects
+                    .select_for_update()
+                    .get(pk=attendance.pk)
+                )
+                if attendance.marked:
+                    raise ClientAttendanceExists(
+                        'Client attendance for this event already exists')
 
             attendance.mark_visit(self)
-            self.visits_left = self.visits_left - 1
-            self.save()
-            from gcp.tasks import enqueue
-            enqueue('notify_client_subscription_visit', self.id)
+            visits_left = self._change_visits_left(-1)
+            self.client.enqueue_notification(
+                'notify_client_subscription_visit', self.id)
 
-    def restore_visit(self):
+        return visits_left
+
+    def restore_visit(self) -> int:
+        """
+        Вернуть посещение на абонемент. Абонемент должен быть заблокирован
+        `lock` в текущей транзакции раньше посещения.
+
+        :return: Остаток посещений после возврата
+        """
         with transaction.atomic():
-            self.visits_left = self.visits_left + 1
-            self.save()
-            from gcp.tasks import enqueue
-            enqueue('notify_client_subscription_visit', self.id)
+            visits_left = self._change_visits_left(1)
+            self.client.enqueue_notification(
+                'notify_client_subscription_visit', self.id)
+
+        return visits_left
 
     class Meta:
         ordering = ['purchase_date']
+        indexes = [
+            models.Index(fields=['company', 'start_date', 'end_date']),
+            models.Index(fields=['company', 'client', 'purchase_date']),
+        ]
 
     def __str__(self):
         return f'{self.subscription.name} (до {self.end_date:%d.%m.%Y})'
@@ -1465,6 +2109,55 @@ class EventManager(TenantManagerMixin, models.Manager):
             event_class = get_object_or_404(EventClass, id=event_class_id)
             return Event(date=event_date, event_class=event_class)
 
+    def with_report_stats(self):
+        """
+        Тренировки с посчитанными для отчета значениями: количество
+        отметившихся учеников, количество проданных разовых и обычных
+        абонементов, сумма продаж.
+
+        Посещения считаются подзапросом, чтобы соединение с посещениями не
+        размножало строки проданных абонементов.
+        """
+        present_clients = (
+            Attendance.objects
+            .filter(event=OuterRef('pk'), marked=True)
+            .order_by()
+            .values('event')
+            .annotate(count=Count('id'))
+            .values('count')
+        )
+        return self.get_queryset().select_related(
+            'event_class__coach__user'
+        ).annotate(
+            present_clients_count=Coalesce(
+                Subquery(present_clients, output_field=IntegerField()), 0
+            ),
+            one_time_sub_clients_count=Count(
+                'clientsubscriptions',
+                filter=Q(clientsubscriptions__subscription__one_time=True)
+            ),
+            subs_sales_count=Count(
+                'clientsubscriptions',
+                filter=Q(clientsubscriptions__subscription__one_time=False)
+            ),
+            profit=Sum('clientsubscriptions__price'),
+        )
+
+    def untouched(self):
+        """
+        Тренировки, с которыми ничего не делали: без записей и посещений,
+        без проданных на них абонементов и продлений, не отмененные и не
+        закрытые. Такие тренировки не отличаются от виртуальных и могут быть
+        удалены.
+        """
+        return self.get_queryset().filter(
+            canceled_at__isnull=True,
+            is_closed=False,
+            attendance__isnull=True,
+            clientsubscriptions__isnull=True,
+            extensionhistory__isnull=True,
+        )
+
 
 @reversion.register()
 class Event(CompanyObjectModel):
@@ -1491,6 +2184,49 @@ class Event(CompanyObjectModel):
     class Meta:
         unique_together = ('event_class', 'date',)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Дата при загрузке, чтобы обновить счетчики посещений при смене
+        instance._loaded_date = instance.__dict__.get('date')
+        return instance
+
+    def save_virtual(self):
+        """
+        Сохранить виртуальную тренировку перед отметкой на ней учеников.
+
+        Одну тренировку могут сохранять одновременно, например, при
+        отметке первых учеников с нескольких сканеров. Тогда тренировка
+        не создается второй раз, а берется уже сохраненная.
+        """
+        if self.id:
+            return
+        saved, _ = Event.objects.get_or_create(
+            event_class=self.event_class,
+            date=self.date,
+            defaults={
+                field.attname: getattr(self, field.attname)
+                for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.attname not in ('event_class_id', 'date')
+            }
+        )
+        for field in self._meta.concrete_fields:
+            setattr(self, field.attname, getattr(saved, field.attname))
+        self._loaded_date = saved.date
+        self._state.adding = False
+        self._state.db = saved._state.db
+
+    def save(self, *args, **kwargs):
+        loaded_date = getattr(self, '_loaded_date', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Дата последнего посещения абонементов могла измениться
+            if loaded_date is not None and loaded_date != self.date:
+                ClientSubscriptions.objects.filter(
+                    attendance__event=self).update_visits_counters()
+        self._loaded_date = self.date
+
     def clean(self):
         # Проверяем пренадлижит ли указанная дата тренировке
         # TODO: Refactor dump Event.is_event_day
@@ -1508,13 +2244,20 @@ class Event(CompanyObjectModel):
         """
         return self.attendance_set.filter(signed_up=True).count()
 
+    # Методы отчета используют значения из Event.objects.with_report_stats,
+    # если тренировка получена через него
+
     def get_present_clients_count(self):
         # Получаем количество посетивших данную тренировку клиентов
+        if hasattr(self, 'present_clients_count'):
+            return self.present_clients_count
         return self.attendance_set.filter(marked=True).count()
 
     def get_clients_count_one_time_sub(self):
         # Получаем количество посетивших данную тренировку
         # по одноразовому абонементу
+        if hasattr(self, 'one_time_sub_clients_count'):
+            return self.one_time_sub_clients_count
         queryset = ClientSubscriptions.objects.filter(
             subscription__one_time=True,
             event=self,
@@ -1523,6 +2266,8 @@ class Event(CompanyObjectModel):
 
     def get_subs_sales(self):
         # Получаем количество проданных абонементов
+        if hasattr(self, 'subs_sales_count'):
+            return self.subs_sales_count
         queryset = ClientSubscriptions.objects.filter(
             subscription__one_time=False,
             event=self
@@ -1531,6 +2276,8 @@ class Event(CompanyObjectModel):
 
     def get_profit(self):
         # Получаем прибыль
+        if hasattr(self, 'profit'):
+            return self.profit or 0
         price = ClientSubscriptions.objects.filter(
             event=self
         ).aggregate(Sum('price'))
@@ -1619,12 +2366,26 @@ class Event(CompanyObjectModel):
             if extend_subscriptions:
                 ClientSubscriptions.objects.extend_by_cancellation(self)
 
+            # Уведомления об отмене рассылаются параллельно, задачей на
+            # каждую пачку учеников
+            client_ids = list(
+                Client.objects.with_active_subscription_to_event(self)
+                .order_by('id')
+                .values_list('id', flat=True)
+            )
             try:
-                from gcp.tasks import enqueue
-                enqueue('notify_event_cancellation', self.id)
+                from gcp.tasks import enqueue_many
+                enqueue_many('notify_event_cancellation', [
+                    (self.id, client_ids[i:i + CANCELLATION_NOTIFY_CHUNK])
+                    for i in range(
+                        0, len(client_ids), CANCELLATION_NOTIFY_CHUNK)
+                ])
             except ImportError:
                 pass
 
+        from crm.scanner import invalidate_event_scanner_roster
+        invalidate_event_scanner_roster(self)
+
     def activate_event(self, revoke_extending=False):
         if not self.is_active:
             raise ValueError("Event is outdated. It can't be activated.")
@@ -1641,6 +2402,9 @@ class Event(CompanyObjectModel):
             if revoke_extending and original_cwe:
                 ClientSubscriptions.objects.revoke_extending(self)
 
+        from crm.scanner import invalidate_event_scanner_roster
+        invalidate_event_scanner_roster(self)
+
     def close_event(self):
         """Закрыть тренировку"""
         if not self.is_overpast:
@@ -1665,6 +2429,74 @@ class Event(CompanyObjectModel):
         enqueue('notify_manager_event_opened', self.id)
 
 
+class AttendanceQuerySet(TenantQuerySet):
+    """
+    Массовые изменения посещений пересчитывают счетчики посещений
+    абонементов, как и сохранение одного посещения.
+    """
+
+    @staticmethod
+    def _update_visits_counters(subscriptions: Q):
+        ClientSubscriptions.objects.filter(
+            subscriptions).update_visits_counters()
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(savepoint=False):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            subscription_ids = {obj.subscription_id for obj in objs} - {None}
+            if subscription_ids:
+                self._update_visits_counters(Q(id__in=subscription_ids))
+        return objs
+
+    def update(self, **kwargs):
+        # Счетчики зависят только от абонемента и даты тренировки
+        if not {'subscription', 'subscription_id', 'event', 'event_id'} & set(
+            kwargs
+        ):
+            return super().update(**kwargs)
+
+        with transaction.atomic(savepoint=False):
+            ids, subscription_ids = set(), set()
+            for attendance_id, subscription_id in self.order_by().values_list(
+                'id', 'subscription_id'
+            ):
+                ids.add(attendance_id)
+                subscription_ids.add(subscription_id)
+            rows = super().update(**kwargs)
+            # Счетчики и прежних, и новых абонементов посещений
+            self._update_visits_counters(
+                Q(id__in=subscription_ids - {None}) |
+                Q(id__in=self.model.objects.filter(
+                    id__in=ids).values('subscription_id'))
+            )
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic(savepoint=False):
+            subscription_ids = set(
+                self.exclude(subscription=None)
+                .order_by()
+                .values_list('subscription_id', flat=True)
+                .distinct()
+            )
+            result = super().delete()
+            if subscription_ids:
+                self._update_visits_counters(Q(id__in=subscription_ids))
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class AttendanceManager(
+    ScrmTenantManagerMixin,
+    BaseManager.from_queryset(AttendanceQuerySet)
+):
+    pass
+
+
 @reversion.register()
 class Attendance(CompanyObjectModel):
     """Посещение клиентом мероприятия(тренировки)"""
@@ -1696,6 +2528,41 @@ class Attendance(CompanyObjectModel):
         default=False
     )
 
+    objects = AttendanceManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Абонемент при загрузке, чтобы обновить его счетчики при смене
+        instance._loaded_subscription_id = instance.__dict__.get(
+            'subscription_id')
+        return instance
+
+    def _update_visits_counters(self):
+        ids = {
+            self.subscription_id,
+            getattr(self, '_loaded_subscription_id', None)
+        } - {None}
+        if ids:
+            ClientSubscriptions.objects.filter(
+                id__in=ids).update_visits_counters()
+        self._loaded_subscription_id = self.subscription_id
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self._update_visits_counters()
+        from crm.scanner import invalidate_event_scanner_roster
+        invalidate_event_scanner_roster(self.event)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super().delete(*args, **kwargs)
+            self._update_visits_counters()
+        from crm.scanner import invalidate_event_scanner_roster
+        invalidate_event_scanner_roster(self.event)
+        return result
+
     def mark_visit(self, subscription: ClientSubscriptions):
         self.subscription = subscription
         self.marked = True
@@ -1703,6 +2570,15 @@ class Attendance(CompanyObjectModel):
 
     def restore_visit(self):
         with transaction.atomic():
+            if self.subscription:
+                self.subscription.lock()
+            # Повторный возврат того же посещения не должен второй раз
+            # увеличить остаток абонемента
+            locked = Attendance.objects.select_for_update().get(pk=self.pk)
+            if not locked.marked:
+                self.marked = False
+                return
+
             self.marked = False
             if self.subscription:
                 self.subscription.restore_visit()
@@ -0,0 +1,224 @@
+from datetime import date
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+from crm.models import Attendance, Client, ClientSubscriptions, Event
+from crm.vk_avatars import get_vk_avatars
+
+
+class RosterEntry(NamedTuple):
+    """Строка списка учеников тренировки"""
+    client: Client
+    subscriptions: List[ClientSubscriptions]
+    last_sub: Optional[ClientSubscriptions]
+    attendance: Optional[Attendance] = None
+
+
+class EventRoster:
+    """
+    Список учеников тренировки, разбитый на группы: записанные, доступные
+    по абонементу и отмеченные.
+
+    Все группы, вместе с активными абонементами, последним абонементом
+    ученика и последним посещением по абонементу, собираются за постоянное
+    количество запросов, независимо от количества учеников.
+    """
+
+    def __init__(self, event: Event):
+        self.event = event
+
+        self.signed_up: List[RosterEntry] = []
+        self.unmarked: List[RosterEntry] = []
+        self.marked: List[RosterEntry] = []
+
+        self._build()
+
+    @property
+    def client_ids(self) -> List[int]:
+        return [
+            entry.client.id
+            for entry in self.signed_up + self.unmarked + self.marked
+        ]
+
+    def _attendances(self) -> List[Attendance]:
+        # У виртуальной тренировки еще не может быть посещений
+        if self.event.id is None:
+            return []
+
+        return list(
+            self.event.attendance_set
+            .select_related(
+                'client',
+                'subscription__subscription',
+                'subscription__sold_by',
+            )
+        )
+
+    def _active_subscriptions(self) -> List[ClientSubscriptions]:
+        return list(
+            ClientSubscriptions.objects
+            .active_subscriptions_to_event(self.event)
+            .select_related('client', 'subscription', 'sold_by')
+            .order_by('client_id', 'purchase_date', 'id')
+        )
+
+    def _build(self):
+        attendances = self._attendances()
+        active_subs = self._active_subscriptions()
+
+        subs_by_client: Dict[int, List[ClientSubscriptions]] = {}
+        clients: Dict[int, Client] = {}
+        for sub in active_subs:
+            subs_by_client.setdefault(sub.client_id, []).append(sub)
+            clients[sub.client_id] = sub.client
+
+        attended_ids = {attendance.client_id for attendance in attendances}
+
+        # Записанные клиенты. У них может и не быть абонементов
+        signed_up = [
+            attendance.client for attendance in attendances
+            if not attendance.marked and attendance.signed_up
+        ]
+        # Неотмеченные клиент. Они не записывались, но у них есть абонементы
+        # которые позволяют сходить на это занятие
+        unmarked = [
+            client for client_id, client in clients.items()
+            if client_id not in attended_ids
+        ]
+        # Отмеченные клиенты. Они сходили на занятие и у них есть абонементы
+        marked = [
+            attendance for attendance in attendances if attendance.marked
+        ]
+
+        last_subs = last_subscriptions(
+            [client.id for client in signed_up + unmarked] +
+            [attendance.client_id for attendance in marked]
+        )
+
+        self.signed_up = [
+            RosterEntry(
+                client=client,
+                subscriptions=subs_by_client.get(client.id, []),
+                last_sub=last_subs.get(client.id),
+            )
+            for client in sorted(signed_up, key=lambda x: x.name)
+            if not client.deleted
+        ]
+        self.unmarked = [
+            RosterEntry(
+                client=client,
+                subscriptions=subs_by_client[client.id],
+                last_sub=last_subs.get(client.id),
+            )
+            for client in sorted(unmarked, key=lambda x: x.name)
+            if not client.deleted
+        ]
+        self.marked = [
+            RosterEntry(
+                client=attendance.client,
+                subscriptions=(
+                    [attendance.subscription] if attendance.subscription
+                    else []
+                ),
+                last_sub=last_subs.get(attendance.client_id),
+                attendance=attendance,
+            )
+            for attendance in sorted(marked, key=lambda x: x.client.name)
+        ]
+
+        prefetch_last_visited_events(
+            sub
+            for entry in self.signed_up + self.unmarked + self.marked
+            for sub in entry.subscriptions
+        )
+
+
+def last_subscriptions(
+    client_ids: Iterable[int]
+) -> Dict[int, ClientSubscriptions]:
+    """
+    Последние купленные (не разовые) абонементы клиентов одним запросом.
+
+    Аналог `Client.last_sub` для набора клиентов.
+
+    :param client_ids: Идентификаторы клиентов
+    :return: Словарь абонементов по идентификатору клиента
+    """
+    client_ids = list(client_ids)
+    if not client_ids:
+        return {}
+
+    subs = (
+        ClientSubscriptions.objects
+        .exclude_onetime()
+        .filter(
+            client_id__in=client_ids,
+            subscription__deleted__isnull=True
+        )
+        .select_related('subscription')
+        .order_by('client_id', '-purchase_date')
+        .distinct('client_id')
+    )
+    return {sub.client_id: sub for sub in subs}
+
+
+def prefetch_last_visited_events(subscriptions: Iterable[ClientSubscriptions]):
+    """
+    Заполнить кэш `ClientSubscriptions.last_visited_event` для набора
+    абонементов одним запросом.
+    """
+    subscriptions = list(subscriptions)
+    if not subscriptions:
+        return
+
+    attendances = (
+        Attendance.objects
+        .filter(
+            subscription_id__in={sub.id for sub in subscriptions},
+            marked=True,
+            event__canceled_at__isnull=True,
+        )
+        .exclude(event__date__gt=date.today())
+        .select_related('event')
+        .order_by('subscription_id', '-event__date')
+        .distinct('subscription_id')
+    )
+    events = {
+        attendance.subscription_id: attendance.event
+        for attendance in attendances
+    }
+    for sub in subscriptions:
+        sub._last_visited_event = events.get(sub.id)
+
+
+def prefetch_client_cards(clients: Iterable[Client]):
+    """
+    Подготовить карточки списка учеников за постоянное количество запросов.
+
+    Ученикам проставляются активные абонементы `active_subs`, последний
+    абонемент `last_subscription` и ссылка на аватарку VK `vk_avatar`.
+    """
+    clients = list(clients)
+    if not clients:
+        return
+
+    client_ids = [client.id for client in clients]
+    active_subs: Dict[int, List[ClientSubscriptions]] = {}
+    subscriptions = (
+        ClientSubscriptions.objects
+        .active_subscriptions()
+        .filter(client_id__in=client_ids)
+        .select_related('subscription', 'sold_by')
+    )
+    for sub in subscriptions:
+        active_subs.setdefault(sub.client_id, []).append(sub)
+    last_subs = last_subscriptions(client_ids)
+    avatars = get_vk_avatars(
+        client.vk_user_id for client in clients if client.vk_user_id)
+
+    for client in clients:
+        client.active_subs = active_subs.get(client.id, [])
+        client.last_subscription = last_subs.get(client.id)
+        client.vk_avatar = avatars.get(client.vk_user_id)
+
+    prefetch_last_visited_events(
+        sub for subs in active_subs.values() for sub in subs)
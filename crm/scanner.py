@@ -0,0 +1,118 @@
+from typing import Dict, Optional
+from uuid import UUID
+
+from django.core.cache import cache
+
+from crm.models import ClientSubscriptions, Event
+
+# Карты сканера нужны, пока идет тренировка
+SCANNER_ROSTER_TIMEOUT = 60 * 60 * 3
+
+
+def _company_version_key(company_id: int) -> str:
+    return f'scanner_roster_version_{company_id}'
+
+
+def scanner_roster_key(event: Event) -> str:
+    """
+    Ключ карты сканера тренировки.
+
+    В ключ входит версия карт компании, поэтому все карты компании можно
+    сбросить, не зная, какие тренировки уже закэшированы.
+    """
+    version = cache.get(_company_version_key(event.company_id), 0)
+    return (
+        f'scanner_roster_{event.company_id}_{version}_'
+        f'{event.event_class_id}_{event.date:%Y%m%d}'
+    )
+
+
+def invalidate_event_scanner_roster(event: Event):
+    """Сбросить карту сканера тренировки после отметок и их отмены"""
+    cache.delete(scanner_roster_key(event))
+
+
+def invalidate_company_scanner_rosters(company_id: int):
+    """
+    Сбросить карты сканера всех тренировок компании.
+
+    Нужно при изменении абонементов: один абонемент подходит ко многим
+    тренировкам.
+    """
+    key = _company_version_key(company_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, timeout=None)
+
+
+class ScannerRoster:
+    """
+    Карта QR кодов учеников тренировки, закэшированная на время тренировки.
+
+    Для каждого ученика с активным абонементом на тренировку или уже
+    отмеченного на ней хранится абонемент, по которому его отметит
+    сканер, и признак отметки. Учеников, которых нет в карте, сканер
+    ищет в базе: у них нет подходящего абонемента.
+    """
+
+    def __init__(self, event: Event):
+        self.event = event
+        self.key = scanner_roster_key(event)
+
+        entries = cache.get(self.key)
+        if entries is None:
+            entries = self._build()
+            cache.set(self.key, entries, timeout=SCANNER_ROSTER_TIMEOUT)
+        self.entries: Dict[str, dict] = entries
+
+    def _build(self) -> Dict[str, dict]:
+        entries = {}
+        subscriptions = (
+            ClientSubscriptions.objects
+            .active_subscriptions_to_event(self.event)
+            .filter(client__deleted__isnull=True)
+            .select_related('client', 'subscription')
+            .order_by('purchase_date', 'id')
+        )
+        for sub in subscriptions:
+            # Как и при отметке по одному, используется самый старый
+            # из подходящих абонементов
+            entries.setdefault(str(sub.client.qr_code), {
+                'client_id': sub.client_id,
+                'client_name': sub.client.name,
+                'subscription_id': sub.id,
+                'subscription_name': str(sub),
+                'marked': False,
+            })
+
+        # У виртуальной тренировки еще не может быть посещений
+        if self.event.id is None:
+            return entries
+
+        attendances = (
+            self.event.attendance_set
+            .filter(marked=True)
+            .select_related('client')
+        )
+        for attendance in attendances:
+            entry = entries.setdefault(str(attendance.client.qr_code), {
+                'client_id': attendance.client_id,
+                'client_name': attendance.client.name,
+                'subscription_id': None,
+                'subscription_name': None,
+            })
+            entry['marked'] = True
+
+        return entries
+
+    def get(self, code: UUID) -> Optional[dict]:
+        return self.entries.get(str(code))
+
+    def mark(self, code: UUID):
+        """
+        Отметить ученика в карте после отметки посещения сканером, чтобы
+        не собирать карту заново при следующем сканировании.
+        """
+        self.entries[str(code)]['marked'] = True
+        cache.set(self.key, self.entries, timeout=SCANNER_ROSTER_TIMEOUT)
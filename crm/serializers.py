@@ -6,7 +6,9 @@ from django.conf.locale.ru.formats import DATE_INPUT_FORMATS
 from django.urls import reverse
 from rest_framework import serializers
 
-from crm.models import Event, ClientSubscriptions, SubscriptionsType
+from crm.models import (
+    ClientImport, ClientSubscriptions, Event, SubscriptionsType,
+)
 
 
 class CalendarEventSerializer(serializers.Serializer):
@@ -91,3 +93,38 @@ class SubscriptionRangeSerializer(serializers.Serializer):
             .end_date(self.context['requested_date'])
             .strftime('%d.%m.%Y')
         )
+
+
+class MarkVisitSerializer(serializers.Serializer):
+    client = serializers.IntegerField()
+    subscription = serializers.IntegerField()
+
+
+class MarkVisitsSerializer(serializers.Serializer):
+    visits = MarkVisitSerializer(many=True, allow_empty=False)
+
+    def validate_visits(self, visits):
+        client_ids = [visit['client'] for visit in visits]
+        if len(set(client_ids)) != len(client_ids):
+            raise serializers.ValidationError(
+                'Ученик не может быть отмечен дважды')
+        return visits
+
+
+class ScanSerializer(serializers.Serializer):
+    code = serializers.CharField()
+
+
+class ClientImportProgressSerializer(serializers.ModelSerializer):
+    status_display = serializers.CharField(source='get_status_display')
+
+    class Meta:
+        model = ClientImport
+        fields = [
+            'status',
+            'status_display',
+            'rows_processed',
+            'added',
+            'skipped',
+            'is_finished',
+        ]
@@ -2,17 +2,14 @@ from collections import Iterable
 from datetime import datetime, date
 
 import phonenumbers
-import vk
 from bootstrap4.components import render_alert
 from bootstrap4.forms import render_label
 from bootstrap4.renderers import FieldRenderer
 from bootstrap4.text import text_value
 from bootstrap4.utils import render_tag
 from django import template
-from django.conf import settings
 from django.contrib.messages.storage.base import Message
 from django.contrib.staticfiles.storage import staticfiles_storage
-from django.core.cache import cache
 from django.template import Node, NodeList, TemplateSyntaxError
 from django.utils.html import format_html, escape, strip_tags
 from django.utils.safestring import mark_safe
@@ -21,6 +18,7 @@ from transliterate.utils import _
 from contrib import text_utils
 
 from crm.auth.one_time_login import get_one_time_login_link
+from crm.vk_avatars import get_vk_avatars
 
 register = template.Library()
 
@@ -68,50 +66,17 @@ DJANGO_TO_BOOTSTRAP = {
 }
 
 
-@register.simple_tag
-def vk_small_avatar(vk_user_id):
-    cache_key = f'vk_photo_50_{vk_user_id}'
-    photo = cache.get(cache_key, None)
-    if photo:
-        return photo
-
-    session = vk.Session()
-    api = vk.API(session, v=5.90)
-
-    try:
-        photo = api.users.get(
-            access_token=settings.VK_GROUP_TOKEN,
-            user_ids=str(vk_user_id),
-            fields='photo_50'
-        )[0]['photo_50']
-    except (IndexError, KeyError):
-        photo = ''
-
-    cache.set(cache_key, photo, timeout=86400)  # Keep in cache one day
-
-    return photo
-
-
-def get_vk_user_ids(vk_user_domains):
-    session = vk.Session()
-    api = vk.API(session, v=5.90)
-    vk_user_ids = [None] * len(vk_user_domains)
-    domains = ",".join(vk_user_domains)
-
-    results = api.users.get(
-        access_token=settings.VK_GROUP_TOKEN,
-        user_ids=domains,
-        fields='domain, screen_name'
-    )
+@register.simple_tag(takes_context=True)
+def vk_small_avatar(context, vk_user_id):
+    if not vk_user_id:
+        return ''
 
-    for result in results:
-        user_id = 'id' + str(result['id'])
-        screen_name = result['screen_name']
-        for i, domain in enumerate(vk_user_domains):
-            if domain == user_id or domain == screen_name:
-                vk_user_ids[i] = result['id']
+    # Аватарки, собранные представлением для всей страницы
+    page_avatars = context.get('vk_avatars') or {}
+    if int(vk_user_id) in page_avatars:
+        return page_avatars[int(vk_user_id)]
 
-    return vk_user_ids
+    return get_vk_avatars([vk_user_id])[int(vk_user_id)]
 
 
 allowed_date_formats_ru = 'ГГГГ-ММ-ДД, ДД.ММ.ГГГГ, ДД/ММ/ГГГГ, ДД-ММ-ГГГГ'
@@ -0,0 +1,222 @@
+from datetime import date
+from io import BytesIO
+
+import openpyxl
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from hamcrest import (
+    assert_that, contains_inanyorder, has_entries, has_length,
+    has_properties, is_,
+)
+from pytest_mock import MockFixture
+
+from crm import models
+from crm.client_import import ClientImporter
+from crm.enums import IMPORT_STATUS
+
+pytestmark = pytest.mark.django_db
+
+
+def make_workbook(rows) -> bytes:
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    content = BytesIO()
+    workbook.save(content)
+    return content.getvalue()
+
+
+def make_import(rows, **kwargs) -> models.ClientImport:
+    params = dict(
+        file=make_workbook(rows),
+        ignore_first_row=True,
+        name_col='A',
+        phone_col='B',
+        birthday_col='C',
+        vk_col='D',
+        balance_col='E',
+    )
+    params.update(kwargs)
+    return models.ClientImport.objects.create(**params)
+
+
+def test_import_clients(vk_api, company_factory, client_factory):
+    company = company_factory()
+    client_factory(
+        company=company,
+        name='Петр',
+        phone_number='79990000002',
+        birthday=date(2001, 2, 2)
+    )
+    client_factory(company=company, name='Семен')
+    vk_api.add_user(1)
+    vk_api.add_user(2, screen_name='durov')
+
+    client_import = make_import([
+        ['ФИО', 'Телефон', 'Дата рождения', 'ВК', 'Баланс'],
+        ['Иван', '+7 (999) 000-00-01', '01.01.2000', 'vk.com/id1', '10,5'],
+        # Already existing client is skipped silently
+        ['Петр', '79990000002', '2001-02-02', None, None],
+        ['Семен', None, None, None, None],
+        [None, None, None, None, None],
+        ['Анна', None, 'завтра', None, None],
+        ['Мария', None, None, 'https://vk.com/durov', None],
+    ])
+
+    ClientImporter(client_import).run()
+
+    client_import.refresh_from_db()
+    assert_that(client_import, has_properties(
+        status=IMPORT_STATUS.DONE,
+        rows_processed=6,
+        added=2,
+        skipped=4,
+        file=is_(b''),
+    ))
+    assert_that(client_import.errors, has_entries({
+        'A4': 'Ученик с таким именем уже есть.',
+        'A5': 'Ошибка в имени или имя пустое.',
+        'C6': is_(str),
+    }))
+    assert_that(client_import.errors, has_length(3))
+
+    assert_that(
+        models.Client.objects.filter(name__in=['Иван', 'Мария']),
+        contains_inanyorder(
+            has_properties(
+                name='Иван',
+                phone_number='79990000001',
+                birthday=date(2000, 1, 1),
+                vk_user_id=1,
+                balance=10.5,
+            ),
+            has_properties(name='Мария', vk_user_id=2),
+        )
+    )
+    # VK users are resolved with one request per chunk
+    assert_that(vk_api.calls_of('users.get'), has_length(1))
+
+
+def test_import_clients_by_chunks(
+    vk_api, company_factory, mocker: MockFixture
+):
+    mocker.patch('crm.client_import.IMPORT_CHUNK_SIZE', 2)
+    company_factory()
+    for vk_user_id in range(1, 6):
+        vk_api.add_user(vk_user_id)
+
+    client_import = make_import(
+        [[f'Ученик {i}', None, None, f'vk.com/id{i}'] for i in range(1, 6)],
+        ignore_first_row=False,
+    )
+
+    ClientImporter(client_import).run()
+
+    client_import.refresh_from_db()
+    assert_that(client_import, has_properties(
+        status=IMPORT_STATUS.DONE,
+        rows_processed=5,
+        added=5,
+        skipped=0,
+    ))
+    assert_that(vk_api.calls_of('users.get'), has_length(3))
+    assert_that(
+        models.Client.objects.values_list('vk_user_id', flat=True),
+        contains_inanyorder(1, 2, 3, 4, 5)
+    )
+
+
+def test_failed_import_file_removed(
+    vk_api, company_factory, mocker: MockFixture
+):
+    company_factory()
+    mocker.patch(
+        'crm.client_import.resolve_vk_user_ids',
+        side_effect=RuntimeError('VK is down')
+    )
+    client_import = make_import([
+        ['ФИО', 'Телефон', 'Дата рождения', 'ВК'],
+        ['Иван', None, None, 'vk.com/id1'],
+    ])
+
+    with pytest.raises(RuntimeError):
+        ClientImporter(client_import).run()
+
+    client_import.refresh_from_db()
+    assert_that(client_import, has_properties(
+        status=IMPORT_STATUS.FAILED,
+        file=is_(b''),
+    ))
+
+
+def test_upload_excel(client, manager_factory, vk_api):
+    manager = manager_factory()
+    client.login(username=manager.user.username, password='defaultpassword')
+    content = make_workbook([
+        ['ФИО', 'Телефон'],
+        ['Иван', '79990000001'],
+    ])
+
+    response = client.post(reverse('crm:manager:client:excel'), {
+        'file': SimpleUploadedFile('clients.xlsx', content),
+        'ignore_first_row': True,
+        'name_col': 'A',
+        'phone_col': 'B',
+        'birthday_col': 'C',
+        'vk_col': 'D',
+        'balance_col': 'E',
+    })
+
+    client_import = models.ClientImport.objects.get()
+    # Import task is executed synchronously in tests
+    assert_that(response.status_code, is_(302))
+    assert_that(response.url, is_(client_import.get_absolute_url()))
+    assert_that(client_import, has_properties(
+        status=IMPORT_STATUS.DONE, added=1))
+    assert_that(
+        models.Client.objects.filter(name='Иван', phone_number='79990000001'),
+        has_length(1)
+    )
+
+    progress = client.get(
+        reverse('api-v1:manager:client:import', args=(client_import.id,)))
+    assert_that(progress.json(), has_entries(
+        status=IMPORT_STATUS.DONE,
+        rows_processed=1,
+        added=1,
+        skipped=0,
+        is_finished=True,
+    ))
+
+    report = client.get(client_import.get_absolute_url())
+    assert_that(report.status_code, is_(200))
+
+
+def test_upload_invalid_file(client, manager_factory):
+    manager = manager_factory()
+    client.login(username=manager.user.username, password='defaultpassword')
+
+    response = client.post(reverse('crm:manager:client:excel'), {
+        'file': SimpleUploadedFile('clients.xlsx', b'not excel'),
+        'name_col': 'A',
+        'phone_col': 'B',
+        'birthday_col': 'C',
+        'vk_col': 'D',
+        'balance_col': 'E',
+    })
+
+    assert_that(response.status_code, is_(200))
+    assert_that(models.ClientImport.objects.all(), has_length(0))
+
+
+def test_import_progress_for_manager_only(client, coach_factory):
+    coach = coach_factory()
+    client.login(username=coach.user.username, password='defaultpassword')
+    client_import = make_import([['Иван']], ignore_first_row=False)
+
+    progress = client.get(
+        reverse('api-v1:manager:client:import', args=(client_import.id,)))
+
+    assert_that(progress.status_code, is_(403))
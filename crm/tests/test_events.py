@@ -4,7 +4,9 @@ from typing import List
 import pytest
 from hamcrest import assert_that, is_, calling, raises
 
-from crm.events import next_day, get_nearest_to, days_delta
+from crm.events import (
+    count_days, days_delta, get_nearest_to, next_day, range_days,
+)
 
 
 @pytest.mark.parametrize('request_day_delta,days,expected_delta', [
@@ -219,3 +221,28 @@ def test_days_delta(input_days, expected):
 ])
 def test_next_day(start, stop, days, expected):
     assert_that(list(next_day(start, stop, days)), is_(expected))
+
+
+@pytest.mark.parametrize('start,stop,days', [
+    (date(2019, 2, 25), date(2019, 3, 3), [0, 1, 2, 3, 4, 5, 6]),
+    (date(2019, 2, 25), date(2019, 3, 24), [0]),
+    (date(2019, 2, 25), date(2019, 3, 24), [6]),
+    (date(2019, 2, 26), date(2019, 3, 10), [0, 1]),
+    (date(2019, 2, 27), date(2019, 5, 9), [1, 3, 5]),
+    (date(2019, 3, 1), date(2019, 3, 1), [4]),
+    (date(2019, 3, 1), date(2019, 3, 1), [3]),
+    (date(2019, 2, 25), date(2019, 3, 10), []),
+])
+def test_count_days(start, stop, days):
+    assert_that(
+        count_days(start, stop, days),
+        is_(len([
+            x for x in range_days(start, stop + timedelta(days=1))
+            if x.weekday() in days
+        ]))
+    )
+
+
+def test_count_days_reversed_period():
+    assert_that(
+        count_days(date(2019, 3, 10), date(2019, 2, 25), [0, 1]), is_(0))
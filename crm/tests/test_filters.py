@@ -0,0 +1,55 @@
+from datetime import date
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from hamcrest import assert_that, contains_inanyorder
+
+from crm import models
+from crm.enums import GRANULARITY
+from crm.filters import ClientFilter
+
+pytestmark = pytest.mark.django_db
+
+
+def test_client_filter_long_time_not_go(
+    company_factory,
+    client_factory,
+    client_subscription_factory
+):
+    company = company_factory()
+    long_ago = date.today() - relativedelta(months=3)
+
+    def sell(client, start_date, one_time=False):
+        return client_subscription_factory(
+            company=company,
+            client=client,
+            subscription__company=company,
+            subscription__one_time=one_time,
+            subscription__duration=1,
+            subscription__duration_type=GRANULARITY.MONTH,
+            subscription__rounding=False,
+            purchase_date=start_date,
+            start_date=start_date,
+        )
+
+    gone = client_factory(company=company)
+    sell(gone, long_ago)
+
+    returned = client_factory(company=company)
+    sell(returned, long_ago)
+    sell(returned, date.today())
+
+    # Разовые посещения не считаются последним абонементом
+    one_time = client_factory(company=company)
+    sell(one_time, long_ago)
+    sell(one_time, date.today(), one_time=True)
+
+    # Никогда не покупал абонементы
+    client_factory(company=company)
+
+    filterset = ClientFilter(
+        {'long_time_not_go': 'True'},
+        queryset=models.Client.objects.filter(company=company)
+    )
+
+    assert_that(filterset.qs, contains_inanyorder(gone, one_time))
@@ -1,12 +1,16 @@
 from datetime import date, datetime, timedelta
+from io import StringIO
 from typing import List
 
 import pytest
 import pytz
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from hamcrest import (
-    assert_that, calling, contains_inanyorder, has_properties, is_,
-    has_length, raises,
+    assert_that, calling, contains_inanyorder, contains_string,
+    has_properties, is_, is_not, has_length, raises,
 )
 from pytest_mock import MockFixture
 
@@ -567,7 +571,8 @@ def test_manager_extend_by_cancellation(
 ):
     event = event_factory(
         date=date(2019, 2, 25),
-        event_class__date_from=date(2019, 1, 1)
+        event_class__date_from=date(2019, 1, 1),
+        event_class__days=[0, 3]
     )
     subs = subscriptions_type_factory(
         company=event.company,
@@ -577,21 +582,98 @@ def test_manager_extend_by_cancellation(
         event_class__events=event.event_class
     )
 
-    client_subscription_factory.create_batch(
+    cs_list = client_subscription_factory.create_batch(
         3,
         company=event.company,
         subscription=subs,
         purchase_date=date(2019, 2, 25),
         start_date=date(2019, 2, 25)
     )
+    spy = mocker.spy(models.ClientSubscriptions, 'save')
 
-    mock = mocker.patch(
-        'crm.models.ClientSubscriptions.extend_by_cancellation')
+    models.ClientSubscriptions.objects.extend_by_cancellation(event)
+
+    spy.assert_not_called()
+    for cs in cs_list:
+        cs.refresh_from_db()
+        # Subscription ends at 24.03.2019 - sunday, next event is on monday
+        assert_that(cs.end_date, is_(date(2019, 3, 25)))
+        assert_that(
+            cs.extensionhistory_set.all(),
+            contains_inanyorder(has_properties(
+                related_event=event,
+                added_visits=0,
+                extended_from=date(2019, 3, 24),
+                extended_to=date(2019, 3, 25)
+            ))
+        )
+
+
+def test_manager_extend_by_cancellation_fixed_queries(
+    subscriptions_type_factory,
+    client_subscription_factory,
+    event_factory,
+    django_assert_num_queries
+):
+    event = event_factory(
+        date=date(2019, 2, 25),
+        event_class__date_from=date(2019, 1, 1)
+    )
+    subs = subscriptions_type_factory(
+        company=event.company,
+        duration=1,
+        duration_type=GRANULARITY.MONTH,
+        rounding=False,
+        event_class__events=event.event_class
+    )
+    client_subscription_factory.create_batch(
+        10,
+        company=event.company,
+        subscription=subs,
+        purchase_date=date(2019, 2, 25),
+        start_date=date(2019, 2, 25)
+    )
+
+    # Subscriptions, their later visits, schedule, update and insert,
+    # wrapped with savepoint
+    with django_assert_num_queries(7):
+        models.ClientSubscriptions.objects.extend_by_cancellation(event)
+
+    assert_that(
+        models.ExtensionHistory.objects.filter(related_event=event),
+        has_length(10)
+    )
+
+
+def test_manager_extend_by_cancellation_no_future_events(
+    subscriptions_type_factory,
+    client_subscription_factory,
+    event_factory,
+):
+    event = event_factory(
+        date=date(2019, 2, 25),
+        event_class__date_from=date(2019, 1, 1),
+        event_class__date_to=date(2019, 3, 1)
+    )
+    subs = subscriptions_type_factory(
+        company=event.company,
+        duration=1,
+        duration_type=GRANULARITY.MONTH,
+        rounding=False,
+        event_class__events=event.event_class
+    )
+    cs = client_subscription_factory(
+        company=event.company,
+        subscription=subs,
+        purchase_date=date(2019, 2, 25),
+        start_date=date(2019, 2, 25)
+    )
 
     models.ClientSubscriptions.objects.extend_by_cancellation(event)
+    cs.refresh_from_db()
 
-    assert_that(mock.call_count, is_(3))
-    mock.assert_any_call(event)
+    assert_that(cs.end_date, is_(date(2019, 3, 24)))
+    assert_that(cs.extensionhistory_set.all(), has_length(0))
 
 
 @pytest.mark.parametrize('visits_left, expected_len', [
@@ -728,7 +810,10 @@ def test_is_active_to_date(
     mocker.patch.object(
         cs, 'is_active_at_date_without_events', return_value=is_active_at_date)
     mocker.patch.object(
-        cs.subscription, 'events_to_date', return_value=events_to_date)
+        cs.subscription,
+        'events_count_to_date',
+        return_value=len(events_to_date)
+    )
 
     assert_that(cs.is_active_to_date(date(2019, 1, 1)), is_(expected))
 
@@ -758,7 +843,8 @@ def test_manager_revoke_extending(
         company=event.company,
         subscription=subs,
         purchase_date=date(2019, 2, 24),
-        start_date=date(2019, 2, 25)
+        start_date=date(2019, 2, 25),
+        end_date=date(2019, 2, 27)
     )
     for cs in cs_list:
         extension_history_factory(
@@ -770,13 +856,40 @@ def test_manager_revoke_extending(
             extended_to=date(2019, 2, 26),
             related_event=event
         )
-
-    mock = mocker.patch('crm.models.ClientSubscriptions.revoke_extending')
+    # Last subscription has one more extension after revoked one
+    chained = extension_history_factory(
+        company=event.company,
+        client_subscription=cs_list[-1],
+        added_visits=0,
+        date_extended=datetime(2019, 2, 25, 12, tzinfo=pytz.utc),
+        extended_from=date(2019, 2, 26),
+        extended_to=date(2019, 2, 27),
+    )
+    # Subscriptions end dates are changed in bulk, without save
+    for cs in cs_list:
+        cs.end_date = date(2019, 2, 27 if cs == cs_list[-1] else 26)
+        cs.save()
+    spy = mocker.spy(models.ClientSubscriptions, 'save')
 
     with freeze_time(date(2019, 2, 25)):
         models.ClientSubscriptions.objects.revoke_extending(event)
 
-    assert_that(mock.call_count, is_(3))
+    spy.assert_not_called()
+    for cs in cs_list:
+        cs.refresh_from_db()
+    assert_that(
+        [cs.end_date for cs in cs_list],
+        is_([date(2019, 2, 25), date(2019, 2, 25), date(2019, 2, 26)])
+    )
+    assert_that(
+        models.ExtensionHistory.objects.filter(related_event=event),
+        has_length(0)
+    )
+    chained.refresh_from_db()
+    assert_that(chained, has_properties(
+        extended_from=date(2019, 2, 25),
+        extended_to=date(2019, 2, 26)
+    ))
 
 
 def test_manager_revoke_extending_with_empty_extension_history(
@@ -798,12 +911,12 @@ def test_manager_revoke_extending_with_empty_extension_history(
         event_class__events=event.event_class
     )
 
-    mock = mocker.patch('crm.models.ClientSubscriptions.revoke_extending')
+    spy = mocker.spy(models, 'bulk_update')
 
     with freeze_time(date(2019, 2, 24)):
         models.ClientSubscriptions.objects.revoke_extending(event)
 
-    mock.assert_not_called()
+    spy.assert_not_called()
 
 
 def test_manager_revoke_extending_on_non_active_event(
@@ -844,12 +957,16 @@ def test_manager_revoke_extending_on_non_active_event(
             related_event=event
         )
 
-    mock = mocker.patch('crm.models.ClientSubscriptions.revoke_extending')
+    spy = mocker.spy(models, 'bulk_update')
 
     with freeze_time(date(2019, 2, 26)):
         models.ClientSubscriptions.objects.revoke_extending(event)
 
-    mock.assert_not_called()
+    spy.assert_not_called()
+    assert_that(
+        models.ExtensionHistory.objects.filter(related_event=event),
+        has_length(3)
+    )
 
 
 def test_manager_revoke_extending_non_canceled(
@@ -889,12 +1006,16 @@ def test_manager_revoke_extending_non_canceled(
             related_event=event
         )
 
-    mock = mocker.patch('crm.models.ClientSubscriptions.revoke_extending')
+    spy = mocker.spy(models, 'bulk_update')
 
     with freeze_time(date(2019, 2, 25)):
         models.ClientSubscriptions.objects.revoke_extending(event)
 
-    mock.assert_not_called()
+    spy.assert_not_called()
+    assert_that(
+        models.ExtensionHistory.objects.filter(related_event=event),
+        has_length(3)
+    )
 
 
 def test_manager_revoke_extending_event_without_extending(
@@ -935,12 +1056,16 @@ def test_manager_revoke_extending_event_without_extending(
             related_event=event
         )
 
-    mock = mocker.patch('crm.models.ClientSubscriptions.revoke_extending')
+    spy = mocker.spy(models, 'bulk_update')
 
     with freeze_time(date(2019, 2, 25)):
         models.ClientSubscriptions.objects.revoke_extending(event)
 
-    mock.assert_not_called()
+    spy.assert_not_called()
+    assert_that(
+        models.ExtensionHistory.objects.filter(related_event=event),
+        has_length(3)
+    )
 
 
 def test_revoke_extending_no_chain(
@@ -1212,3 +1337,363 @@ def test_revoke_extending_no_extension_history(
     cs.revoke_extending(event)
 
     spy.assert_not_called()
+
+
+@pytest.fixture
+def visited_subscription(
+    company_factory,
+    event_factory,
+    client_subscription_factory,
+    mocker: MockFixture
+):
+    mocker.patch('gcp.tasks.enqueue')
+    company = company_factory()
+    event = event_factory(
+        company=company,
+        date=date(2019, 2, 25),
+        event_class__date_from=date(2019, 1, 1)
+    )
+    subscription = client_subscription_factory(
+        company=company,
+        subscription__event_class__events=event.event_class,
+        subscription__duration=1,
+        subscription__duration_type=GRANULARITY.MONTH,
+        subscription__rounding=False,
+        start_date=date(2019, 2, 1),
+        visits_left=5,
+    )
+    subscription.mark_visit(event)
+    subscription.refresh_from_db()
+    return subscription, event
+
+
+def test_visits_counters_on_mark(visited_subscription):
+    subscription, event = visited_subscription
+
+    assert_that(subscription, has_properties(
+        visits_used=1,
+        last_visit_date=date(2019, 2, 25),
+        visits_left=4,
+    ))
+
+
+def test_visits_counters_on_cancel(visited_subscription):
+    subscription, event = visited_subscription
+
+    subscription.client.cancel_signup_for_event(event)
+    subscription.refresh_from_db()
+
+    assert_that(subscription, has_properties(
+        visits_used=0,
+        last_visit_date=None,
+        visits_left=5,
+    ))
+
+
+def test_visits_counters_on_subscription_change(
+    visited_subscription,
+    client_subscription_factory
+):
+    subscription, event = visited_subscription
+    other = client_subscription_factory(
+        company=subscription.company,
+        client=subscription.client,
+        subscription=subscription.subscription,
+        start_date=date(2019, 2, 1),
+    )
+
+    attendance = models.Attendance.objects.get(event=event)
+    attendance.mark_visit(other)
+    subscription.refresh_from_db()
+    other.refresh_from_db()
+
+    assert_that(subscription, has_properties(visits_used=0))
+    assert_that(other, has_properties(
+        visits_used=1, last_visit_date=date(2019, 2, 25)))
+
+
+@pytest.mark.parametrize('to_date, visits', [
+    (date(2019, 2, 24), 5),
+    (date(2019, 2, 25), 4),
+    (date(2019, 2, 26), 4),
+])
+def test_visits_to_date_with_counters(visited_subscription, to_date, visits):
+    subscription, event = visited_subscription
+
+    assert_that(subscription.visits_to_date(to_date), is_(visits))
+
+
+def test_active_subscriptions_to_date_without_join():
+    query = str(
+        models.ClientSubscriptions.objects
+        .active_subscriptions_to_date(date(2019, 2, 25)).query
+    )
+
+    # Attendance history is neither joined to subscriptions nor counted
+    # in subquery, visits after the date are counted in advance
+    assert_that(query, is_not(contains_string('"crm_attendance"')))
+
+
+@pytest.mark.parametrize('to_date, active', [
+    (date(2019, 2, 25), True),
+    (date(2019, 2, 26), False),
+])
+def test_active_subscriptions_to_date_with_later_visits(
+    visited_subscription,
+    to_date,
+    active
+):
+    subscription, event = visited_subscription
+    models.ClientSubscriptions.objects.filter(id=subscription.id).update(
+        visits_on_by_time=1, visits_left=0)
+
+    assert_that(
+        models.ClientSubscriptions.objects
+        .active_subscriptions_to_date(to_date)
+        .filter(id=subscription.id)
+        .exists(),
+        is_(active)
+    )
+
+
+def test_visits_counters_on_bulk_changes(
+    visited_subscription,
+    client_subscription_factory,
+    event_factory
+):
+    subscription, event = visited_subscription
+    other = client_subscription_factory(
+        company=subscription.company,
+        client=subscription.client,
+        subscription=subscription.subscription,
+        start_date=date(2019, 2, 1),
+    )
+    next_event = event_factory(
+        company=event.company,
+        event_class=event.event_class,
+        date=date(2019, 2, 26)
+    )
+
+    models.Attendance.objects.bulk_create([models.Attendance(
+        company=event.company,
+        client=subscription.client,
+        event=next_event,
+        subscription=other,
+    )])
+    other.refresh_from_db()
+    assert_that(other, has_properties(
+        visits_used=1, last_visit_date=date(2019, 2, 26)))
+
+    models.Attendance.objects.filter(event=event).update(subscription=other)
+    subscription.refresh_from_db()
+    other.refresh_from_db()
+    assert_that(subscription, has_properties(
+        visits_used=0, last_visit_date=None))
+    assert_that(other, has_properties(
+        visits_used=2, last_visit_date=date(2019, 2, 26)))
+
+    models.Attendance.objects.filter(event=next_event).delete()
+    other.refresh_from_db()
+    assert_that(other, has_properties(
+        visits_used=1, last_visit_date=date(2019, 2, 25)))
+
+
+def test_visits_counters_on_event_date_change(visited_subscription):
+    subscription, event = visited_subscription
+
+    event.date = date(2019, 2, 27)
+    event.save()
+    subscription.refresh_from_db()
+
+    assert_that(subscription, has_properties(
+        visits_used=1, last_visit_date=date(2019, 2, 27)))
+
+
+def test_check_visits_counters_command(visited_subscription):
+    subscription, event = visited_subscription
+    models.ClientSubscriptions.objects.filter(id=subscription.id).update(
+        visits_used=0, last_visit_date=None)
+
+    out = StringIO()
+    call_command('check_visits_counters', stdout=out)
+    subscription.refresh_from_db()
+
+    assert_that(out.getvalue(), contains_string(f'Абонемент {subscription.id}'))
+    assert_that(subscription, has_properties(visits_used=0))
+
+    call_command('check_visits_counters', rebuild=True, stdout=StringIO())
+    subscription.refresh_from_db()
+
+    assert_that(subscription, has_properties(
+        visits_used=1, last_visit_date=date(2019, 2, 25)))
+
+
+def test_mark_visit_returns_visits_left(
+    visited_subscription,
+    event_factory
+):
+    subscription, event = visited_subscription
+    next_event = event_factory(
+        company=event.company,
+        event_class=event.event_class,
+        date=event.date + timedelta(days=1)
+    )
+
+    assert_that(subscription.mark_visit(next_event), is_(3))
+    assert_that(subscription.visits_left, is_(3))
+    assert_that(subscription.restore_visit(), is_(4))
+
+
+def test_subscription_locked_once(visited_subscription, event_factory):
+    subscription, event = visited_subscription
+    next_event = event_factory(
+        company=event.company,
+        event_class=event.event_class,
+        date=event.date + timedelta(days=1)
+    )
+
+    def subscription_locks(queries):
+        return [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('SELECT "crm_clientsubscriptions"')
+            and query['sql'].endswith('FOR UPDATE')
+        ]
+
+    with CaptureQueriesContext(connection) as mark_queries:
+        subscription.mark_visit(next_event)
+    with CaptureQueriesContext(connection) as cancel_queries:
+        subscription.client.cancel_signup_for_event(next_event)
+    subscription.refresh_from_db()
+
+    assert_that(subscription_locks(mark_queries), has_length(1))
+    assert_that(subscription_locks(cancel_queries), has_length(1))
+    assert_that(subscription, has_properties(visits_left=4, visits_used=1))
+
+
+def test_restore_visit_once(visited_subscription):
+    subscription, event = visited_subscription
+    attendance = models.Attendance.objects.get(event=event)
+    same_attendance = models.Attendance.objects.get(event=event)
+
+    attendance.restore_visit()
+    same_attendance.restore_visit()
+    subscription.refresh_from_db()
+
+    assert_that(subscription, has_properties(visits_left=5))
+
+
+@pytest.fixture
+def group_subscriptions(
+    company_factory,
+    event_factory,
+    client_subscription_factory,
+    subscriptions_type_factory,
+):
+    company = company_factory()
+    event = event_factory(
+        company=company,
+        date=date(2019, 2, 25),
+        event_class__date_from=date(2019, 1, 1)
+    )
+    subscription_type = subscriptions_type_factory(
+        company=company,
+        event_class__events=event.event_class,
+        duration=1,
+        duration_type=GRANULARITY.MONTH,
+        rounding=False,
+        one_time=False,
+    )
+    subscriptions = client_subscription_factory.create_batch(
+        5,
+        company=company,
+        subscription=subscription_type,
+        start_date=date(2019, 2, 1),
+        visits_left=5,
+    )
+    return event, subscriptions
+
+
+def test_manager_mark_visits(
+    group_subscriptions,
+    mocker: MockFixture,
+    django_assert_num_queries
+):
+    enqueue = mocker.patch('gcp.tasks.enqueue')
+    event, subscriptions = group_subscriptions
+    signed_up = subscriptions[0].client
+    signed_up.signup_for_event(event)
+    visits = {sub.client_id: sub.id for sub in subscriptions}
+
+    # Lock, attendances, insert, update of attendances with counters of
+    # their subscriptions and update of subscriptions, plus savepoint and
+    # its release
+    with django_assert_num_queries(10):
+        marked = models.ClientSubscriptions.objects.mark_visits(
+            event, visits)
+
+    assert_that(marked, has_length(5))
+    assert_that(
+        models.Attendance.objects.filter(event=event, marked=True),
+        has_length(5)
+    )
+    for subscription in subscriptions:
+        subscription.refresh_from_db()
+        assert_that(subscription, has_properties(
+            visits_left=4,
+            visits_used=1,
+            last_visit_date=date(2019, 2, 25),
+        ))
+    enqueue.assert_called_once_with(
+        'notify_client_subscription_visits', sorted(visits.values()))
+
+
+def test_manager_mark_visits_virtual_event(
+    group_subscriptions,
+    mocker: MockFixture
+):
+    mocker.patch('gcp.tasks.enqueue')
+    event, subscriptions = group_subscriptions
+    virtual_event = event.event_class.get_calendar(
+        date(2019, 2, 26), date(2019, 2, 26))[date(2019, 2, 26)]
+    subscription = subscriptions[0]
+
+    models.ClientSubscriptions.objects.mark_visits(
+        virtual_event, {subscription.client_id: subscription.id})
+
+    assert_that(virtual_event.id, is_not(None))
+    assert_that(
+        models.Attendance.objects.filter(event=virtual_event, marked=True),
+        has_length(1)
+    )
+
+
+def test_manager_mark_visits_invalid(
+    group_subscriptions,
+    client_factory,
+    mocker: MockFixture
+):
+    enqueue = mocker.patch('gcp.tasks.enqueue')
+    event, subscriptions = group_subscriptions
+    marked, ended, valid = subscriptions[:3]
+    marked.mark_visit(event)
+    models.ClientSubscriptions.objects.filter(id=ended.id).update(
+        visits_left=0)
+    stranger = client_factory(company=event.company)
+    enqueue.reset_mock()
+
+    assert_that(
+        calling(models.ClientSubscriptions.objects.mark_visits).with_args(
+            event,
+            {
+                marked.client_id: marked.id,
+                ended.client_id: ended.id,
+                stranger.id: valid.id,
+                valid.client_id: valid.id,
+            }
+        ),
+        raises(models.InvalidVisits)
+    )
+
+    valid.refresh_from_db()
+    assert_that(valid, has_properties(visits_left=5, visits_used=0))
+    enqueue.assert_not_called()
@@ -1,10 +1,22 @@
-from datetime import date
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from io import StringIO
 
 import pytest
+from django.core.management import call_command
+from django.db import connection
+from django_multitenant.utils import set_current_tenant
 from freezegun import freeze_time
-from hamcrest import (assert_that, calling, has_properties, none, raises)
+from hamcrest import (
+    assert_that, calling, contains, has_properties, is_, none, not_none,
+    only_contains, raises,
+)
 from pytest_mock import MockFixture
 
+from crm import models
+from crm.enums import GRANULARITY
+
 pytestmark = pytest.mark.django_db
 
 
@@ -15,7 +27,7 @@ def test_cancel_with_extending(
     event = event_factory()
     mock = mocker.patch(
         'crm.models.ClientSubscriptionsManager.extend_by_cancellation')
-    mock_google_tasks = mocker.patch('gcp.tasks.enqueue')
+    mock_google_tasks = mocker.patch('gcp.tasks.enqueue_many')
     with freeze_time('2019-02-25'):
         event.cancel_event(extend_subscriptions=True)
 
@@ -26,7 +38,7 @@ def test_cancel_with_extending(
         canceled_with_extending=True
     ))
     mock.assert_called_once_with(event)
-    mock_google_tasks.assert_called_once_with('notify_event_cancellation', event.id)
+    mock_google_tasks.assert_called_once_with('notify_event_cancellation', [])
 
 
 def test_cancel_without_extending(
@@ -36,7 +48,7 @@ def test_cancel_without_extending(
     event = event_factory()
     mock = mocker.patch(
         'crm.models.ClientSubscriptionsManager.extend_by_cancellation')
-    mock_google_tasks = mocker.patch('gcp.tasks.enqueue')
+    mock_google_tasks = mocker.patch('gcp.tasks.enqueue_many')
     with freeze_time('2019-02-25'):
         event.cancel_event(extend_subscriptions=False)
 
@@ -47,7 +59,34 @@ def test_cancel_without_extending(
         canceled_with_extending=False
     ))
     mock.assert_not_called()
-    mock_google_tasks.assert_called_once_with('notify_event_cancellation', event.id)
+    mock_google_tasks.assert_called_once_with('notify_event_cancellation', [])
+
+
+def test_cancel_notifications_by_chunks(
+    event_factory,
+    client_subscription_factory,
+    mocker: MockFixture
+):
+    event = event_factory()
+    subscriptions = client_subscription_factory.create_batch(
+        3,
+        company=event.company,
+        subscription__event_class__events=event.event_class,
+        subscription__duration=1,
+        subscription__duration_type=GRANULARITY.YEAR,
+        subscription__rounding=False,
+        start_date=event.date,
+    )
+    mocker.patch('crm.models.CANCELLATION_NOTIFY_CHUNK', 2)
+    mock_google_tasks = mocker.patch('gcp.tasks.enqueue_many')
+
+    event.cancel_event()
+
+    client_ids = sorted(x.client_id for x in subscriptions)
+    mock_google_tasks.assert_called_once_with('notify_event_cancellation', [
+        (event.id, client_ids[:2]),
+        (event.id, client_ids[2:]),
+    ])
 
 
 def test_cancel_outdated(event_factory):
@@ -145,3 +184,174 @@ def test_activate_with_revoke_extension(
         canceled_with_extending=False
     ))
     mock.assert_called_once_with(event)
+
+
+def test_mark_visit_saves_virtual_event(
+    event_class_factory,
+    client_subscription_factory,
+    mocker: MockFixture
+):
+    mocker.patch('gcp.tasks.enqueue')
+    event_class = event_class_factory()
+    event = models.Event.objects.get_or_virtual(
+        event_class.id, event_class.date_from)
+    subscription = client_subscription_factory(
+        company=event_class.company,
+        subscription__event_class__events=event_class,
+        start_date=event_class.date_from,
+    )
+
+    subscription.mark_visit(event)
+
+    assert_that(event.id, not_none())
+    assert_that(
+        event.attendance_set.all(),
+        contains(has_properties(subscription=subscription, marked=True))
+    )
+
+
+def test_untouched_events(
+    event_factory,
+    client_factory,
+    extension_history_factory
+):
+    untouched = event_factory()
+    company = untouched.company
+    event_class = untouched.event_class
+
+    def at(days):
+        return event_factory(
+            company=company,
+            event_class=event_class,
+            date=event_class.date_from + timedelta(days=days)
+        )
+
+    at(1).cancel_event()
+    closed = at(2)
+    closed.is_closed = True
+    closed.save()
+    client_factory(company=company).signup_for_event(at(3))
+    extension_history_factory(company=company, related_event=at(4))
+
+    assert_that(models.Event.objects.untouched(), contains(untouched))
+
+
+def test_delete_untouched_events_command(event_factory, client_factory):
+    untouched = event_factory()
+    touched = event_factory(
+        company=untouched.company,
+        event_class=untouched.event_class,
+        date=untouched.date + timedelta(days=1)
+    )
+    client_factory(company=untouched.company).signup_for_event(touched)
+
+    call_command('delete_untouched_events', batch_size=1, stdout=StringIO())
+
+    assert_that(models.Event.objects.all(), contains(touched))
+
+
+@pytest.fixture
+def report_event(event_factory, client_subscription_factory):
+    event = event_factory()
+
+    for one_time, price in ((True, 100), (False, 1000), (False, 1500)):
+        sub = client_subscription_factory(
+            company=event.company,
+            subscription__one_time=one_time,
+            event=event,
+            price=price,
+        )
+        models.Attendance.objects.create(
+            company=event.company,
+            event=event,
+            client=sub.client,
+            subscription=sub,
+            marked=one_time,
+            signed_up=not one_time,
+        )
+
+    return event
+
+
+def test_with_report_stats(report_event):
+    event = models.Event.objects.with_report_stats().get(id=report_event.id)
+
+    assert_that(event, has_properties(
+        present_clients_count=report_event.get_present_clients_count(),
+        one_time_sub_clients_count=(
+            report_event.get_clients_count_one_time_sub()),
+        subs_sales_count=report_event.get_subs_sales(),
+        profit=report_event.get_profit(),
+    ))
+    assert_that(event, has_properties(
+        present_clients_count=1,
+        one_time_sub_clients_count=1,
+        subs_sales_count=2,
+        profit=2600,
+    ))
+
+
+def test_with_report_stats_fixed_queries(
+    company_factory,
+    event_factory,
+    django_assert_num_queries
+):
+    event_factory.create_batch(5, company=company_factory())
+
+    with django_assert_num_queries(1):
+        for event in models.Event.objects.with_report_stats():
+            assert_that(event.get_present_clients_count(), is_(0))
+            assert_that(event.get_clients_count_one_time_sub(), is_(0))
+            assert_that(event.get_subs_sales(), is_(0))
+            assert_that(event.get_profit(), is_(0))
+            assert_that(event.event_class.coach.user.username, not_none())
+
+
+@pytest.mark.django_db(transaction=True)
+def test_virtual_event_marked_in_parallel(
+    event_class_factory,
+    client_subscription_factory,
+    mocker: MockFixture
+):
+    mocker.patch('gcp.tasks.enqueue_coalesced')
+    event_class = event_class_factory(date_from=date.today())
+    company = event_class.company
+    subscriptions = [
+        client_subscription_factory(
+            company=company,
+            subscription__event_class__events=event_class,
+            subscription__duration=1,
+            subscription__duration_type=GRANULARITY.MONTH,
+            subscription__rounding=False,
+            start_date=date.today(),
+            visits_left=5,
+        )
+        for _ in range(2)
+    ]
+    # Both marks save the same virtual event at the same time
+    barrier = threading.Barrier(len(subscriptions))
+    save_virtual = models.Event.save_virtual
+
+    def wait_and_save_virtual(event):
+        barrier.wait(timeout=5)
+        save_virtual(event)
+
+    mocker.patch.object(models.Event, 'save_virtual', wait_and_save_virtual)
+
+    def mark(subscription):
+        set_current_tenant(company)
+        try:
+            event = models.Event(event_class=event_class, date=date.today())
+            return subscription.mark_visit(event)
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=len(subscriptions)) as executor:
+        visits_left = list(executor.map(mark, subscriptions))
+
+    assert_that(visits_left, contains(4, 4))
+    assert_that(
+        models.Attendance.objects.filter(marked=True),
+        only_contains(has_properties(
+            event_id=models.Event.objects.get(event_class=event_class).id))
+    )
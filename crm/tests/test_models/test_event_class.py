@@ -120,3 +120,54 @@ def test_get_calendar_all_events_exists(
 
     ec.get_calendar(start, date(2019, 1, 10))
     assert_that(spy.call_count, is_(0))
+
+
+def test_queryset_calendar_same_as_single(
+    company_factory,
+    event_class_factory,
+    event_factory,
+):
+    start = date(2019, 1, 1)
+    end = date(2019, 1, 31)
+    company = company_factory()
+    ecs = [
+        event_class_factory(company=company, date_from=start, days=[0, 2, 4]),
+        event_class_factory(
+            company=company, date_from=date(2019, 1, 10), days=[1]),
+        event_class_factory(
+            company=company, date_from=None, date_to=date(2019, 1, 20),
+            days=[5, 6]),
+    ]
+    event_factory(company=company, event_class=ecs[0], date=date(2019, 1, 2))
+
+    expected = sorted(
+        (e.event_class_id, e.date, e.id, e.start_time)
+        for ec in ecs
+        for e in ec.get_calendar(start, end).values()
+    )
+
+    assert_that(
+        sorted(
+            (e.event_class_id, e.date, e.id, e.start_time)
+            for e in models.EventClass.objects.get_calendar(start, end)
+        ),
+        is_(expected)
+    )
+
+
+def test_queryset_calendar_fixed_queries(
+    company_factory,
+    event_class_factory,
+    django_assert_num_queries
+):
+    start = date(2019, 1, 1)
+    company = company_factory()
+    event_class_factory.create_batch(5, company=company, date_from=start)
+
+    with django_assert_num_queries(3):
+        calendar = models.EventClass.objects.get_calendar(
+            start, date(2019, 1, 31))
+        for event in calendar:
+            assert_that(event.event_class_name, is_(event.event_class.name))
+
+    assert_that(calendar, has_length(5 * 31))
@@ -274,3 +274,140 @@ def test_events_to_date_all(
     # 2 canceled events
 
     assert_that(cs_events, has_length(14))
+
+
+@pytest.mark.parametrize('filter_runner', [
+    SubscriptionsTypeEventFilter.ACTIVE,
+    SubscriptionsTypeEventFilter.CANCELED,
+    SubscriptionsTypeEventFilter.ALL,
+])
+def test_events_count_to_date(
+    filter_runner,
+    event_class_factory,
+    event_factory,
+    company_factory,
+    subscriptions_type_factory,
+):
+    start_date = date(2019, 1, 1)
+    company = company_factory()
+    ecs: List[models.EventClass] = [
+        event_class_factory(
+            company=company,
+            date_from=start_date,
+            date_to=date(2019, 1, 20),
+            days=[0, 2, 4]
+        ),
+        event_class_factory(
+            company=company,
+            date_from=date(2019, 1, 10),
+            days=[1, 6]
+        ),
+    ]
+    cs: models.SubscriptionsType = subscriptions_type_factory(
+        company=company,
+        event_class__events=ecs,
+    )
+    event_factory(
+        company=company,
+        event_class=ecs[0],
+        date=date(2019, 1, 2),
+        canceled_at=date(2019, 1, 1)
+    )
+    event_factory(
+        company=company,
+        event_class=ecs[1],
+        date=date(2019, 1, 13),
+        canceled_at=date(2019, 1, 1)
+    )
+    event_factory(company=company, event_class=ecs[1], date=date(2019, 1, 15))
+
+    for to_date in (date(2019, 1, 1), date(2019, 1, 14), date(2019, 2, 28)):
+        assert_that(
+            cs.events_count_to_date(
+                from_date=start_date,
+                to_date=to_date,
+                filter_runner=filter_runner
+            ),
+            is_(len(cs.events_to_date(
+                from_date=start_date,
+                to_date=to_date,
+                filter_runner=filter_runner
+            )))
+        )
+
+
+def test_events_count_to_date_fixed_queries(
+    event_class_factory,
+    company_factory,
+    subscriptions_type_factory,
+    django_assert_num_queries,
+):
+    company = company_factory()
+    cs: models.SubscriptionsType = subscriptions_type_factory(
+        company=company,
+        event_class__events=event_class_factory.create_batch(
+            5, company=company),
+    )
+
+    with django_assert_num_queries(2):
+        count = cs.events_count_to_date(
+            to_date=date.today() + timedelta(days=365))
+
+    assert_that(count, is_(5 * 366))
+
+
+@pytest.mark.parametrize('filter_runner', [
+    SubscriptionsTypeEventFilter.ACTIVE,
+    SubscriptionsTypeEventFilter.CANCELED,
+    SubscriptionsTypeEventFilter.ALL,
+])
+def test_events_count_to_date_off_schedule(
+    filter_runner,
+    event_class_factory,
+    event_factory,
+    company_factory,
+    subscriptions_type_factory,
+):
+    start_date = date(2019, 1, 1)
+    company = company_factory()
+    # Event class on mondays and event class without schedule
+    ecs: List[models.EventClass] = [
+        event_class_factory(company=company, date_from=start_date, days=[0]),
+        event_class_factory(company=company, date_from=start_date, days=[]),
+    ]
+    cs: models.SubscriptionsType = subscriptions_type_factory(
+        company=company,
+        event_class__events=ecs,
+    )
+    # Tuesday
+    event_factory(company=company, event_class=ecs[0], date=date(2019, 1, 8))
+    event_factory(
+        company=company,
+        event_class=ecs[0],
+        date=date(2019, 1, 9),
+        canceled_at=date(2019, 1, 1)
+    )
+    event_factory(company=company, event_class=ecs[1], date=date(2019, 1, 3))
+    event_factory(
+        company=company,
+        event_class=ecs[1],
+        date=date(2019, 1, 4),
+        canceled_at=date(2019, 1, 1)
+    )
+
+    count = cs.events_count_to_date(
+        from_date=start_date,
+        to_date=date(2019, 1, 31),
+        filter_runner=filter_runner
+    )
+
+    assert_that(count, is_(len(cs.events_to_date(
+        from_date=start_date,
+        to_date=date(2019, 1, 31),
+        filter_runner=filter_runner
+    ))))
+    assert_that(count, is_({
+        SubscriptionsTypeEventFilter.ACTIVE: 6,
+        SubscriptionsTypeEventFilter.CANCELED: 2,
+        SubscriptionsTypeEventFilter.ALL: 8,
+    }[filter_runner]))
@@ -0,0 +1,135 @@
+from datetime import date
+
+import pytest
+from hamcrest import (
+    assert_that, contains, contains_inanyorder, empty, has_properties, is_,
+    none,
+)
+
+from crm.enums import GRANULARITY
+from crm.models import Attendance
+from crm.roster import EventRoster
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def event(event_factory):
+    return event_factory(
+        event_class__date_from=date.today(),
+        event_class__days=[0, 1, 2, 3, 4, 5, 6],
+    )
+
+
+@pytest.fixture
+def sell(client_subscription_factory, subscriptions_type_factory, event):
+    subscription_type = subscriptions_type_factory(
+        company=event.company,
+        event_class__events=event.event_class,
+        duration_type=GRANULARITY.MONTH,
+        duration=1,
+        rounding=False,
+        one_time=False,
+    )
+
+    def _sell(client):
+        return client_subscription_factory(
+            company=event.company,
+            client=client,
+            subscription=subscription_type,
+            purchase_date=date.today(),
+            start_date=date.today(),
+            visits_left=5,
+        )
+
+    return _sell
+
+
+def attend(event, client, subscription=None, marked=False, signed_up=False):
+    return Attendance.objects.create(
+        company=event.company,
+        event=event,
+        client=client,
+        subscription=subscription,
+        marked=marked,
+        signed_up=signed_up,
+    )
+
+
+def test_roster_groups(event, sell, client_factory):
+    signed_up = client_factory(company=event.company)
+    signed_up_sub = sell(signed_up)
+    attend(event, signed_up, signed_up=True)
+
+    unmarked = client_factory(company=event.company)
+    unmarked_sub = sell(unmarked)
+
+    marked = client_factory(company=event.company)
+    marked_sub = sell(marked)
+    attend(event, marked, marked_sub, marked=True)
+
+    # Не участвует в тренировке
+    client_factory(company=event.company)
+
+    roster = EventRoster(event)
+
+    assert_that(roster.signed_up, contains(has_properties(
+        client=signed_up,
+        subscriptions=contains(signed_up_sub),
+        last_sub=signed_up_sub,
+        attendance=none(),
+    )))
+    assert_that(roster.unmarked, contains(has_properties(
+        client=unmarked,
+        subscriptions=contains(unmarked_sub),
+        last_sub=unmarked_sub,
+    )))
+    assert_that(roster.marked, contains(has_properties(
+        client=marked,
+        subscriptions=contains(marked_sub),
+        last_sub=marked_sub,
+        attendance=has_properties(marked=True),
+    )))
+    assert_that(
+        roster.client_ids,
+        contains_inanyorder(signed_up.id, unmarked.id, marked.id)
+    )
+    assert_that(marked_sub.last_visited_event(), is_(event))
+    assert_that(unmarked_sub.last_visited_event(), none())
+
+
+def test_roster_virtual_event(event_class_factory):
+    event_class = event_class_factory()
+    event = event_class.get_calendar(
+        event_class.date_from, event_class.date_from)[event_class.date_from]
+
+    roster = EventRoster(event)
+
+    assert_that(roster.signed_up, empty())
+    assert_that(roster.unmarked, empty())
+    assert_that(roster.marked, empty())
+
+
+def test_roster_fixed_queries(
+    event,
+    sell,
+    client_factory,
+    django_assert_num_queries
+):
+    for _ in range(5):
+        client = client_factory(company=event.company)
+        sell(client)
+        attend(event, client, signed_up=True)
+
+        sell(client_factory(company=event.company))
+
+        client = client_factory(company=event.company)
+        attend(event, client, sell(client), marked=True)
+
+    # Later visits of subscriptions are counted with separate query
+    with django_assert_num_queries(5):
+        roster = EventRoster(event)
+        for entry in roster.signed_up + roster.unmarked + roster.marked:
+            assert_that(entry.last_sub.subscription.name)
+            for sub in entry.subscriptions:
+                sub.last_visited_event()
@@ -0,0 +1,137 @@
+from datetime import date, timedelta
+
+import pytest
+from hamcrest import assert_that, has_entries, has_key, is_, is_not, none
+from pytest_mock import MockFixture
+
+from crm.enums import GRANULARITY
+from crm.models import Attendance
+from crm.scanner import ScannerRoster
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def event(event_factory, mocker: MockFixture):
+    mocker.patch('gcp.tasks.enqueue')
+    return event_factory(
+        event_class__date_from=date.today(),
+        event_class__days=[0, 1, 2, 3, 4, 5, 6],
+    )
+
+
+@pytest.fixture
+def sell(client_subscription_factory, subscriptions_type_factory, event):
+    subscription_type = subscriptions_type_factory(
+        company=event.company,
+        event_class__events=event.event_class,
+        duration_type=GRANULARITY.MONTH,
+        duration=1,
+        rounding=False,
+        one_time=False,
+    )
+
+    def _sell(client):
+        return client_subscription_factory(
+            company=event.company,
+            client=client,
+            subscription=subscription_type,
+            purchase_date=date.today(),
+            start_date=date.today(),
+            visits_left=5,
+        )
+
+    return _sell
+
+
+def test_scanner_roster(event, sell, client_factory):
+    client = client_factory(company=event.company)
+    subscription = sell(client)
+    marked = client_factory(company=event.company)
+    Attendance.objects.create(
+        company=event.company, event=event, client=marked, marked=True)
+    # Нет абонемента на тренировку
+    other = client_factory(company=event.company)
+
+    roster = ScannerRoster(event)
+
+    assert_that(roster.get(client.qr_code), has_entries(
+        client_id=client.id,
+        subscription_id=subscription.id,
+        marked=False,
+    ))
+    assert_that(roster.get(marked.qr_code), has_entries(
+        client_id=marked.id,
+        marked=True,
+    ))
+    assert_that(roster.get(other.qr_code), none())
+
+
+def test_scanner_roster_cached(
+    event,
+    sell,
+    client_factory,
+    django_assert_num_queries
+):
+    client = client_factory(company=event.company)
+    sell(client)
+    ScannerRoster(event)
+
+    with django_assert_num_queries(0):
+        roster = ScannerRoster(event)
+
+    assert_that(roster.entries, has_key(str(client.qr_code)))
+
+
+def test_scanner_roster_invalidated_by_sale(event, sell, client_factory):
+    client = client_factory(company=event.company)
+    ScannerRoster(event)
+
+    sell(client)
+
+    assert_that(ScannerRoster(event).get(client.qr_code), is_not(none()))
+
+
+def test_scanner_roster_invalidated_by_mark_and_cancel(
+    event,
+    sell,
+    client_factory
+):
+    client = client_factory(company=event.company)
+    subscription = sell(client)
+    ScannerRoster(event)
+
+    subscription.mark_visit(event)
+
+    assert_that(ScannerRoster(event).get(client.qr_code)['marked'], is_(True))
+
+    client.cancel_signup_for_event(event)
+
+    assert_that(
+        ScannerRoster(event).get(client.qr_code)['marked'], is_(False))
+
+
+def test_scanner_roster_invalidated_by_extension(
+    event,
+    event_factory,
+    sell,
+    client_factory
+):
+    client = client_factory(company=event.company)
+    subscription = sell(client)
+    subscription.end_date = event.date
+    subscription.save()
+    next_event = event_factory(
+        company=event.company,
+        event_class=event.event_class,
+        date=event.date + timedelta(days=1)
+    )
+    # Абонемент закончился до следующей тренировки
+    assert_that(ScannerRoster(next_event).get(client.qr_code), none())
+
+    event.cancel_event(extend_subscriptions=True)
+
+    assert_that(ScannerRoster(next_event).get(client.qr_code), has_entries(
+        subscription_id=subscription.id,
+        marked=False,
+    ))
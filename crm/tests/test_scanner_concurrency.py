@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import pytest
+from django.db import connection
+from django.test import Client as HttpClient
+from django.urls import reverse
+from hamcrest import assert_that, has_length, has_properties
+from pytest_mock import MockFixture
+
+from crm import models
+from crm.enums import GRANULARITY
+
+# Threads work with their own database connections, so data must be
+# committed, not kept in test transaction
+pytestmark = pytest.mark.django_db(transaction=True)
+
+THREADS = 8
+SCANS_PER_CLIENT = 8
+
+
+def test_parallel_scans(
+    manager_factory,
+    event_factory,
+    client_factory,
+    client_subscription_factory,
+    mocker: MockFixture
+):
+    enqueue_coalesced = mocker.patch('gcp.tasks.enqueue_coalesced')
+    manager = manager_factory()
+    company = manager.company
+    event = event_factory(company=company, event_class__date_from=date.today())
+    next_event = event_factory(
+        company=company,
+        event_class=event.event_class,
+        date=event.date + timedelta(days=1)
+    )
+    # Event is saved by first mark, which several scans may do at once
+    virtual_date = event.date + timedelta(days=2)
+    event_dates = [event.date, next_event.date, virtual_date]
+
+    subscriptions = [
+        client_subscription_factory(
+            company=company,
+            client=client_factory(company=company),
+            subscription__event_class__events=event.event_class,
+            subscription__duration=1,
+            subscription__duration_type=GRANULARITY.MONTH,
+            subscription__rounding=False,
+            start_date=event.date,
+            visits_left=5,
+        )
+        for _ in range(4)
+    ]
+    # Signed up clients already have not marked attendance
+    for subscription in subscriptions:
+        subscription.client.signup_for_event(event)
+
+    urls = [
+        reverse(
+            'crm:manager:event-class:event:do-scan',
+            args=(
+                event.event_class_id,
+                event_date.year,
+                event_date.month,
+                event_date.day,
+                subscription.client.qr_code,
+            )
+        )
+        for _ in range(SCANS_PER_CLIENT)
+        for subscription in subscriptions
+        for event_date in event_dates
+    ]
+
+    def scan(url):
+        http_client = HttpClient()
+        http_client.force_login(manager.user)
+        try:
+            return http_client.get(url).status_code
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(max_workers=THREADS) as executor:
+        statuses = list(executor.map(scan, urls))
+
+    assert_that(set(statuses), has_length(1))
+    for subscription in subscriptions:
+        subscription.refresh_from_db()
+        # Every client is marked once for each event, however many times
+        # the client was scanned
+        assert_that(subscription, has_properties(
+            visits_left=2,
+            visits_used=3,
+        ))
+        assert_that(
+            models.Attendance.objects.filter(
+                client=subscription.client, marked=True),
+            has_length(3)
+        )
+    assert_that(
+        models.Event.objects.filter(
+            event_class=event.event_class, date=virtual_date),
+        has_length(1)
+    )
+    # Client is notified about every marked visit
+    assert_that(
+        enqueue_coalesced.call_args_list,
+        has_length(len(subscriptions) * len(event_dates))
+    )
@@ -1,7 +1,22 @@
+from datetime import date, datetime
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from hamcrest import assert_that
+from django.utils import timezone
+from freezegun import freeze_time
+from hamcrest import (
+    assert_that, contains_inanyorder, contains_string, has_entries,
+    has_length, is_,
+)
+from reversion.models import Version
+from social_django.models import UserSocialAuth
 
+from crm import models
+from crm.enums import GRANULARITY
+from crm.scanner import ScannerRoster
+from crm.views.manager.event import VisitReport
 from crm.tests.matchers import (
     is_http_200_response, is_http_302_response, is_http_403_response,
 )
@@ -45,3 +60,350 @@ def test_manager_urls_for_coach(path, client, coach_factory):
     response = client.get(reverse(path))
 
     assert_that(response, is_http_403_response())
+
+
+def test_client_list_fixed_queries(
+    client,
+    manager_factory,
+    client_factory,
+    client_subscription_factory,
+    vk_api
+):
+    manager = manager_factory()
+    client.login(username=manager.user.username, password='defaultpassword')
+    path = reverse('crm:manager:client:list')
+
+    def add_clients(count):
+        for i in range(count):
+            vk_user_id = len(client_ids) + 1
+            vk_api.add_user(vk_user_id)
+            client_subscription_factory(
+                company=manager.company,
+                client=client_factory(
+                    company=manager.company, vk_user_id=vk_user_id),
+                start_date=date.today(),
+            )
+            client_ids.append(i)
+
+    client_ids = []
+    add_clients(2)
+    with CaptureQueriesContext(connection) as few_clients:
+        client.get(path)
+    add_clients(5)
+    with CaptureQueriesContext(connection) as more_clients:
+        response = client.get(path)
+
+    assert_that(response, is_http_200_response())
+    assert_that(
+        more_clients.captured_queries,
+        has_length(len(few_clients.captured_queries))
+    )
+    # Аватарки новых учеников запрошены у VK одним запросом
+    assert_that(vk_api.calls_of('users.get'), has_length(2))
+    assert_that(response.content.decode(), contains_string(
+        'https://vk.test/photo_50_7.jpg'))
+
+
+@pytest.mark.parametrize('path, factory_name', [
+    ('crm:manager:coach:list', 'coach_factory'),
+    ('crm:manager:manager:list', 'manager_factory'),
+])
+def test_personnel_list_fixed_queries(
+    path,
+    factory_name,
+    request,
+    client,
+    manager_factory,
+    vk_api
+):
+    manager = manager_factory()
+    client.login(username=manager.user.username, password='defaultpassword')
+    factory = request.getfixturevalue(factory_name)
+
+    def add_personnel(count):
+        for _ in range(count):
+            vk_user_id = len(vk_user_ids) + 1
+            vk_api.add_user(vk_user_id)
+            user = factory(user__company=manager.company).user
+            UserSocialAuth.objects.create(
+                user=user,
+                provider='vk-oauth2',
+                uid=str(vk_user_id),
+                extra_data={'id': vk_user_id}
+            )
+            vk_user_ids.append(vk_user_id)
+
+    vk_user_ids = []
+    add_personnel(2)
+    with CaptureQueriesContext(connection) as few_personnel:
+        client.get(reverse(path))
+    add_personnel(5)
+    with CaptureQueriesContext(connection) as more_personnel:
+        response = client.get(reverse(path))
+
+    assert_that(response, is_http_200_response())
+    assert_that(
+        more_personnel.captured_queries,
+        has_length(len(few_personnel.captured_queries))
+    )
+    assert_that(response.content.decode(), contains_string(
+        'https://vk.test/photo_50_7.jpg'))
+
+
+def test_event_by_date_rest_clients_paginated(
+    client, manager_factory, event_class_factory, client_factory
+):
+    manager = manager_factory()
+    event_class = event_class_factory(company=manager.company)
+    client_factory.create_batch(30, company=manager.company)
+    client.login(username=manager.user.username, password='defaultpassword')
+
+    day = event_class.date_from
+    response = client.get(reverse(
+        'crm:manager:event-class:event:event-by-date',
+        args=(event_class.id, day.year, day.month, day.day)
+    ))
+
+    assert_that(response, is_http_200_response())
+    rest_clients = response.context['rest_clients']
+    assert_that(rest_clients.paginator.count, is_(30))
+    assert_that(rest_clients, has_length(25))
+
+
+def test_event_by_date_does_not_save_virtual_event(
+    client, manager_factory, event_class_factory
+):
+    manager = manager_factory()
+    event_class = event_class_factory(company=manager.company)
+    client.login(username=manager.user.username, password='defaultpassword')
+
+    day = event_class.date_from
+    response = client.get(reverse(
+        'crm:manager:event-class:event:event-by-date',
+        args=(event_class.id, day.year, day.month, day.day)
+    ))
+
+    assert_that(response, is_http_200_response())
+    assert_that(event_class.event_set.count(), is_(0))
+
+
+@pytest.fixture
+def enqueue_coalesced(mocker):
+    return mocker.patch('gcp.tasks.enqueue_coalesced')
+
+
+@pytest.fixture
+def event_to_mark(
+    client,
+    manager_factory,
+    event_factory,
+    client_subscription_factory,
+    enqueue_coalesced
+):
+    """
+    Сегодняшняя тренировка, абонементы к ней и вошедший менеджер
+    для отметки посещений
+    """
+    manager = manager_factory()
+    event = event_factory(
+        company=manager.company, event_class__date_from=date.today())
+
+    def sell(**kwargs):
+        return client_subscription_factory(
+            company=manager.company,
+            subscription__event_class__events=event.event_class,
+            subscription__duration=1,
+            subscription__duration_type=GRANULARITY.MONTH,
+            subscription__rounding=False,
+            start_date=event.date,
+            visits_left=5,
+            **kwargs
+        )
+
+    event.sell = sell
+    client.login(username=manager.user.username, password='defaultpassword')
+    return event
+
+
+def event_path(name, event):
+    return reverse(
+        name,
+        args=(
+            event.event_class_id,
+            event.date.year,
+            event.date.month,
+            event.date.day
+        )
+    )
+
+
+def test_mark_visits_api(client, event_to_mark, enqueue_coalesced, mocker):
+    enqueue = mocker.patch('gcp.tasks.enqueue')
+    subscriptions = [event_to_mark.sell() for _ in range(2)]
+    enqueue_coalesced.reset_mock()
+    path = event_path('api-v1:manager:event:mark-visits', event_to_mark)
+    visits = [
+        {'client': sub.client_id, 'subscription': sub.id}
+        for sub in subscriptions
+    ]
+
+    response = client.post(
+        path, {'visits': visits}, content_type='application/json')
+
+    assert_that(response.status_code, is_(201))
+    assert_that(response.json()['visits'], contains_inanyorder(*[
+        has_entries(visit, visits_left=4) for visit in visits
+    ]))
+    # Marked visits are saved in history of changes
+    assert_that(
+        Version.objects.get_for_model(models.Attendance),
+        has_length(2)
+    )
+    # Все ученики уведомляются одной задачей
+    enqueue.assert_called_once_with(
+        'notify_client_subscription_visits',
+        sorted(sub.id for sub in subscriptions)
+    )
+    enqueue_coalesced.assert_not_called()
+
+    response = client.post(
+        path, {'visits': visits[:1]}, content_type='application/json')
+
+    assert_that(response.status_code, is_(400))
+    assert_that(response.json(), has_entries(
+        errors=has_entries({str(visits[0]['client']): is_(str)})))
+
+
+def test_scan_api(client, event_to_mark, client_factory, enqueue_coalesced):
+    subscription = event_to_mark.sell()
+    without_subscription = client_factory(company=event_to_mark.company)
+    enqueue_coalesced.reset_mock()
+    path = event_path('api-v1:manager:event:scan', event_to_mark)
+
+    def scan(code):
+        return client.post(path, {'code': str(code)}).json()
+
+    assert_that(
+        scan(subscription.client.qr_code),
+        has_entries(result='marked', visits_left=4)
+    )
+    assert_that(
+        scan(subscription.client.qr_code),
+        has_entries(result='already-marked')
+    )
+    assert_that(
+        scan(without_subscription.qr_code),
+        has_entries(result='no-subscription', sell_url=is_(str))
+    )
+    assert_that(scan('not-a-code'), has_entries(result='invalid-code'))
+    subscription.refresh_from_db()
+    assert_that(subscription.visits_left, is_(4))
+    enqueue_coalesced.assert_called_once_with(
+        f'client-{subscription.client_id}',
+        'notify_client',
+        'notify_client_subscription_visit',
+        subscription.id
+    )
+
+
+def test_scan_api_stale_roster(
+    client,
+    event_to_mark,
+    enqueue_coalesced,
+    mocker
+):
+    subscription = event_to_mark.sell()
+    enqueue_coalesced.reset_mock()
+    # Карта собрана без абонемента, и ее не сбросили
+    build = ScannerRoster._build
+    builds = []
+
+    def stale_build(roster):
+        builds.append(roster)
+        return build(roster) if len(builds) > 1 else {}
+
+    mocker.patch.object(ScannerRoster, '_build', stale_build)
+    path = event_path('api-v1:manager:event:scan', event_to_mark)
+
+    response = client.post(path, {'code': str(subscription.client.qr_code)})
+
+    assert_that(
+        response.json(), has_entries(result='marked', visits_left=4))
+    assert_that(builds, has_length(2))
+    enqueue_coalesced.assert_called_once_with(
+        f'client-{subscription.client_id}',
+        'notify_client',
+        'notify_client_subscription_visit',
+        subscription.id
+    )
+
+
+@freeze_time('2019-02-15')
+def test_visit_report_subscription_visits(
+    company_factory,
+    event_class_factory,
+    event_factory,
+    client_subscription_factory,
+    extension_history_factory,
+    django_assert_num_queries,
+):
+    company = company_factory()
+    event_class = event_class_factory(
+        company=company, date_from=date(2018, 12, 1))
+
+    def sell(start_date, visits_left):
+        return client_subscription_factory(
+            company=company,
+            subscription__event_class__events=event_class,
+            subscription__duration_type=GRANULARITY.MONTH,
+            subscription__duration=2,
+            subscription__rounding=False,
+            start_date=start_date,
+            visits_left=visits_left,
+        )
+
+    def visit(subscription, day):
+        models.Attendance.objects.create(
+            company=company,
+            event=event_factory(
+                company=company, event_class=event_class, date=day),
+            client=subscription.client,
+            subscription=subscription,
+            marked=True,
+        )
+
+    late = sell(date(2019, 1, 10), 10)
+    visit(late, date(2019, 1, 15))
+    visit(late, date(2019, 1, 16))
+    extension_history_factory(
+        company=company,
+        client_subscription=late,
+        added_visits=2,
+        date_extended=timezone.make_aware(datetime(2019, 1, 20, 12)),
+    )
+    early = sell(date(2018, 12, 1), 8)
+    visit(early, date(2018, 12, 20))
+    visit(early, date(2019, 1, 5))
+
+    dates = [date(2019, 1, day) for day in range(1, 32)]
+    with django_assert_num_queries(4):
+        rows = VisitReport().get_subscription_visits(dates, event_class)
+
+    late_attendances = ['grey'] * 9 + ['red'] * 22
+    late_attendances[14] = late_attendances[15] = 'green'
+    early_attendances = ['red'] * 31
+    early_attendances[4] = 'green'
+    assert_that(rows, contains_inanyorder(
+        has_entries(
+            client=late.client,
+            attendances=late_attendances,
+            visit_start=10,
+            visit_end=10,
+        ),
+        has_entries(
+            client=early.client,
+            attendances=early_attendances,
+            visit_start=7,
+            visit_end=6,
+        ),
+    ))
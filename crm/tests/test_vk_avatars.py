@@ -0,0 +1,64 @@
+import time
+
+import pytest
+from hamcrest import assert_that, has_entries, has_length, is_
+from pytest_mock import MockFixture
+
+from crm import vk_avatars
+from crm.vk_avatars import get_vk_avatars
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def enqueue(mocker: MockFixture, company_factory):
+    mocker.patch(
+        'crm.vk_avatars.get_current_tenant', return_value=company_factory())
+    return mocker.patch('gcp.tasks.enqueue')
+
+
+def test_missing_avatars_fetched_at_once(vk_api, enqueue):
+    for vk_user_id in (1, 2):
+        vk_api.add_user(vk_user_id)
+
+    avatars = get_vk_avatars([1, 2, 3])
+
+    assert_that(avatars, has_entries({
+        1: 'https://vk.test/photo_50_1.jpg',
+        2: 'https://vk.test/photo_50_2.jpg',
+        3: '',
+    }))
+    assert_that(vk_api.calls_of('users.get'), has_length(1))
+
+    # Second page with same users is served from cache
+    assert_that(get_vk_avatars([1, 2, 3]), is_(avatars))
+    assert_that(vk_api.calls_of('users.get'), has_length(1))
+    enqueue.assert_not_called()
+
+
+def test_avatars_fetched_by_chunks(vk_api, enqueue, mocker: MockFixture):
+    mocker.patch('crm.vk_avatars.VK_USERS_GET_LIMIT', 2)
+
+    get_vk_avatars([1, 2, 3])
+
+    assert_that(vk_api.calls_of('users.get'), has_length(2))
+
+
+def test_stale_avatars_refreshed_in_background(
+    vk_api,
+    enqueue,
+    mocker: MockFixture
+):
+    vk_api.add_user(1)
+    get_vk_avatars([1])
+    mocker.patch(
+        'crm.vk_avatars.time.time',
+        return_value=time.time() + vk_avatars.AVATAR_FRESH_TIME + 1
+    )
+
+    assert_that(get_vk_avatars([1]), has_entries({
+        1: 'https://vk.test/photo_50_1.jpg'}))
+    get_vk_avatars([1])
+
+    assert_that(vk_api.calls_of('users.get'), has_length(1))
+    enqueue.assert_called_once_with('refresh_vk_avatars', [1])
@@ -0,0 +1,39 @@
+from hamcrest import assert_that, has_entries, has_length, is_
+from pytest_mock import MockFixture
+
+from bot.api.vkapi import RateLimiter
+from contrib.vk_utils import resolve_vk_user_ids, resolve_vk_users
+
+
+def test_resolve_vk_user_ids(vk_api):
+    vk_api.add_user(1)
+    vk_api.add_user(2, screen_name='durov')
+    vk_api.add_user(3, screen_name='Team')
+
+    user_ids = resolve_vk_user_ids(
+        ['id1', 'durov', 'id2', 'team', '3', 'unknown', None])
+
+    assert_that(user_ids, is_({
+        'id1': 1,
+        'durov': 2,
+        'id2': 2,
+        'team': 3,
+        '3': 3,
+    }))
+    # Repeated domains are requested once
+    assert_that(vk_api.calls_of('users.get'), has_length(1))
+
+
+def test_resolve_vk_users_by_chunks(vk_api, mocker: MockFixture):
+    mocker.patch('contrib.vk_utils.VK_USERS_GET_LIMIT', 2)
+    wait = mocker.patch.object(RateLimiter, 'wait')
+    for vk_user_id in range(1, 6):
+        vk_api.add_user(vk_user_id, bdate='1.1.2000')
+
+    users = resolve_vk_users(range(1, 6), 'bdate')
+
+    assert_that(users, has_length(5))
+    assert_that(users['5'], has_entries(id=5, bdate='1.1.2000'))
+    assert_that(vk_api.calls_of('users.get'), has_length(3))
+    # Every chunk is requested within request rate of token
+    assert_that(wait.call_count, is_(3))
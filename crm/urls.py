@@ -133,7 +133,11 @@ manager_clients_urlpatterns = ([
     path('<int:client_id>/', manager_client_views.AddSubscription.as_view(), {'hide_form': True}, name='detail'),
     path('<int:pk>/balance/', include(manager_client_balance_urlpatterns)),
     path('new/', manager_client_views.Create.as_view(), name='new'),
-    path('import-report/', manager_client_views.ImportReport.as_view(), name='import-report'),
+    path(
+        'import-report/<int:pk>/',
+        manager_client_views.ImportReport.as_view(),
+        name='import-report'
+    ),
     path('upload-excel/', manager_client_views.UploadExcel.as_view(), name='excel'),
     path(
         '<int:pk>/update/',
@@ -1,6 +1,7 @@
 from django.urls import path, include
 
-from crm.views.manager.event_class import ApiCalendar
+from crm.views.manager.event_class import ApiCalendar, MarkVisits, Scan
+from crm.views.manager import client as manager_client_views
 from crm.views.manager import event as manager_event_views
 from crm.views.manager import subscription as manager_subscription_views
 from crm.views import coach as coach_views
@@ -12,8 +13,26 @@ manager_event_class_urls = ([
 
 manager_event_urls = ([
     path('', manager_event_views.ApiCalendar.as_view(), name='calendar'),
+    path(
+        '<int:event_class_id>/<int:year>/<int:month>/<int:day>/mark-visits/',
+        MarkVisits.as_view(),
+        name='mark-visits'
+    ),
+    path(
+        '<int:event_class_id>/<int:year>/<int:month>/<int:day>/scan/',
+        Scan.as_view(),
+        name='scan'
+    ),
 ], 'event')
 
+manager_client_urls = ([
+    path(
+        'import/<int:pk>/',
+        manager_client_views.ImportProgress.as_view(),
+        name='import'
+    ),
+], 'client')
+
 manager_subscription_urls = ([
     path(
         '<int:pk>/sell-range/',
@@ -23,6 +42,7 @@ manager_subscription_urls = ([
 ], 'subscription')
 
 manager_api_urls = ([
+    path('client/', include(manager_client_urls)),
     path('event-class/', include(manager_event_class_urls)),
     path('event/', include(manager_event_urls)),
     path('subscription/', include(manager_subscription_urls)),
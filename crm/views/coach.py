@@ -56,13 +56,9 @@ class ApiCalendar(ListAPIView):
             self.request.query_params.get('end').split('T')[0]
         ) or (first_day + timedelta(days=31))
 
-        events = []
-        event_classes = (
+        return (
             EventClass.objects
             .in_range(start, end)
             .filter(coach=self.request.user.coach)
+            .get_calendar(start, end)
         )
-        for ec in event_classes:
-            events.extend(list(ec.get_calendar(start, end).values()))
-
-        return events
@@ -1,9 +1,7 @@
-import re
 from datetime import date, datetime
 import pytz
 
 from itertools import chain
-import openpyxl as openpyxl
 from django.contrib import messages
 from django.contrib.auth.views import SuccessURLAllowedHostsMixin
 from django.db import transaction
@@ -15,33 +13,32 @@ from django.shortcuts import get_object_or_404
 from django.urls import reverse, reverse_lazy
 from django.utils.http import is_safe_url
 from django.views.generic import (
-    CreateView, DeleteView, FormView, RedirectView, TemplateView,
-    UpdateView,
+    CreateView, DeleteView, DetailView, FormView, RedirectView, UpdateView,
 )
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django_filters.views import FilterView
 from django_multitenant.utils import get_current_tenant
-from openpyxl.utils import cell
 from rest_framework.generics import RetrieveAPIView
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.serializers import DateField, IntegerField
 from reversion.views import RevisionMixin
 from rules.contrib.views import PermissionRequiredMixin
 
-from crm import utils
 from crm.enums import BALANCE_REASON
 from crm.filters import ClientFilter
 from crm.forms import (
     ClientForm, ClientSubscriptionForm, ExtendClientSubscriptionForm,
     UploadExcelForm,
 )
+from crm.client_import import open_workbook
 from crm.models import (
-    Attendance, Client, ClientSubscriptions, EventClass, ExtensionHistory,
-    SubscriptionsType, Event, ExtensionHistory
+    Attendance, Client, ClientImport, ClientSubscriptions, EventClass,
+    ExtensionHistory, SubscriptionsType, Event, ExtensionHistory
 )
-from crm.serializers import ClientSubscriptionCheckOverlappingSerializer
-from crm.templatetags.html_helper import (
-    allowed_date_formats_ru,
-    get_vk_user_ids, try_parse_date,
+from crm.roster import prefetch_client_cards
+from crm.serializers import (
+    ClientImportProgressSerializer,
+    ClientSubscriptionCheckOverlappingSerializer,
 )
 from crm.views.manager.event_class import EventByDateMixin
 from crm.views.mixin import CreateAndAddView, UnDeleteView
@@ -61,6 +58,8 @@ class List(PermissionRequiredMixin, FilterView):
         context = super().get_context_data(object_list=object_list, **kwargs)
         context['has_active_event_class'] = EventClass.objects.active().exists()
         context['vk_group_id'] = get_current_tenant().vk_group_id
+        context['clients'] = list(context['clients'])
+        prefetch_client_cards(context['clients'])
         return context
 
 
@@ -315,9 +314,13 @@ class AddSubscription(
                 )
             client.save()
             response = super().form_valid(form)
-            self.object.event = self.get_event()
+            event = self.get_event()
+            if event:
+                event.save_virtual()
+            self.object.event = event
             self.object.save()
-            enqueue('notify_client_buy_subscription', self.object.id)
+            client.enqueue_notification(
+                'notify_client_buy_subscription', self.object.id)
 
         return response
 
@@ -467,149 +470,51 @@ class SubscriptionDelete(PermissionRequiredMixin, RevisionMixin, DeleteView):
             'crm:manager:client:detail', args=[self.object.client.id])
 
 
-class ImportReport(PermissionRequiredMixin, RevisionMixin, TemplateView):
+class ImportReport(PermissionRequiredMixin, DetailView):
+    model = ClientImport
+    context_object_name = 'client_import'
     template_name = 'crm/manager/client/import_report.html'
     permission_required = 'client.add'
 
-    def get(self, *args, **kwargs):
-        if 'import_errors' not in self.request.session:
-            raise Http404()
-        resp = super().get(*args, **kwargs)
-        del self.request.session['import_errors']
-        return resp
 
-    def get_context_data(self, **kwargs):
-        context = super(ImportReport, self).get_context_data(**kwargs)
-        context['import_errors'] = self.request.session['import_errors']
-        return context
+class ImportProgress(PermissionRequiredMixin, RetrieveAPIView):
+    serializer_class = ClientImportProgressSerializer
+    queryset = ClientImport.objects
+    permission_classes = (IsAuthenticated,)
+    permission_required = 'client.add'
 
 
-class UploadExcel(PermissionRequiredMixin, RevisionMixin, FormView):
+class UploadExcel(PermissionRequiredMixin, FormView):
     form_class = UploadExcelForm
     template_name = 'crm/manager/client/upload_excel.html'
     permission_required = 'client.add'
-    success_url = reverse_lazy('crm:manager:client:import-report')
 
     def form_valid(self, form):
         file = form.cleaned_data['file']
-        ignore_first_row = form.cleaned_data['ignore_first_row']
-        name_col = form.cleaned_data['name_col']
-        phone_col = form.cleaned_data['phone_col']
-        birthday_col = form.cleaned_data['birthday_col']
-        vk_col = form.cleaned_data['vk_col']
-        balance_col = form.cleaned_data['balance_col']
 
         try:
-            wb = openpyxl.load_workbook(file)
-            ws = wb.worksheets[0]
+            open_workbook(file).close()
         except Exception:
             form._errors[forms.NON_FIELD_ERRORS] = ErrorList([
                 u'Неподдерживаемый формат файла!'
             ])
             return self.form_invalid(form)
 
-        iter_rows = iter(ws.rows)
-        if ignore_first_row:
-            next(iter_rows)
-
-        skipped = 0
-        added = 0
-        clients_to_add = []
-        vk_domains = []
-        errors={}
-
-        for index, row in enumerate(iter_rows):
-            try:
-                name = row[cell.column_index_from_string(name_col) - 1].value
-            except (IndexError, ValueError):
-                errors["{}{}".format(name_col, index+1)] = "Ошибка в имени или имя пустое."
-                skipped += 1
-                continue
-            if name == None:
-                errors["{}{}".format(name_col, index + 1)] = "Имя пустое."
-                skipped += 1
-                continue
-
-            try:
-                phone = self.try_parse_phone(row[cell.column_index_from_string(phone_col) - 1].value)
-            except IndexError:
-                phone = Client._meta.get_field('phone_number').get_default()
-            except ValueError:
-                errors["{}{}".format(phone_col, index+1)] = "Неверный формат номера."
-                skipped += 1
-                continue
-
-            try:
-                birthday = try_parse_date(row[cell.column_index_from_string(birthday_col) - 1].value)
-            except (IndexError, TypeError):
-                birthday = Client._meta.get_field('birthday').get_default()
-            except ValueError:
-                errors["{}{}".format(birthday_col, index+1)] = "Неверный формат даты. Допустимые форматы: " + allowed_date_formats_ru;
-                skipped += 1
-                continue
-
-
-            try:
-                balance = self.try_parse_balance(row[cell.column_index_from_string(balance_col) - 1].value)
-            except (IndexError, AttributeError):
-                balance = Client._meta.get_field('balance').get_default()
-            except (ValueError, TypeError):
-                errors["{}{}".format(balance_col, index+1)] = "Неверный формат числа. Допустимые форматы: целые числа, дробные разделенные точкой или запятой."
-                skipped += 1
-                continue
-
-            try:
-                m = re.search(utils.VK_PAGE_REGEXP, row[cell.column_index_from_string(vk_col) - 1].value)
-                vk_domain = m.group('user_id')
-            except (IndexError, TypeError, AttributeError):
-                vk_domain = Client._meta.get_field('vk_user_id').get_default()
-            except ValueError:
-                errors["{}{}".format(vk_col, index+1)] = "Неверный формат ссылки. Допустимые форматы: vk.com/user_id или https://vk.com/user_id"
-                skipped += 1
-                continue
-
-            exists = Client.objects.filter(
-                name=name,
-                phone_number=phone,
-                birthday=birthday
-            ).exists()
-
-            if not exists:
-                client = Client(name = name, phone_number = phone, birthday = birthday)
-                if balance:
-                    client.balance = balance
-                clients_to_add.append(client)
-                if vk_domain:
-                    vk_domains.append(vk_domain)
-                added += 1
-            else:
-                skipped+=1
-
-            if len(clients_to_add) >= 1000:
-                vk_user_ids = get_vk_user_ids(vk_domains)
-                for vk_user_id in vk_user_ids:
-                    clients_to_add[vk_user_ids.index(vk_user_id)].vk_user_id = vk_user_id
-                Client.objects.bulk_create(clients_to_add)
-                clients_to_add = []
-                vk_domains = []
-
-        vk_user_ids = get_vk_user_ids(vk_domains)
-        for i, vk_user_id in enumerate(vk_user_ids):
-            clients_to_add[i].vk_user_id = vk_user_id
-
-        Client.objects.bulk_create(clients_to_add)
-        self.request.session['import_errors'] = errors
-
-        messages.info(self.request, 'Создано записей: {}. Пропущено записей: {}'.format(added, skipped) )
-
-        return super(UploadExcel, self).form_valid(form)
-
-    def try_parse_phone(self, raw_value):
-        phone = re.sub("\D", "", str(raw_value))[0:14]
-        return phone
-
-    def try_parse_balance(self, raw_value):
-        if isinstance(raw_value, float):
-            return  raw_value;
-        balance = float(raw_value.replace(',','.'))
-        return balance
+        file.seek(0)
+        self.client_import = ClientImport.objects.create(
+            file=file.read(),
+            ignore_first_row=form.cleaned_data['ignore_first_row'],
+            name_col=form.cleaned_data['name_col'],
+            phone_col=form.cleaned_data['phone_col'],
+            birthday_col=form.cleaned_data['birthday_col'],
+            vk_col=form.cleaned_data['vk_col'],
+            balance_col=form.cleaned_data['balance_col'],
+        )
+        # Загрузка большого файла не укладывается в время запроса, поэтому
+        # выполняется в фоне, а страница отчета показывает прогресс
+        enqueue('import_clients', self.client_import.id)
+
+        return super().form_valid(form)
+
+    def get_success_url(self):
+        return self.client_import.get_absolute_url()
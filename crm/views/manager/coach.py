@@ -14,10 +14,12 @@ from crm.auth.one_time_login import get_one_time_login_link
 from crm.filters import CoachFilter
 from crm.forms import CoachMultiForm
 from crm.models import Coach
-from crm.views.mixin import CreateAndAddView, SocialAuthMixin, UnDeleteView
+from crm.views.mixin import (
+    CreateAndAddView, SocialAuthMixin, UnDeleteView, UsersVkAvatarsMixin,
+)
 
 
-class List(PermissionRequiredMixin, FilterView):
+class List(PermissionRequiredMixin, UsersVkAvatarsMixin, FilterView):
     model = Coach
     template_name = 'crm/manager/coach/list.html'
     context_object_name = 'coachs'
@@ -1,8 +1,10 @@
-from datetime import timedelta, date
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
 
-from typing import Dict, List
+from typing import Dict, List, Tuple
 
-from django.db.models import Sum
+from django.db.models import Count
 from django.utils import timezone
 from django.views.generic import (
     TemplateView,
@@ -16,7 +18,10 @@ from rest_framework.permissions import IsAuthenticated
 from rules.contrib.views import PermissionRequiredMixin
 
 from crm.filters import EventReportFilter, VisitReportFilter
-from crm.models import EventClass, Event, ClientSubscriptions, Attendance, ExtensionHistory
+from crm.models import (
+    Attendance, Client, ClientSubscriptions, Event, EventClass,
+    ExtensionHistory,
+)
 from crm.serializers import CalendarEventSerializer
 from crm.tables import EventReportTable
 
@@ -29,6 +34,9 @@ class EventReport(PermissionRequiredMixin, SingleTableMixin, FilterView):
     model = Event
     permission_required = 'report.events'
 
+    def get_queryset(self):
+        return Event.objects.with_report_stats()
+
 
 class VisitReport(PermissionRequiredMixin, FormView):
     template_name = 'crm/manager/event/visit-report.html'
@@ -51,15 +59,12 @@ class VisitReport(PermissionRequiredMixin, FormView):
         kwargs['data'] = self.request.GET or self.default_data()
         return kwargs
 
-    def get_month_dates_range(self, year: int, month: int, event_class: EventClass):
-        dt1 = date.today().replace(year, month, 1)
-        days = (date.today().replace(month=month % 12 + 1, day=1) - timedelta(days=1)).day
-        dt2 = date.today().replace(year, month, days)
-        return sorted(
-            list(
-                event_class.get_calendar(dt1, dt2).keys()
-            )
-        )
+    def get_month_dates_range(
+        self, year: int, month: int, event_class: EventClass
+    ) -> List[date]:
+        dt1 = date(year, month, 1)
+        dt2 = date(year, month, monthrange(year, month)[1])
+        return sorted(event_class.get_calendar(dt1, dt2).keys())
 
     def get_context_data(self, **kwargs: dict):
         context = super().get_context_data(**kwargs)
@@ -70,8 +75,8 @@ class VisitReport(PermissionRequiredMixin, FormView):
             year = int(form.cleaned_data['year'])
             event_class = form.cleaned_data['event_class']
 
-            data = self.get_table_data(year, month, event_class)
             date_list = self.get_month_dates_range(year, month, event_class)
+            data = self.get_table_data(date_list, event_class)
             context['table_data'] = self.sort_data(data)
             context['month_days'] = date_list
             context['event_class'] = event_class
@@ -83,137 +88,164 @@ class VisitReport(PermissionRequiredMixin, FormView):
         data.sort(key=lambda i: i['client'].name)
         return data
 
-    def get_table_data(self, year: int, month: int, event_class: EventClass):
-        data = self.get_subscription_visits(year, month, event_class)
+    def get_table_data(self, dates: List[date], event_class: EventClass):
+        data = self.get_subscription_visits(dates, event_class)
 
-        for client, attendances in self.get_one_time_visits(year, month, event_class).items():
-            tmp = self.attendances_to_list(attendances)
+        one_time_visits = self.get_one_time_visits(dates, event_class)
+        for client, attendances in one_time_visits.items():
             data.append({
                 'client': client,
                 'subscription': 'Разовые',
                 'visit_start': 0,
                 'visit_end': 0,
-                'attendances': tmp
+                'attendances': attendances
             })
         return data
 
-    def get_subscription_visits(self, year: int, month: int, event_class: EventClass):
-        dates = self.get_month_dates_range(year, month, event_class)
+    @staticmethod
+    def _day_start(day: date) -> datetime:
+        # Так же, как Django приводит дату при сравнении с DateTimeField
+        return timezone.make_aware(datetime.combine(day, time.min))
+
+    def get_subscription_visits(
+        self, dates: List[date], event_class: EventClass
+    ) -> List[dict]:
+        """
+        Строки отчета по абонементам: отметки посещений по дням месяца,
+        остаток посещений на начало и конец периода.
+
+        Данные всех абонементов собираются несколькими сгруппированными
+        запросами, независимо от количества абонементов.
+        """
         if not dates:
             return []
         today = date.today()
         from_date, to_date = dates[0], dates[-1]
-        fltr = {
-            'subscription__one_time': False,
-            'start_date__lte': to_date,
-            'end_date__gte': from_date,
-            'subscription__event_class': event_class
-        }
-
-        active_subs = ClientSubscriptions.objects.exclude_onetime().filter(
-            **fltr
-        ).select_related(
-            'subscription', 'client'
-        ).iterator()
-        result = []
-
-        for subs in active_subs:
-
-            attendances = {}
-            for dt in dates:
-                if dt <= today:
-                    attendances[dt] = 'red'
-                else:
-                    attendances[dt] = ''
-
-            added_visits = ExtensionHistory.objects.filter(
-                date_extended__range=(from_date, to_date),
-                client_subscription=subs,
-            ).aggregate(
-                Sum('added_visits')
-            )['added_visits__sum'] or 0
-
-            from_date = max(from_date, subs.start_date)
-            to_date = min(to_date, subs.end_date or to_date)
-
-            for dt in dates:
-                if dt < from_date:
-                    attendances[dt] = 'grey'
-                    continue
-                if to_date < dt <= today:
-                    attendances[dt] = 'grey'
-                    continue
-
-            old_added_visits = ExtensionHistory.objects.filter(
-                date_extended__lt=from_date,
-                client_subscription=subs,
-            ).aggregate(
-                Sum('added_visits')
-            )['added_visits__sum'] or 0
-            visit_start = subs.visits_on_by_time + old_added_visits
-
-            if subs.start_date < from_date:
-                visit_start -= subs.attendance_set.filter(
-                    marked=True,
-                    event__date__lt=from_date
-                ).exclude(
-                    event__date__gt=date.today()
-                ).count()
+        day_index = {dt: index for index, dt in enumerate(dates)}
+
+        subscriptions = list(
+            ClientSubscriptions.objects
+            .exclude_onetime()
+            .filter(
+                start_date__lte=to_date,
+                end_date__gte=from_date,
+                subscription__event_class=event_class
+            )
+            .select_related('subscription', 'client')
+        )
+        if not subscriptions:
+            return []
+        subs_ids = [subs.id for subs in subscriptions]
+
+        # Продления абонементов: за период отчета и до начала
+        # действия абонемента в периоде
+        extensions: Dict[int, List[Tuple[datetime, int]]] = defaultdict(list)
+        for subs_id, date_extended, added_visits in (
+            ExtensionHistory.objects
+            .filter(
+                client_subscription_id__in=subs_ids,
+                date_extended__lte=to_date,
+            )
+            .order_by()
+            .values_list(
+                'client_subscription_id', 'date_extended', 'added_visits')
+        ):
+            extensions[subs_id].append((date_extended, added_visits))
+
+        # Посещения до начала периода отчета
+        prior_visits = dict(
+            Attendance.objects
+            .filter(
+                subscription_id__in=subs_ids,
+                marked=True,
+                event__date__lt=from_date,
+            )
+            .exclude(event__date__gt=today)
+            .order_by()
+            .values('subscription_id')
+            .annotate(count=Count('id'))
+            .values_list('subscription_id', 'count')
+        )
 
-            visited = subs.attendance_set.filter(
+        # Даты посещений за период отчета
+        visits: Dict[int, List[date]] = defaultdict(list)
+        for subs_id, event_date in (
+            Attendance.objects
+            .filter(
+                subscription_id__in=subs_ids,
                 marked=True,
                 event__date__range=(from_date, to_date),
-                subscription=subs,
-            ).exclude(
-                event__date__gt=date.today()
-            ).select_related('event').all()
+            )
+            .exclude(event__date__gt=today)
+            .order_by()
+            .values_list('subscription_id', 'event__date')
+        ):
+            visits[subs_id].append(event_date)
 
-            for visit in visited:
-                if visit.event.date in dates and visit.event.date <= today:
-                    attendances[visit.event.date] = 'green'
+        period_start = self._day_start(from_date)
+        period_end = self._day_start(to_date)
 
-            visit_end = added_visits + visit_start - len(visited)
-            tmp = self.attendances_to_list(attendances)
+        result = []
+        for subs in subscriptions:
+            subs_from = max(from_date, subs.start_date)
+            subs_to = min(to_date, subs.end_date or to_date)
+            subs_start = self._day_start(subs_from)
+
+            attendances = [
+                'grey' if dt < subs_from or subs_to < dt <= today
+                else 'red' if dt <= today
+                else ''
+                for dt in dates
+            ]
+
+            added_visits = 0
+            old_added_visits = 0
+            for date_extended, visits_count in extensions[subs.id]:
+                if period_start <= date_extended <= period_end:
+                    added_visits += visits_count
+                if date_extended < subs_start:
+                    old_added_visits += visits_count
+
+            visit_start = subs.visits_on_by_time + old_added_visits
+            if subs.start_date < subs_from:
+                visit_start -= prior_visits.get(subs.id, 0)
+
+            visited = [
+                visit_date for visit_date in visits[subs.id]
+                if subs_from <= visit_date <= subs_to
+            ]
+            for visit_date in visited:
+                if visit_date in day_index:
+                    attendances[day_index[visit_date]] = 'green'
 
             result.append({
                 'client': subs.client,
                 'subscription': subs.subscription.name,
-                'attendances': tmp,
+                'attendances': attendances,
                 'visit_start': visit_start,
-                'visit_end': visit_end,
+                'visit_end': added_visits + visit_start - len(visited),
             })
         return result
 
-    def attendances_to_list(self, attendances):
-        tmp = []
-        for key in sorted(attendances.keys()):
-            tmp.append(attendances[key])
-        return tmp
-
-    def get_one_time_visits(self, year: int, month: int, event_class: EventClass) -> Dict:
-        dates = self.get_month_dates_range(year, month, event_class)
+    def get_one_time_visits(
+        self, dates: List[date], event_class: EventClass
+    ) -> Dict[Client, List[str]]:
         if not dates:
             return {}
-        fltr = {
-            'subscription__subscription__one_time': True,
-            'event__date__range': (dates[0], dates[-1]),
-            'event__event_class': event_class
-        }
-        attendances = {}
-        for dt in dates:
-            attendances[dt] = ''
+        day_index = {dt: index for index, dt in enumerate(dates)}
 
         visited = Attendance.objects.filter(
-            **fltr
+            subscription__subscription__one_time=True,
+            event__date__range=(dates[0], dates[-1]),
+            event__event_class=event_class
         ).exclude(
            event__date__gt=date.today()
-        ).select_related('client', 'event').all()
+        ).select_related('client', 'event')
         result = {}
         for visit in visited:
-            client = visit.client
-            if client not in result:
-                result[client] = attendances.copy()
-            result[client][visit.event.date] = 'green'
+            attendances = result.setdefault(visit.client, [''] * len(dates))
+            if visit.event.date in day_index:
+                attendances[day_index[visit.event.date]] = 'green'
         return result
 
 
@@ -236,8 +268,4 @@ class ApiCalendar(ListAPIView):
             self.request.query_params.get('end').split('T')[0]
         ) or (first_day + timedelta(days=31))
 
-        events = []
-        for ec in EventClass.objects.in_range(start, end):
-            events.extend(list(ec.get_calendar(start, end).values()))
-
-        return events
+        return EventClass.objects.in_range(start, end).get_calendar(start, end)
@@ -1,8 +1,10 @@
 from datetime import date, timedelta
 from typing import List, Optional
+from urllib.parse import urlencode
 from uuid import UUID
 
 from django.contrib import messages
+from django.core.paginator import Paginator
 from django.db import transaction
 from django.db.models import ProtectedError
 from django.http import HttpResponseRedirect
@@ -14,8 +16,10 @@ from django.views.generic import (
     TemplateView,
 )
 from rest_framework.fields import DateField
-from rest_framework.generics import ListAPIView
+from rest_framework import status
+from rest_framework.generics import GenericAPIView, ListAPIView
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
 from reversion.views import RevisionMixin
 from rules.contrib.views import PermissionRequiredMixin
 
@@ -26,11 +30,15 @@ from crm.forms import (
 )
 from crm.models import (
     Client, ClientAttendanceExists, ClientSubscriptions,
-    DayOfTheWeekClass, Event, EventClass, SubscriptionsType,
+    DayOfTheWeekClass, Event, EventClass, InvalidVisits, SubscriptionsType,
+)
+from crm.roster import EventRoster, RosterEntry, last_subscriptions
+from crm.scanner import ScannerRoster, invalidate_event_scanner_roster
+from crm.serializers import (
+    CalendarEventSerializer, MarkVisitsSerializer, ScanSerializer,
 )
-from crm.serializers import CalendarEventSerializer
 from crm.views.mixin import RedirectWithActionView
-from gcp.tasks import enqueue
+from crm.vk_avatars import get_vk_avatars
 
 
 class ObjList(PermissionRequiredMixin, ListView):
@@ -122,69 +130,43 @@ class EventByDate(
     template_name = 'crm/manager/event/detail.html'
     permission_required = 'event'
 
-    def get_clients_subscriptions(self, clients_qs):
-        result = {}
-        for client in clients_qs:
-            client_subscriptions = result.setdefault(client, [])
-            subs = client.clientsubscriptions_set.active_subscriptions_to_event(
-                self.object
+    rest_clients_paginate_by = 25
+
+    def get_rest_clients(self, exclude_ids: List[int]):
+        """
+        Прочие ученики компании, постранично и с поиском по имени, чтобы
+        не загружать в страницу тренировки всех учеников.
+        """
+        rest_clients_qs = Client.objects.exclude(id__in=exclude_ids)
+        name = self.request.GET.get('name')
+        if name:
+            rest_clients_qs = rest_clients_qs.filter(name__icontains=name)
+
+        page = Paginator(
+            rest_clients_qs.order_by('name'), self.rest_clients_paginate_by
+        ).get_page(self.request.GET.get('page'))
+
+        last_subs = last_subscriptions(client.id for client in page)
+        page.object_list = [
+            RosterEntry(
+                client=client,
+                subscriptions=[],
+                last_sub=last_subs.get(client.id),
             )
-            for sub in subs:
-                client_subscriptions.append(sub)
-        return result
+            for client in page
+        ]
+        return page
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        # Записанные клиенты. У них может и не быть абонементов
-        signed_up_clients_qs = Client.objects.filter(
-            id__in=self.object.attendance_set
-            .filter(marked=False, signed_up=True)
-            .order_by('name')
-            .values_list('client', flat=True)
-        )
-        signed_up_clients = self.get_clients_subscriptions(signed_up_clients_qs)
-
-        # Неотмеченные клиент. Они не записывались, но у них есть абонементы
-        # которые позволяют сходить на это занятие
-        unmarked_clients_qs = (
-            Client.objects
-            .with_active_subscription_to_event(self.object)
-            .exclude(
-                id__in=self.object
-                .attendance_set
-                .values_list('client', flat=True)
-            )
-            .order_by('name')
-        )
-        unmarked_clients = self.get_clients_subscriptions(unmarked_clients_qs)
-
-        # Отмеченные клиенты. Они сходили на занятие и у них есть абонементы
-        attendance_list_marked = (
-            self.object.attendance_set
-            .filter(marked=True)
-            .select_related('client')
-            .order_by('client__name')
-        )
-
-        selected_id = [
-            x.id for x, _ in signed_up_clients.items()
-        ]
-        selected_id.extend([
-            x.id for x, _ in unmarked_clients.items()
-        ])
-        selected_id.extend([
-            x.client_id for x in attendance_list_marked
-        ])
-
-        rest_clients = Client.objects.exclude(id__in=selected_id)
-
-        self.object.save()
+        roster = EventRoster(self.object)
+        rest_clients = self.get_rest_clients(roster.client_ids)
 
         context.update({
-            'attendance_list_marked': attendance_list_marked,
-            'signed_up_clients': signed_up_clients,
-            'unmarked_clients': unmarked_clients,
+            'attendance_list_marked': roster.marked,
+            'signed_up_clients': roster.signed_up,
+            'unmarked_clients': roster.unmarked,
             'sell_subscription_form': InplaceSellSubscriptionForm(
                 subscription_type_qs=SubscriptionsType.objects.filter(
                     event_class=self.object.event_class)
@@ -195,7 +177,19 @@ class EventByDate(
                 .active()
                 .filter(id=self.object.event_class_id).exists()
             ),
-            'rest_clients': rest_clients
+            'rest_clients': rest_clients,
+            'rest_clients_query': (
+                urlencode({'name': self.request.GET['name']})
+                if self.request.GET.get('name') else ''
+            ),
+            'vk_avatars': get_vk_avatars(
+                entry.client.vk_user_id
+                for entries in (
+                    roster.signed_up, roster.unmarked, roster.marked,
+                    rest_clients
+                )
+                for entry in entries
+            ),
         })
 
         context.update(
@@ -381,12 +375,14 @@ class SellAndMark(
                 default_reason = 'Перечесление средств за абонемент'
                 client.add_balance_in_history(abon_price, default_reason, changed_by=current_user)
             client.save()
+            event = self.get_object()
+            event.save_virtual()
             subscription = form.save()
-            subscription.event = self.get_object()
+            subscription.event = event
             subscription.sold_by = current_user
             subscription.save()
             try:
-                client.mark_visit(self.get_object(), subscription)
+                client.mark_visit(event, subscription)
             except ValueError:
                 messages.warning(
                     'Не получилось отметить визит - возможно абонемент был '
@@ -396,7 +392,8 @@ class SellAndMark(
                 # Strange case - sell - it's ok, but existent attendance won't
                 # be related with new subscription, as it exists
                 pass
-            enqueue('notify_client_buy_subscription', subscription.id)
+            client.enqueue_notification(
+                'notify_client_buy_subscription', subscription.id)
         return HttpResponseRedirect(self.get_success_url())
 
 
@@ -486,6 +483,55 @@ class MarkClient (
             'crm:manager:event-class:event:event-by-date', kwargs=self.kwargs)
 
 
+class MarkVisits(
+    PermissionRequiredMixin,
+    RevisionMixin,
+    EventByDateMixin,
+    GenericAPIView
+):
+    """
+    Отметка посещений группы учеников одним запросом.
+
+    Принимает список пар ученик - абонемент. Если хотя бы одно посещение
+    нельзя отметить, не отмечается ни одно, а в ответе причины по ученикам.
+    """
+    permission_required = 'event.mark-attendance'
+    serializer_class = MarkVisitsSerializer
+
+    def get_object(self, queryset=None) -> Event:
+        # Тренировка нужна и для проверки прав, и для отметки
+        if not hasattr(self, 'object'):
+            self.object = super().get_object(queryset)
+        return self.object
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        visits = {
+            visit['client']: visit['subscription']
+            for visit in serializer.validated_data['visits']
+        }
+        try:
+            subscriptions = ClientSubscriptions.objects.mark_visits(
+                self.get_object(), visits)
+        except InvalidVisits as exc:
+            return Response(
+                {'errors': exc.errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response({
+            'visits': [
+                {
+                    'client': sub.client_id,
+                    'subscription': sub.id,
+                    'visits_left': sub.visits_left,
+                }
+                for sub in subscriptions
+            ]
+        }, status=status.HTTP_201_CREATED)
+
+
 class CreateEdit(
     PermissionRequiredMixin,
     RevisionMixin,
@@ -650,9 +696,109 @@ class Scanner(
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['event'] = self.get_object()
+        # Карта учеников собирается при открытии сканера, чтобы
+        # сканирования сразу отвечали из кэша
+        ScannerRoster(context['event'])
         return context
 
 
+class Scan(
+    PermissionRequiredMixin,
+    RevisionMixin,
+    EventByDateMixin,
+    GenericAPIView
+):
+    """
+    Отметка ученика по QR коду для сканера.
+
+    Ученик и его абонемент ищутся в закэшированной карте сканера
+    тренировки, а результат возвращается в JSON, без перезагрузки
+    страницы сканера.
+    """
+    permission_required = 'event.mark-attendance'
+    serializer_class = ScanSerializer
+
+    def get_object(self, queryset=None) -> Event:
+        # Тренировка нужна и для проверки прав, и для отметки
+        if not hasattr(self, 'object'):
+            self.object = super().get_object(queryset)
+        return self.object
+
+    def result(self, result: str, message: str, **kwargs) -> Response:
+        return Response({'result': result, 'message': message, **kwargs})
+
+    def sell_result(self, client_id: int, client_name: str) -> Response:
+        sell_kwargs = dict(self.kwargs, client_id=client_id)
+        return self.result(
+            'no-subscription',
+            f'У ученика {client_name} нет подходящего абонемента',
+            sell_url=reverse(
+                'crm:manager:event-class:event:sell-and-mark-to-client',
+                kwargs=sell_kwargs
+            ) + '?scanner=True'
+        )
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        code = serializer.validated_data['code']
+        try:
+            uuid = UUID(code)
+        except ValueError:
+            return self.result(
+                'invalid-code', f'Некорректный формат кода "{code}"')
+
+        event = self.get_object()
+        roster = ScannerRoster(event)
+        entry = roster.get(uuid)
+
+        if entry is None:
+            client = Client.objects.filter(qr_code=uuid).first()
+            if not client:
+                return self.result(
+                    'not-found', f'Ученик с QR кодом {code} не найден')
+
+            has_subscription = (
+                ClientSubscriptions.objects
+                .active_subscriptions_to_event(event)
+                .filter(client=client)
+                .exists()
+            )
+            if not has_subscription:
+                return self.sell_result(client.id, client.name)
+
+            # Абонемент куплен после сборки карты, а карту не сбросили
+            invalidate_event_scanner_roster(event)
+            roster = ScannerRoster(event)
+            entry = roster.get(uuid)
+            if entry is None:
+                return self.sell_result(client.id, client.name)
+
+        if entry['marked']:
+            return self.result(
+                'already-marked', f'{entry["client_name"]} уже отмечен')
+
+        try:
+            subscription = ClientSubscriptions.objects.get(
+                id=entry['subscription_id'])
+            visits_left = subscription.mark_visit(event)
+        except ClientAttendanceExists:
+            roster.mark(uuid)
+            return self.result(
+                'already-marked', f'{entry["client_name"]} уже отмечен')
+        except (ClientSubscriptions.DoesNotExist, ValueError):
+            # Абонемент изменился после сборки карты
+            return self.sell_result(entry['client_id'], entry['client_name'])
+
+        roster.mark(uuid)
+        return self.result(
+            'marked',
+            f'{entry["client_name"]} отмечен по абонементу '
+            f'{entry["subscription_name"]}',
+            visits_left=visits_left
+        )
+
+
 class DoScan(
     PermissionRequiredMixin,
     EventByDateMixin,
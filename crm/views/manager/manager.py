@@ -12,10 +12,12 @@ from crm.auth.one_time_login import get_one_time_login_link
 from crm.filters import ManagerFilter
 from crm.forms import ManagerMultiForm
 from crm.models import Manager
-from crm.views.mixin import CreateAndAddView, SocialAuthMixin, UnDeleteView
+from crm.views.mixin import (
+    CreateAndAddView, SocialAuthMixin, UnDeleteView, UsersVkAvatarsMixin,
+)
 
 
-class List(PermissionRequiredMixin, FilterView):
+class List(PermissionRequiredMixin, UsersVkAvatarsMixin, FilterView):
     model = Manager
     template_name = 'crm/manager/manager/list.html'
     context_object_name = 'managers'
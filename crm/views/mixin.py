@@ -1,5 +1,6 @@
 from django.contrib import messages
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models import prefetch_related_objects
 from django.http import HttpResponseRedirect
 from django.urls import reverse
 from django.views.generic import CreateView, RedirectView
@@ -7,9 +8,11 @@ from django.views.generic.detail import (
     BaseDetailView,
     SingleObjectTemplateResponseMixin,
 )
+from social_django.models import UserSocialAuth
 from social_django.utils import load_backend, load_strategy
 
 from contrib.vk_utils import get_one_vk_user_info, get_vk_id_from_link
+from crm.vk_avatars import get_vk_avatars
 
 
 class CreateAndAddView(CreateView):
@@ -82,6 +85,36 @@ class SocialAuthMixin:
             linked_social.delete()
 
 
+class UsersVkAvatarsMixin:
+    """
+    Collect VK avatars of all users on list page at once.
+
+    Objects of list must have `user` field. VK id and link of user are
+    set to `vk_id` and `vk_link` of object, so template doesn't request
+    them for every row. Avatars are placed to context as `vk_avatars` and
+    used by `vk_small_avatar` tag.
+    """
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        objects = list(context['object_list'])
+        # Users are shown in every row of list
+        prefetch_related_objects(objects, 'user')
+        socials = UserSocialAuth.objects.filter(
+            user_id__in=[obj.user_id for obj in objects],
+            provider='vk-oauth2'
+        )
+        vk_ids = {
+            social.user_id: social.extra_data.get('id') or social.uid
+            for social in socials
+        }
+        for obj in objects:
+            obj.vk_id = vk_ids.get(obj.user_id)
+            obj.vk_link = (
+                'https://vk.com/id{}'.format(obj.vk_id) if obj.vk_id else None)
+        context['vk_avatars'] = get_vk_avatars(vk_ids.values())
+        return context
+
+
 class UnDeletionMixin:
     """Provide the ability to undelete objects."""
     # TODO: on initialization add validation of object class
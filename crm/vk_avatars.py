@@ -0,0 +1,96 @@
+import time
+from typing import Dict, Iterable, List
+
+from django.core.cache import cache
+from django_multitenant.utils import get_current_tenant
+
+from contrib.vk_utils import VK_USERS_GET_LIMIT, get_vk_small_photos
+
+# Через сутки аватарка считается устаревшей и обновляется в фоне
+AVATAR_FRESH_TIME = 60 * 60 * 24
+# Устаревшая аватарка показывается, пока ее не обновят, но не дольше месяца
+AVATAR_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+# Одну аватарку не обновляют чаще, чем раз в 10 минут
+AVATAR_REFRESH_TIMEOUT = 60 * 10
+
+
+def _avatar_key(vk_user_id: int) -> str:
+    return f'vk_avatar_50_{vk_user_id}'
+
+
+def _refresh_key(vk_user_id: int) -> str:
+    return f'vk_avatar_50_refresh_{vk_user_id}'
+
+
+def fetch_vk_avatars(vk_user_ids: Iterable[int]) -> Dict[int, str]:
+    """
+    Запросить аватарки у VK, по одному запросу на каждую 1000
+    пользователей, и положить их в кэш.
+
+    :param vk_user_ids: Идентификаторы пользователей VK
+    :return: Ссылки на аватарки по идентификатору пользователя, пустая
+        строка, если аватарки нет
+    """
+    vk_user_ids = list(vk_user_ids)
+    photos = {}
+    for i in range(0, len(vk_user_ids), VK_USERS_GET_LIMIT):
+        chunk = vk_user_ids[i:i + VK_USERS_GET_LIMIT]
+        chunk_photos = get_vk_small_photos(chunk)
+        photos.update({x: chunk_photos.get(x, '') for x in chunk})
+
+    fetched_at = time.time()
+    cache.set_many(
+        {
+            _avatar_key(vk_user_id): (photo, fetched_at)
+            for vk_user_id, photo in photos.items()
+        },
+        timeout=AVATAR_CACHE_TIMEOUT
+    )
+    return photos
+
+
+def _schedule_refresh(vk_user_ids: List[int]):
+    # Фоновые задачи выполняются в компании, поэтому без нее
+    # устаревшие аватарки обновятся на следующей странице компании
+    if not vk_user_ids or get_current_tenant() is None:
+        return
+
+    # Обновление каждой аватарки ставится в очередь только один раз
+    to_refresh = [
+        vk_user_id for vk_user_id in vk_user_ids
+        if cache.add(_refresh_key(vk_user_id), True, AVATAR_REFRESH_TIMEOUT)
+    ]
+    if to_refresh:
+        from gcp.tasks import enqueue
+        enqueue('refresh_vk_avatars', to_refresh)
+
+
+def get_vk_avatars(vk_user_ids: Iterable) -> Dict[int, str]:
+    """
+    Маленькие аватарки пользователей VK, нужные странице.
+
+    Аватарки из кэша возвращаются сразу, даже устаревшие: их обновление
+    ставится в фоновую задачу. У VK синхронно запрашиваются только
+    аватарки, которых еще нет в кэше, сразу для всей страницы.
+
+    :param vk_user_ids: Идентификаторы пользователей VK
+    :return: Ссылки на аватарки по идентификатору пользователя, пустая
+        строка, если аватарки нет
+    """
+    keys = {_avatar_key(int(x)): int(x) for x in set(vk_user_ids) if x}
+    cached = cache.get_many(keys)
+
+    photos = {}
+    stale = []
+    now = time.time()
+    for key, (photo, fetched_at) in cached.items():
+        photos[keys[key]] = photo
+        if now - fetched_at > AVATAR_FRESH_TIME:
+            stale.append(keys[key])
+
+    missing = [x for x in keys.values() if x not in photos]
+    if missing:
+        photos.update(fetch_vk_avatars(missing))
+    _schedule_refresh(stale)
+
+    return photos
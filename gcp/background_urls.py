@@ -4,6 +4,13 @@ from . import views
 
 urlpatterns = [
     path('google_task_handler/', views.google_task_handler, name='google-task-handler'),
+    path(
+        'outbox/dispatch',
+        views.dispatch_outbox_handler,
+        name='dispatch-outbox'
+    ),
+    path('outbox/purge', views.purge_outbox_handler, name='purge-outbox'),
+    path('tasks/stats', views.task_stats, name='task-stats'),
     path('', include('gcp.urls')),
 ]
 
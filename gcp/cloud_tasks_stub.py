@@ -0,0 +1,74 @@
+import json
+import threading
+from typing import Dict, List
+
+from google.api_core.exceptions import AlreadyExists
+
+
+class CloudTasksStub:
+    """
+    Local replacement of `tasks_v2beta3.CloudTasksClient` for tests.
+
+    Created tasks are recorded in `tasks`, task with existing name is
+    rejected with `AlreadyExists`, like in Cloud Tasks. Recorded tasks
+    are run by `run_tasks`, as task handler of App Engine runs them.
+
+    Usage::
+
+        stub = CloudTasksStub()
+        mocker.patch(
+            'gcp.tasks.tasks_v2beta3.CloudTasksClient', return_value=stub)
+    """
+
+    def __init__(self):
+        self.tasks: List[Dict] = []
+        self._names = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def queue_path(project: str, location: str, queue: str) -> str:
+        return f'projects/{project}/locations/{location}/queues/{queue}'
+
+    @classmethod
+    def task_path(
+        cls,
+        project: str,
+        location: str,
+        queue: str,
+        task: str
+    ) -> str:
+        return f'{cls.queue_path(project, location, queue)}/tasks/{task}'
+
+    def create_task(self, parent: str, task: Dict) -> Dict:
+        # Tasks are created from several threads
+        with self._lock:
+            name = task.get('name')
+            if name in self._names:
+                raise AlreadyExists(f'Task {name} already exists')
+            if name:
+                self._names.add(name)
+            self.tasks.append({**task, 'parent': parent})
+        return task
+
+    def payloads(self) -> List[Dict]:
+        """Payloads of created tasks, in order of creation"""
+        with self._lock:
+            tasks = list(self.tasks)
+        return [
+            json.loads(task['app_engine_http_request']['body'].decode())
+            for task in tasks
+        ]
+
+    def run_tasks(self) -> List[str]:
+        """
+        Run created tasks with task handler and forget them.
+
+        :return: Results of task handler
+        """
+        # Imported here, as tasks module imports all tasks and models
+        from gcp.tasks import do
+
+        payloads = self.payloads()
+        with self._lock:
+            self.tasks.clear()
+        return [do(json.dumps(payload).encode()) for payload in payloads]
@@ -0,0 +1,72 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from gcp.worker import TaskWorker
+
+
+class Command(BaseCommand):
+    help = (
+        'Выполнять фоновые задачи из очереди без Google Cloud Tasks. '
+        'Для отправки задач в обработчик нужна настройка USE_TASK_WORKER.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Количество потоков, выполняющих задачи',
+        )
+        parser.add_argument(
+            '--per-company',
+            type=int,
+            default=2,
+            help='Сколько задач одной компании выполняются одновременно',
+        )
+        parser.add_argument(
+            '--lease',
+            type=int,
+            default=300,
+            help=(
+                'Через сколько секунд задача, не выполненная обработчиком, '
+                'будет отдана другому'
+            ),
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1,
+            help='Как часто в секундах проверять новые задачи',
+        )
+        parser.add_argument(
+            '--stats-interval',
+            type=float,
+            default=300,
+            help='Как часто в секундах писать в лог статистику задач',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Выполнить готовые задачи и завершиться',
+        )
+
+    def handle(
+        self,
+        *args,
+        workers,
+        per_company,
+        lease,
+        poll_interval,
+        stats_interval,
+        once,
+        **options
+    ):
+        worker = TaskWorker(
+            workers=workers,
+            per_company=per_company,
+            lease=timedelta(seconds=lease),
+            stats_interval=stats_interval
+        )
+        self.stdout.write(f'Обработчик задач запущен, потоков: {workers}')
+        worker.run(poll_interval=poll_interval, stop_when_idle=once)
@@ -0,0 +1,35 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:38
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('idempotency_key', models.UUIDField(default=uuid.uuid4, unique=True, verbose_name='Ключ идемпотентности')),
+                ('payload', django.contrib.postgres.fields.jsonb.JSONField(verbose_name='Данные задачи')),
+                ('status', models.CharField(choices=[('pending', 'Ожидает отправки'), ('done', 'Отправлена'), ('failed', 'Не отправлена')], default='pending', max_length=16, verbose_name='Состояние')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Попыток отправки')),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Следующая попытка')),
+                ('last_error', models.TextField(blank=True, verbose_name='Последняя ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('dispatched_at', models.DateTimeField(blank=True, null=True, verbose_name='Дата отправки')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxtask',
+            index_together={('status', 'next_attempt_at')},
+        ),
+    ]
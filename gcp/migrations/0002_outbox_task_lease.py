@@ -0,0 +1,18 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gcp', '0001_outbox_task'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxtask',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Занята обработчиком до'),
+        ),
+    ]
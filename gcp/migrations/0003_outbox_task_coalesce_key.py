@@ -0,0 +1,22 @@
+# Generated by Django 2.1.7 on 2026-10-18 11:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gcp', '0002_outbox_task_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxtask',
+            name='coalesce_key',
+            field=models.CharField(blank=True, max_length=255, verbose_name='Ключ объединения'),
+        ),
+        migrations.AlterIndexTogether(
+            name='outboxtask',
+            index_together={('status', 'next_attempt_at'), ('coalesce_key', 'status')},
+        ),
+    ]
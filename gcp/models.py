@@ -1,3 +1,48 @@
+import uuid
+
+from django.contrib.postgres.fields import JSONField
 from django.db import models
+from django.utils import timezone
+from extended_choices import Choices
+
+OUTBOX_STATUS = Choices(
+    ('PENDING', 'pending', 'Ожидает отправки'),
+    ('DONE', 'done', 'Отправлена'),
+    ('FAILED', 'failed', 'Не отправлена'),
+)
+
+
+class OutboxTask(models.Model):
+    """
+    Task, enqueued in transaction. It is written in the same transaction
+    as the work it belongs to, and is dispatched only after commit.
+    """
+    idempotency_key = models.UUIDField(
+        'Ключ идемпотентности', default=uuid.uuid4, unique=True)
+    payload = JSONField('Данные задачи')
+    coalesce_key = models.CharField(
+        'Ключ объединения', max_length=255, blank=True)
+    status = models.CharField(
+        'Состояние',
+        max_length=16,
+        choices=OUTBOX_STATUS,
+        default=OUTBOX_STATUS.PENDING
+    )
+    attempts = models.PositiveIntegerField('Попыток отправки', default=0)
+    next_attempt_at = models.DateTimeField(
+        'Следующая попытка', default=timezone.now)
+    last_error = models.TextField('Последняя ошибка', blank=True)
+    leased_until = models.DateTimeField(
+        'Занята обработчиком до', null=True, blank=True)
+    created_at = models.DateTimeField('Дата создания', auto_now_add=True)
+    dispatched_at = models.DateTimeField(
+        'Дата отправки', null=True, blank=True)
+
+    class Meta:
+        index_together = [
+            ('status', 'next_attempt_at'),
+            ('coalesce_key', 'status'),
+        ]
 
-# Create your models here.
+    def __str__(self):
+        return f'{self.payload.get("method")} ({self.idempotency_key})'
@@ -0,0 +1,99 @@
+"""Registry of tasks, enqueued by name, and statistics of their runs"""
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.utils import timezone
+
+# Length of error, kept in statistics
+ERROR_MAX_LENGTH = 500
+
+_tasks: Dict[str, Callable] = {}
+
+
+def task(func: Callable) -> Callable:
+    """
+    Register function as task, which can be enqueued by its name.
+
+    Usage::
+
+        @task
+        def notify_client_balance(client_id: int):
+            ...
+
+        enqueue('notify_client_balance', client.id)
+    """
+    name = func.__name__
+    registered = _tasks.get(name)
+    if registered and registered.__module__ != func.__module__:
+        raise ValueError(
+            f'Task "{name}" is already registered in {registered.__module__}')
+    _tasks[name] = func
+    return func
+
+
+def get_task(name: str) -> Optional[Callable]:
+    return _tasks.get(name)
+
+
+@dataclass
+class TaskStats:
+    """Statistics of runs of one task for one company"""
+    calls: int = 0
+    failures: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    last_error: str = ''
+    last_error_at: Optional[datetime] = None
+
+    @property
+    def avg_time(self) -> float:
+        return self.total_time / self.calls if self.calls else 0.0
+
+
+# Statistics by task name and company id, since start of process
+_stats: Dict[Tuple[str, Optional[int]], TaskStats] = {}
+_stats_lock = threading.Lock()
+
+
+def record_task_run(
+    name: str,
+    company_id: Optional[int],
+    duration: float,
+    error: Optional[Exception] = None
+):
+    """
+    Add run of task to statistics.
+
+    :param duration: Run time in seconds
+    :param error: Exception, raised by task
+    """
+    with _stats_lock:
+        stats = _stats.setdefault((name, company_id), TaskStats())
+        stats.calls += 1
+        stats.total_time += duration
+        stats.max_time = max(stats.max_time, duration)
+        if error is not None:
+            stats.failures += 1
+            stats.last_error = repr(error)[:ERROR_MAX_LENGTH]
+            stats.last_error_at = timezone.now()
+
+
+def get_task_stats() -> List[Tuple[str, Optional[int], TaskStats]]:
+    """
+    Copy of statistics of tasks in this process, slowest tasks first.
+
+    :return: Task name, company id and statistics of task runs
+    """
+    with _stats_lock:
+        stats = [
+            (name, company_id, TaskStats(**vars(task_stats)))
+            for (name, company_id), task_stats in _stats.items()
+        ]
+    return sorted(stats, key=lambda item: item[2].total_time, reverse=True)
+
+
+def reset_task_stats():
+    with _stats_lock:
+        _stats.clear()
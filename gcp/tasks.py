@@ -1,58 +1,465 @@
 """Create a task for a given queue with an arbitrary payload."""
 import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, QuerySet
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from django_multitenant.utils import set_current_tenant, get_current_tenant
+from google.api_core.exceptions import AlreadyExists
 from google.cloud import tasks_v2beta3
 
-import bot.api.messageHandler
-import bot.tasks
+# Tasks are registered on import of their modules
+import bot.api.messageHandler  # noqa: F401
+import bot.tasks  # noqa: F401
+from contrib.db_utils import bulk_update
 from crm.models import Company
+from gcp import registry
+from gcp.models import OUTBOX_STATUS, OutboxTask
+from gcp.registry import get_task, record_task_run
 
+logger = logging.getLogger('gcp.tasks')
 
-def enqueue(method: str, *args, **kwargs):
+# Outbox tasks are dispatched by batches of this size
+OUTBOX_BATCH_SIZE = 100
+# After this number of failed attempts task is not dispatched anymore
+OUTBOX_MAX_ATTEMPTS = 10
+# Delay before retry of failed task, doubled after every attempt
+OUTBOX_RETRY_DELAY = timedelta(seconds=30)
+OUTBOX_MAX_RETRY_DELAY = timedelta(hours=1)
+# Dispatcher leases tasks for this time, so others skip them
+OUTBOX_LEASE = timedelta(minutes=5)
+# Dispatched tasks are kept for this time, then purged by cron
+OUTBOX_KEEP_DONE = timedelta(days=7)
+# Tasks of outbox batch are sent to Cloud Tasks by this number of threads
+CLOUD_TASKS_SEND_WORKERS = 8
+# Fields of task, changed by finish_task
+OUTBOX_RESULT_FIELDS = [
+    'status',
+    'attempts',
+    'next_attempt_at',
+    'last_error',
+    'dispatched_at',
+    'leased_until',
+]
 
+# Seconds, for which company of task is cached by process
+COMPANY_CACHE_TIMEOUT = 60
+
+_dispatching = threading.local()
+# Expiration time and company by company id
+_companies: Dict[int, Tuple[float, Company]] = {}
+
+# Cloud Tasks client and queue path by project, location and queue
+_queues: Dict[Tuple[str, str, str], Tuple[object, str]] = {}
+_queues_lock = threading.Lock()
+
+
+def get_tasks_queue() -> Tuple[tasks_v2beta3.CloudTasksClient, str]:
+    """
+    Cloud Tasks client and fully qualified name of queue from settings.
+
+    Client is shared by all threads of process, so its gRPC channel is
+    reused between requests.
+    """
+    key = (
+        settings.GCP_TASK_PROJECT,
+        settings.GCP_TASK_LOCATION,
+        settings.GCP_TASK_QUEUE,
+    )
+    with _queues_lock:
+        if key not in _queues:
+            client = tasks_v2beta3.CloudTasksClient()
+            _queues[key] = (client, client.queue_path(*key))
+        return _queues[key]
+
+
+def enqueue(method: str, *args, **kwargs) -> OutboxTask:
+    """
+    Enqueue task in outbox.
+
+    Task is written in current transaction and dispatched after commit,
+    so rolled back work doesn't run tasks.
+    """
+    tenant = get_current_tenant()
     payload = {'method': method,
                'args': args,
                'kwargs': kwargs,
-               'company_id': get_current_tenant().id
+               'company_id': tenant.id if tenant else None
                }
 
-    # The API expects a payload of type bytes.
-    json_payload = json.dumps(payload)
+    # Payload is stored as JSON, so arguments are checked right here
+    task = OutboxTask.objects.create(payload=json.loads(json.dumps(payload)))
+    transaction.on_commit(lambda: dispatch_outbox([task.id]))
+    return task
 
-    converted_payload = json_payload.encode()
 
-    if settings.USE_GOOGLE_TASKS:
+def enqueue_many(
+    method: str,
+    args_list: Iterable[Sequence]
+) -> List[OutboxTask]:
+    """
+    Enqueue task for every list of arguments, like fan-out of
+    notifications by chunks of recipients.
 
-        project = settings.GCP_TASK_PROJECT
-        queue = settings.GCP_TASK_QUEUE
-        location = settings.GCP_TASK_LOCATION
+    Tasks are written with one query and dispatched after commit, like
+    tasks of `enqueue`; Cloud Tasks receives them concurrently.
 
-        client = tasks_v2beta3.CloudTasksClient()
+    :param method: Name of task to call
+    :param args_list: Positional arguments of every task
+    """
+    tenant = get_current_tenant()
+    tasks = [
+        OutboxTask(payload=json.loads(json.dumps({
+            'method': method,
+            'args': args,
+            'kwargs': {},
+            'company_id': tenant.id if tenant else None,
+        })))
+        for args in args_list
+    ]
+    if not tasks:
+        return []
+
+    tasks = OutboxTask.objects.bulk_create(tasks)
+    transaction.on_commit(
+        lambda: dispatch_outbox([task.id for task in tasks]))
+    return tasks
+
+
+def enqueue_coalesced(
+    coalesce_key: str,
+    combiner: str,
+    method: str,
+    *args
+) -> OutboxTask:
+    """
+    Enqueue task, which may be combined with other tasks of the same key.
+
+    Tasks of one key, enqueued in the same transaction or within
+    `TASK_COALESCE_WINDOW` seconds, while first of them is not
+    dispatched, are collapsed into one call of `combiner` task. It gets
+    list of `[method, args]` calls, without repeated ones, in order of
+    enqueue.
+
+    :param coalesce_key: Key of tasks to combine, like `client-1`
+    :param combiner: Name of task, which runs combined calls
+    :param method: Name of task to call
+    """
+    call = [method, json.loads(json.dumps(args))]
+    with transaction.atomic():
+        # Task, taken by dispatcher, is not changed, new one is created
+        task = (
+            OutboxTask.objects
+            .select_for_update(skip_locked=True)
+            .filter(
+                coalesce_key=coalesce_key,
+                status=OUTBOX_STATUS.PENDING,
+                attempts=0,
+                leased_until__isnull=True,
+            )
+            .order_by('id')
+            .first()
+        )
+        if task and task.payload['method'] == combiner:
+            calls = task.payload['args'][0]
+            if call not in calls:
+                calls.append(call)
+                task.save(update_fields=['payload'])
+            return task
+
+        tenant = get_current_tenant()
+        task = OutboxTask.objects.create(
+            payload={
+                'method': combiner,
+                'args': [[call]],
+                'kwargs': {},
+                'company_id': tenant.id if tenant else None,
+            },
+            coalesce_key=coalesce_key,
+            next_attempt_at=timezone.now() + timedelta(
+                seconds=settings.TASK_COALESCE_WINDOW),
+        )
+    if settings.USE_GOOGLE_TASKS and settings.TASK_COALESCE_WINDOW:
+        transaction.on_commit(lambda: _schedule_dispatch(task))
+    else:
+        transaction.on_commit(lambda: dispatch_outbox([task.id]))
+    return task
 
-        # Construct the fully qualified queue name.
-        parent = client.queue_path(project, location, queue)
 
-        # Construct the request body.
-        task = {
-            'app_engine_http_request': {  # Specify the type of request.
-                'http_method': 'POST',
-                'relative_uri': '/google_task_handler/'
-            }
+def _create_cloud_task(
+    client,
+    parent: str,
+    name: str,
+    payload: dict,
+    schedule_time: Optional[datetime] = None
+):
+    task = {
+        # Cloud Tasks rejects task with existing name, so task sent again
+        # after failed dispatch is not run twice
+        'name': client.task_path(
+            settings.GCP_TASK_PROJECT,
+            settings.GCP_TASK_LOCATION,
+            settings.GCP_TASK_QUEUE,
+            name
+        ),
+        'app_engine_http_request': {
+            'http_method': 'POST',
+            'relative_uri': '/google_task_handler/',
+            'body': json.dumps(payload).encode(),
         }
-        # Add the payload to the request.
-        task['app_engine_http_request']['body'] = converted_payload
+    }
+    if schedule_time:
+        task['schedule_time'] = {
+            'seconds': math.ceil(schedule_time.timestamp())}
+    try:
+        client.create_task(parent, task)
+    except AlreadyExists:
+        pass
 
-        # Use the client to build and send the task.
-        response = client.create_task(parent, task)
+
+def _send_cloud_task(client, parent: str, task: OutboxTask):
+    _create_cloud_task(
+        client,
+        parent,
+        task.idempotency_key.hex,
+        {**task.payload, 'task_id': str(task.idempotency_key)}
+    )
+
+
+def _schedule_dispatch(task: OutboxTask):
+    """
+    Create delayed Cloud Task, which dispatches outbox task, when it is
+    due, so delayed task doesn't wait for retry cron.
+    """
+    try:
+        client, parent = get_tasks_queue()
+        _create_cloud_task(
+            client,
+            parent,
+            f'{task.idempotency_key.hex}-dispatch',
+            {
+                'method': 'dispatch_outbox_tasks',
+                'args': [[task.id]],
+                'kwargs': {},
+                'company_id': None,
+            },
+            schedule_time=task.next_attempt_at
+        )
+    except Exception:
+        # Task is still dispatched by retry cron
+        logger.exception('Dispatch of task %s is not scheduled', task)
+
+
+@registry.task
+def dispatch_outbox_tasks(ids: List[int]):
+    """Dispatch outbox tasks, run by Cloud Task, scheduled for them"""
+    dispatch_outbox(ids)
+    not_due = OutboxTask.objects.filter(
+        id__in=ids,
+        status=OUTBOX_STATUS.PENDING,
+        attempts=0,
+        next_attempt_at__gt=timezone.now(),
+    )
+    if not_due.exists():
+        # Cloud Task ran a bit earlier, it is retried by Cloud Tasks
+        raise RuntimeError(f'Outbox tasks {ids} are not due yet')
+
+
+def finish_task(task: OutboxTask, error: Optional[Exception]):
+    """
+    Save result of dispatch attempt in task: mark it done or schedule
+    retry. Changed fields are listed in `OUTBOX_RESULT_FIELDS`.
+    """
+    task.attempts += 1
+    task.leased_until = None
+    if error is None:
+        task.status = OUTBOX_STATUS.DONE
+        task.dispatched_at = timezone.now()
+        return
+
+    task.last_error = repr(error)
+    if task.attempts >= OUTBOX_MAX_ATTEMPTS:
+        task.status = OUTBOX_STATUS.FAILED
     else:
-        do_result = do(converted_payload)
+        task.next_attempt_at = timezone.now() + min(
+            OUTBOX_RETRY_DELAY * 2 ** (task.attempts - 1),
+            OUTBOX_MAX_RETRY_DELAY
+        )
+
+
+def run_task(task: OutboxTask):
+    # Failed task rolls back only its own work
+    with transaction.atomic():
+        do_result = do(json.dumps(task.payload).encode())
         if not do_result == 'OK':
             raise RuntimeError(f'DO result: {do_result}')
 
 
+def due_tasks(now: datetime) -> QuerySet:
+    """
+    Pending tasks, which should be dispatched now, locked for update.
+    Tasks, locked by other dispatcher or leased by worker, are skipped.
+    """
+    return (
+        OutboxTask.objects
+        .select_for_update(skip_locked=True)
+        .filter(status=OUTBOX_STATUS.PENDING, next_attempt_at__lte=now)
+        .filter(Q(leased_until__isnull=True) | Q(leased_until__lt=now))
+        .order_by('id')
+    )
+
+
+def lease_tasks(tasks: List[OutboxTask], lease: timedelta):
+    """Lease locked tasks, so other dispatchers and workers skip them"""
+    leased_until = timezone.now() + lease
+    for task in tasks:
+        task.leased_until = leased_until
+    bulk_update(OutboxTask.objects, tasks, ['leased_until'])
+
+
+def complete_task(task: OutboxTask, error: Optional[Exception]) -> bool:
+    """
+    Save result of leased task with `finish_task`.
+
+    :return: False, if lease has expired and task is taken by other
+        dispatcher, so result is not saved
+    """
+    leased_until = task.leased_until
+    finish_task(task, error)
+    saved = OutboxTask.objects.filter(
+        id=task.id, leased_until=leased_until
+    ).update(**{field: getattr(task, field) for field in OUTBOX_RESULT_FIELDS})
+    if not saved:
+        logger.warning('Lease of task %s has expired, result is lost', task)
+    return bool(saved)
+
+
+def _lease_batch(ids: Optional[Sequence[int]]) -> List[OutboxTask]:
+    with transaction.atomic():
+        tasks = due_tasks(timezone.now())
+        if ids is not None:
+            tasks = tasks.filter(id__in=ids)
+        tasks = list(tasks[:OUTBOX_BATCH_SIZE])
+        lease_tasks(tasks, OUTBOX_LEASE)
+    return tasks
+
+
+def _send_cloud_tasks(tasks: List[OutboxTask]):
+    client, parent = get_tasks_queue()
+
+    def send(task: OutboxTask) -> Optional[Exception]:
+        try:
+            _send_cloud_task(client, parent, task)
+        except Exception as exc:
+            return exc
+        return None
+
+    with ThreadPoolExecutor(
+        max_workers=min(len(tasks), CLOUD_TASKS_SEND_WORKERS)
+    ) as executor:
+        errors = list(executor.map(send, tasks))
+    # Results are saved by connection of dispatcher thread
+    for task, error in zip(tasks, errors):
+        complete_task(task, error)
+
+
+def _run_tasks(tasks: List[OutboxTask]):
+    for task in tasks:
+        error = None
+        try:
+            run_task(task)
+        except Exception as exc:
+            logger.exception('Task %s failed', task)
+            error = exc
+        complete_task(task, error)
+
+
+def _dispatch(ids: Optional[Sequence[int]]) -> int:
+    dispatched = 0
+    while True:
+        # Every task is leased, run and saved in its own transaction, so
+        # failed save doesn't make other tasks of batch run again
+        tasks = _lease_batch(ids)
+        if not tasks:
+            return dispatched
+
+        if settings.USE_GOOGLE_TASKS:
+            _send_cloud_tasks(tasks)
+        else:
+            _run_tasks(tasks)
+        dispatched += len(tasks)
+
+
+def dispatch_outbox(ids: Optional[Sequence[int]] = None) -> int:
+    """
+    Dispatch due outbox tasks, by batches: send them to Cloud Tasks or,
+    when it is not used, run them in place.
+
+    :param ids: Dispatch only these tasks, like tasks of committed
+        transaction. All due tasks are dispatched by default
+    :return: Number of dispatched tasks, including failed
+    """
+    if settings.USE_TASK_WORKER and not settings.USE_GOOGLE_TASKS:
+        # Tasks are run by worker, see run_task_worker command
+        return 0
+    nested_ids = getattr(_dispatching, 'ids', None)
+    if nested_ids is not None:
+        # Tasks, enqueued by running task, are dispatched by outer call
+        if ids is not None:
+            nested_ids.extend(ids)
+        return 0
+
+    tenant = get_current_tenant()
+    _dispatching.ids = []
+    try:
+        dispatched = _dispatch(ids)
+        while _dispatching.ids:
+            nested_ids, _dispatching.ids = _dispatching.ids, []
+            dispatched += _dispatch(nested_ids)
+        return dispatched
+    finally:
+        _dispatching.ids = None
+        # Running tasks switch tenant
+        set_current_tenant(tenant)
+
+
+def purge_outbox(older_than: timedelta = OUTBOX_KEEP_DONE) -> int:
+    """
+    Delete tasks, dispatched earlier than `older_than` ago.
+
+    :return: Number of deleted tasks
+    """
+    deleted, _ = OutboxTask.objects.filter(
+        status=OUTBOX_STATUS.DONE,
+        dispatched_at__lt=timezone.now() - older_than,
+    ).delete()
+    return deleted
+
+
+def get_task_company(company_id: int) -> Company:
+    """
+    Company of task. Companies are cached by process for
+    `COMPANY_CACHE_TIMEOUT`, as every task switches tenant.
+    """
+    now = time.monotonic()
+    cached = _companies.get(company_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    company = get_object_or_404(Company, pk=company_id)
+    _companies[company_id] = (now + COMPANY_CACHE_TIMEOUT, company)
+    return company
+
+
 def do(body_payload: bytes) -> str:
 
     payload = json.loads(body_payload.decode())
@@ -63,21 +470,19 @@ def do(body_payload: bytes) -> str:
 
     args = payload['args']
     kwargs = payload['kwargs']
-    modules = {bot.tasks, bot.api.messageHandler}
-    if company_id:
-        company = get_object_or_404(Company, pk=company_id)
-        set_current_tenant(company)
+    method_to_call = get_task(method)
+    if not method_to_call:
+        return f'ERROR: no task "{method}" registered'
 
-    method_to_call = None
-
-    for module in modules:
-        if hasattr(module, method):
-            method_to_call = getattr(module, method)
+    if company_id:
+        set_current_tenant(get_task_company(company_id))
 
-    if method_to_call:
+    started_at = time.monotonic()
+    try:
         method_to_call(*args, **kwargs)
-        return 'OK'
-    else:
-        return f'ERROR: no method "{method}" in modules'
-
-
+    except Exception as exc:
+        record_task_run(
+            method, company_id, time.monotonic() - started_at, exc)
+        raise
+    record_task_run(method, company_id, time.monotonic() - started_at)
+    return 'OK'
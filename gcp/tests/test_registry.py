@@ -0,0 +1,93 @@
+import json
+
+import pytest
+from hamcrest import (
+    assert_that, calling, contains, contains_inanyorder, contains_string,
+    has_entries, has_properties, is_, raises,
+)
+from pytest_mock import MockFixture
+
+from gcp import views
+from gcp.registry import get_task_stats, task
+from gcp.tasks import do
+
+
+@pytest.fixture(autouse=True)
+def registry(mocker: MockFixture):
+    mocker.patch.dict('gcp.registry._tasks', clear=True)
+    mocker.patch.dict('gcp.registry._stats', clear=True)
+
+
+def payload(method: str, *args, company_id=None) -> bytes:
+    return json.dumps({
+        'method': method,
+        'args': args,
+        'kwargs': {},
+        'company_id': company_id,
+    }).encode()
+
+
+def test_task_registered_by_name():
+    calls = []
+
+    @task
+    def notify(value):
+        calls.append(value)
+
+    assert_that(do(payload('notify', 1)), is_('OK'))
+    assert_that(calls, contains(1))
+    assert_that(
+        do(payload('unknown')), is_('ERROR: no task "unknown" registered'))
+
+
+def test_task_name_is_unique():
+    task(json.dumps)
+
+    def dumps():
+        pass
+
+    assert_that(
+        calling(task).with_args(dumps),
+        raises(ValueError, 'already registered in json')
+    )
+
+
+@pytest.mark.django_db
+def test_task_stats(company_factory, rf, django_assert_num_queries):
+    company = company_factory()
+
+    @task
+    def notify(fail):
+        if fail:
+            raise RuntimeError('VK is down')
+
+    do(payload('notify', False, company_id=company.id))
+    with pytest.raises(RuntimeError):
+        # Company is cached after first task
+        with django_assert_num_queries(0):
+            do(payload('notify', True, company_id=company.id))
+    do(payload('notify', False))
+
+    assert_that(get_task_stats(), contains_inanyorder(
+        contains('notify', company.id, has_properties(
+            calls=2,
+            failures=1,
+            last_error=contains_string('VK is down'),
+        )),
+        contains('notify', None, has_properties(calls=1, failures=0)),
+    ))
+    response = views.task_stats(
+        rf.get('/tasks/stats', HTTP_X_APPENGINE_CRON='true'))
+    assert_that(json.loads(response.content)['tasks'], contains_inanyorder(
+        has_entries(name='notify', company_id=company.id, calls=2),
+        has_entries(name='notify', company_id=None, calls=1),
+    ))
+
+
+def test_task_stats_for_cron_and_staff_only(rf, mocker: MockFixture):
+    request = rf.get('/tasks/stats')
+    request.user = mocker.Mock(is_staff=False)
+    assert_that(views.task_stats(request).status_code, is_(403))
+
+    request.user.is_staff = True
+    assert_that(views.task_stats(request).status_code, is_(200))
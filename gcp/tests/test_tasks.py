@@ -0,0 +1,375 @@
+from datetime import timedelta
+
+import pytest
+from django.db import transaction
+from django.utils import timezone
+from freezegun import freeze_time
+from hamcrest import (
+    assert_that, contains, contains_inanyorder, contains_string,
+    greater_than, has_entries, has_length, has_properties, is_, is_not,
+    none, only_contains,
+)
+from pytest_mock import MockFixture
+
+from gcp import views
+from gcp.models import OUTBOX_STATUS, OutboxTask
+from gcp.tasks import (
+    complete_task, dispatch_outbox, dispatch_outbox_tasks, enqueue,
+    enqueue_coalesced, enqueue_many, purge_outbox,
+)
+
+
+@pytest.fixture
+def task(mocker: MockFixture):
+    task = mocker.Mock()
+    mocker.patch.dict('gcp.registry._tasks', notify_client_balance=task)
+    return task
+
+
+@pytest.mark.django_db(transaction=True)
+def test_task_run_after_commit(task, company_factory):
+    company = company_factory()
+
+    with transaction.atomic():
+        enqueue('notify_client_balance', 1)
+        task.assert_not_called()
+
+    task.assert_called_once_with(1)
+    assert_that(OutboxTask.objects.get(), has_properties(
+        status=OUTBOX_STATUS.DONE,
+        attempts=1,
+        payload=has_entries(
+            method='notify_client_balance',
+            args=[1],
+            company_id=company.id
+        ),
+    ))
+
+
+@pytest.mark.django_db(transaction=True)
+def test_rolled_back_task_not_run(task, company_factory):
+    company_factory()
+    with pytest.raises(ValueError):
+        with transaction.atomic():
+            enqueue('notify_client_balance', 1)
+            raise ValueError()
+
+    dispatch_outbox()
+
+    task.assert_not_called()
+    assert_that(OutboxTask.objects.all(), has_length(0))
+
+
+@pytest.mark.django_db
+def test_request_dispatches_own_tasks(task, company_factory):
+    company_factory()
+    # Task of other request, left for retry by cron
+    other = OutboxTask.objects.create(payload={
+        'method': 'notify_client_balance',
+        'args': [2],
+        'kwargs': {},
+        'company_id': None,
+    })
+
+    enqueue('notify_client_balance', 1)
+
+    task.assert_called_once_with(1)
+    other.refresh_from_db()
+    assert_that(other.status, is_(OUTBOX_STATUS.PENDING))
+
+    # Cron dispatches all due tasks
+    assert_that(dispatch_outbox(), is_(1))
+    task.assert_called_with(2)
+
+
+@pytest.mark.django_db
+def test_task_enqueued_by_task_dispatched(
+    task,
+    company_factory,
+    mocker: MockFixture
+):
+    company_factory()
+    mocker.patch.dict(
+        'gcp.registry._tasks',
+        notify_client=lambda: enqueue('notify_client_balance', 1)
+    )
+
+    enqueue('notify_client')
+
+    task.assert_called_once_with(1)
+    assert_that(
+        OutboxTask.objects.all(),
+        only_contains(has_properties(status=OUTBOX_STATUS.DONE))
+    )
+
+
+@pytest.mark.django_db
+def test_result_of_expired_lease_not_saved(task, company_factory):
+    company_factory()
+    outbox_task = enqueue('notify_client_balance', 1)
+    outbox_task.refresh_from_db()
+    # Lease expired, and other dispatcher took the task
+    outbox_task.status = OUTBOX_STATUS.PENDING
+    outbox_task.leased_until = timezone.now()
+    OutboxTask.objects.filter(id=outbox_task.id).update(
+        leased_until=timezone.now() + timedelta(minutes=5))
+
+    assert_that(complete_task(outbox_task, None), is_(False))
+
+    outbox_task.refresh_from_db()
+    assert_that(outbox_task.leased_until, is_not(none()))
+
+
+@pytest.mark.django_db
+def test_purge_outbox(task, company_factory):
+    company_factory()
+    with freeze_time(timezone.now() - timedelta(days=8)):
+        old = enqueue('notify_client_balance', 1)
+        task.side_effect = RuntimeError()
+        failed = enqueue('notify_client_balance', 2)
+    task.side_effect = None
+    recent = enqueue('notify_client_balance', 3)
+
+    assert_that(purge_outbox(), is_(1))
+
+    assert_that(
+        OutboxTask.objects.values_list('id', flat=True),
+        contains_inanyorder(failed.id, recent.id)
+    )
+    assert_that(OutboxTask.objects.filter(id=old.id).exists(), is_(False))
+
+
+@pytest.mark.django_db
+def test_failed_task_retried(task, company_factory):
+    company_factory()
+    task.side_effect = RuntimeError('VK is down')
+
+    outbox_task = enqueue('notify_client_balance', 1)
+
+    outbox_task.refresh_from_db()
+    assert_that(outbox_task, has_properties(
+        status=OUTBOX_STATUS.PENDING,
+        attempts=1,
+        last_error=contains_string('VK is down'),
+        next_attempt_at=greater_than(timezone.now()),
+    ))
+
+    # Task is not retried until its delay passes
+    dispatch_outbox()
+    assert_that(task.call_count, is_(1))
+
+    task.side_effect = None
+    with freeze_time(timezone.now() + timedelta(minutes=1)):
+        assert_that(dispatch_outbox(), is_(1))
+
+    outbox_task.refresh_from_db()
+    assert_that(outbox_task, has_properties(
+        status=OUTBOX_STATUS.DONE,
+        attempts=2,
+    ))
+
+
+@pytest.mark.django_db
+def test_task_failed_after_max_attempts(
+    task,
+    company_factory,
+    mocker: MockFixture
+):
+    company_factory()
+    mocker.patch('gcp.tasks.OUTBOX_MAX_ATTEMPTS', 1)
+    task.side_effect = RuntimeError()
+
+    outbox_task = enqueue('notify_client_balance', 1)
+
+    outbox_task.refresh_from_db()
+    assert_that(outbox_task.status, is_(OUTBOX_STATUS.FAILED))
+
+
+@pytest.mark.django_db
+def test_cloud_task_created_once(company_factory, cloud_tasks, task):
+    company_factory()
+    outbox_task = enqueue('notify_client_balance', 1)
+    # Task was created by previous dispatch, which failed to save it
+    OutboxTask.objects.filter(id=outbox_task.id).update(
+        status=OUTBOX_STATUS.PENDING)
+    dispatch_outbox()
+
+    outbox_task.refresh_from_db()
+    assert_that(outbox_task.status, is_(OUTBOX_STATUS.DONE))
+    assert_that(cloud_tasks.tasks, contains(has_entries(
+        name=(
+            'projects/project/locations/location/queues/queue/tasks/'
+            f'{outbox_task.idempotency_key.hex}'
+        ),
+    )))
+    assert_that(cloud_tasks.payloads(), contains(has_entries(
+        task_id=str(outbox_task.idempotency_key))))
+
+    assert_that(cloud_tasks.run_tasks(), contains('OK'))
+    task.assert_called_once_with(1)
+
+
+@pytest.mark.django_db
+def test_cloud_tasks_client_reused(
+    company_factory,
+    cloud_tasks,
+    mocker: MockFixture
+):
+    company_factory()
+    client_class = mocker.patch(
+        'gcp.tasks.tasks_v2beta3.CloudTasksClient', return_value=cloud_tasks)
+
+    enqueue('notify_client_balance', 1)
+    enqueue('notify_client_balance', 2)
+
+    assert_that(client_class.call_count, is_(1))
+    assert_that(cloud_tasks.tasks, has_length(2))
+
+
+@pytest.mark.django_db
+def test_enqueue_many(company_factory, cloud_tasks, task):
+    company = company_factory()
+
+    with transaction.atomic():
+        outbox_tasks = enqueue_many(
+            'notify_client_balance', [(client_id,) for client_id in range(20)])
+        enqueue_many('notify_client_balance', [])
+
+    assert_that(outbox_tasks, has_length(20))
+    assert_that(
+        OutboxTask.objects.all(),
+        only_contains(has_properties(status=OUTBOX_STATUS.DONE))
+    )
+    assert_that(
+        cloud_tasks.payloads(),
+        contains_inanyorder(*[
+            has_entries(
+                method='notify_client_balance',
+                args=[client_id],
+                company_id=company.id
+            )
+            for client_id in range(20)
+        ])
+    )
+
+    cloud_tasks.run_tasks()
+    assert_that(
+        [call[0][0] for call in task.call_args_list],
+        contains_inanyorder(*range(20))
+    )
+
+
+@pytest.fixture
+def combiner(mocker: MockFixture):
+    combiner = mocker.Mock()
+    mocker.patch.dict('gcp.registry._tasks', notify_client=combiner)
+    return combiner
+
+
+@pytest.mark.django_db(transaction=True)
+def test_coalesced_tasks_combined_in_transaction(combiner, company_factory):
+    company_factory()
+
+    with transaction.atomic():
+        enqueue_coalesced(
+            'client-1', 'notify_client', 'notify_client_balance', 1)
+        enqueue_coalesced(
+            'client-1', 'notify_client', 'notify_client_buy_subscription', 2)
+        # Repeated call is sent once
+        enqueue_coalesced(
+            'client-1', 'notify_client', 'notify_client_balance', 1)
+        enqueue_coalesced(
+            'client-2', 'notify_client', 'notify_client_balance', 2)
+
+    assert_that(
+        [call[0][0] for call in combiner.call_args_list],
+        contains_inanyorder(
+            [
+                ['notify_client_balance', [1]],
+                ['notify_client_buy_subscription', [2]],
+            ],
+            [['notify_client_balance', [2]]],
+        )
+    )
+    assert_that(OutboxTask.objects.all(), has_length(2))
+
+
+@pytest.mark.django_db
+def test_coalesced_tasks_wait_for_window(
+    combiner,
+    company_factory,
+    settings
+):
+    company_factory()
+    settings.TASK_COALESCE_WINDOW = 30
+
+    first = enqueue_coalesced(
+        'client-1', 'notify_client', 'notify_client_balance', 1)
+    second = enqueue_coalesced(
+        'client-1', 'notify_client', 'notify_client_subscription_visit', 2)
+    combiner.assert_not_called()
+    assert_that(second.id, is_(first.id))
+
+    with freeze_time(timezone.now() + timedelta(seconds=31)):
+        assert_that(dispatch_outbox(), is_(1))
+
+    combiner.assert_called_once_with([
+        ['notify_client_balance', [1]],
+        ['notify_client_subscription_visit', [2]],
+    ])
+
+    # Dispatched task is not changed by new calls
+    third = enqueue_coalesced(
+        'client-1', 'notify_client', 'notify_client_balance', 1)
+    assert_that(third.id, is_not(first.id))
+
+
+@pytest.mark.django_db
+def test_coalesced_task_dispatch_scheduled(
+    combiner,
+    company_factory,
+    cloud_tasks,
+    settings
+):
+    company_factory()
+    settings.TASK_COALESCE_WINDOW = 30
+
+    task = enqueue_coalesced(
+        'client-1', 'notify_client', 'notify_client_balance', 1)
+    enqueue_coalesced(
+        'client-1', 'notify_client', 'notify_client_subscription_visit', 2)
+
+    # Dispatch is scheduled once, at the end of window
+    assert_that(cloud_tasks.tasks, contains(has_entries(
+        schedule_time=has_entries(
+            seconds=greater_than(task.next_attempt_at.timestamp() - 1)),
+    )))
+    assert_that(cloud_tasks.payloads(), contains(has_entries(
+        method='dispatch_outbox_tasks', args=[[task.id]])))
+    # Early run is retried by Cloud Tasks
+    with pytest.raises(RuntimeError):
+        cloud_tasks.run_tasks()
+    combiner.assert_not_called()
+
+    with freeze_time(timezone.now() + timedelta(seconds=31)):
+        dispatch_outbox_tasks([task.id])
+    cloud_tasks.run_tasks()
+
+    combiner.assert_called_once_with([
+        ['notify_client_balance', [1]],
+        ['notify_client_subscription_visit', [2]],
+    ])
+
+
+@pytest.mark.parametrize('handler', [
+    views.dispatch_outbox_handler,
+    views.purge_outbox_handler,
+])
+@pytest.mark.django_db
+def test_outbox_handlers_for_cron_only(handler, rf, mocker: MockFixture):
+    request = rf.get('/outbox')
+    request.user = mocker.Mock(is_staff=False)
+    assert_that(handler(request).status_code, is_(403))
+
+    request = rf.get('/outbox', HTTP_X_APPENGINE_CRON='true')
+    assert_that(handler(request).status_code, is_(200))
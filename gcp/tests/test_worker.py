@@ -0,0 +1,116 @@
+import gc
+import logging
+from datetime import timedelta
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+from hamcrest import (
+    assert_that, contains_inanyorder, contains_string, has_item, has_length,
+    has_properties, is_, not_none, only_contains,
+)
+from pytest_mock import MockFixture
+
+from gcp.models import OUTBOX_STATUS, OutboxTask
+from gcp.tasks import enqueue
+from gcp.worker import TaskWorker
+
+
+@pytest.fixture
+def task(mocker: MockFixture):
+    task = mocker.Mock()
+    mocker.patch.dict('gcp.registry._tasks', notify_client_balance=task)
+    return task
+
+
+@pytest.fixture
+def use_task_worker(settings):
+    settings.USE_TASK_WORKER = True
+
+
+@pytest.mark.django_db(transaction=True)
+def test_worker_runs_tasks(
+    task,
+    use_task_worker,
+    company_factory,
+    caplog,
+    mocker: MockFixture
+):
+    mocker.patch.dict('gcp.registry._stats', clear=True)
+    caplog.set_level(logging.INFO, logger='gcp.worker')
+    company = company_factory()
+    for client_id in range(3):
+        enqueue('notify_client_balance', client_id)
+    # Tasks are left for worker
+    task.assert_not_called()
+
+    call_command('run_task_worker', '--once', '--poll-interval', '0.01')
+    # Connections of finished worker threads are closed only on garbage
+    # collection, and test database can't be dropped with them
+    gc.collect()
+
+    assert_that(
+        [call[0][0] for call in task.call_args_list],
+        contains_inanyorder(0, 1, 2)
+    )
+    assert_that(
+        OutboxTask.objects.all(),
+        only_contains(has_properties(
+            status=OUTBOX_STATUS.DONE,
+            leased_until=None,
+        ))
+    )
+    # Statistics of tasks are logged by worker on stop
+    assert_that(caplog.messages, has_item(contains_string(
+        f'Task notify_client_balance of company {company.id}: calls 3')))
+
+
+@pytest.mark.django_db
+def test_lease_per_company(task, use_task_worker, company_factory):
+    first = company_factory(name='first')
+    for client_id in range(3):
+        enqueue('notify_client_balance', client_id)
+    second = company_factory(name='second')
+    enqueue('notify_client_balance', 3)
+
+    leased = TaskWorker(workers=4, per_company=1).lease_tasks()
+
+    assert_that(
+        [task.payload['company_id'] for task in leased],
+        contains_inanyorder(first.id, second.id)
+    )
+    assert_that(
+        leased, only_contains(has_properties(leased_until=not_none())))
+
+    # Leased tasks are skipped by other workers
+    other_leased = TaskWorker(workers=4, per_company=1).lease_tasks()
+    assert_that(other_leased, has_length(1))
+    assert_that(other_leased[0].payload['company_id'], is_(first.id))
+    assert_that(other_leased[0].id, is_(leased[0].id + 1))
+    task.assert_not_called()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_result_saved_by_lease_holder(
+    task,
+    use_task_worker,
+    company_factory
+):
+    company_factory()
+    enqueue('notify_client_balance', 1)
+    worker = TaskWorker(workers=1, lease=timedelta(seconds=1))
+    leased = worker.lease_tasks()[0]
+    # Task ran longer than its lease and was taken by other worker
+    other_leased_until = timezone.now() + timedelta(minutes=5)
+    OutboxTask.objects.filter(id=leased.id).update(
+        leased_until=other_leased_until)
+
+    worker.running[leased.payload['company_id']] += 1
+    worker._run(leased)
+
+    task.assert_called_once_with(1)
+    assert_that(OutboxTask.objects.get(id=leased.id), has_properties(
+        status=OUTBOX_STATUS.PENDING,
+        attempts=0,
+        leased_until=other_leased_until,
+    ))
@@ -1,7 +1,10 @@
+from functools import wraps
+
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 
-from .tasks import do
+from .registry import get_task_stats
+from .tasks import dispatch_outbox, do, purge_outbox
 
 
 @csrf_exempt
@@ -16,3 +19,52 @@ def google_task_handler(request):
 
 def warm_up(request):
     return HttpResponse('warm up', content_type="text/plain", status=200)
+
+
+def cron_or_staff_only(view):
+    """Allow view only for App Engine cron and staff users"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        # App Engine removes this header from requests of external users
+        is_cron = request.META.get('HTTP_X_APPENGINE_CRON') == 'true'
+        user = getattr(request, 'user', None)
+        if not is_cron and not (user and user.is_staff):
+            return HttpResponseForbidden(
+                'Only for cron and staff', content_type="text/plain")
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+@cron_or_staff_only
+def dispatch_outbox_handler(request):
+    # Retries of failed outbox tasks are dispatched by cron
+    dispatched = dispatch_outbox()
+    return HttpResponse(
+        f'Dispatched: {dispatched}', content_type="text/plain", status=200)
+
+
+@cron_or_staff_only
+def purge_outbox_handler(request):
+    # Dispatched tasks are deleted by cron, so outbox doesn't grow forever
+    deleted = purge_outbox()
+    return HttpResponse(
+        f'Deleted: {deleted}', content_type="text/plain", status=200)
+
+
+@cron_or_staff_only
+def task_stats(request):
+    # Statistics of tasks, run by this instance since its start
+    return JsonResponse({'tasks': [
+        {
+            'name': name,
+            'company_id': company_id,
+            'calls': stats.calls,
+            'failures': stats.failures,
+            'avg_time': stats.avg_time,
+            'max_time': stats.max_time,
+            'total_time': stats.total_time,
+            'last_error': stats.last_error,
+            'last_error_at': stats.last_error_at,
+        }
+        for name, company_id, stats in get_task_stats()
+    ]})
@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import List
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from gcp.models import OutboxTask
+from gcp.registry import get_task_stats
+from gcp.tasks import complete_task, due_tasks, lease_tasks, run_task
+
+logger = logging.getLogger('gcp.worker')
+
+# Worker looks through this number of due tasks per free thread to find
+# tasks of companies, which didn't reach their limit
+LEASE_LOOKAHEAD = 10
+
+
+class TaskWorker:
+    """
+    Local replacement of Cloud Tasks: runs outbox tasks on thread pool.
+
+    Worker leases due tasks, so other workers skip them, and runs them
+    with `do`, like task handler of Cloud Tasks. Tasks of one company
+    take no more than `per_company` threads, so long tasks of one
+    company don't hold notifications of others. Statistics of tasks are
+    logged every `stats_interval` seconds and on stop.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        per_company: int = 2,
+        lease: timedelta = timedelta(minutes=5),
+        stats_interval: float = 300
+    ):
+        self.workers = workers
+        self.per_company = per_company
+        self.lease = lease
+        self.stats_interval = stats_interval
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.running = Counter()
+        self._lock = threading.Lock()
+
+    def lease_tasks(self) -> List[OutboxTask]:
+        """Lease due tasks for free threads, within company limits"""
+        with self._lock:
+            running = Counter(self.running)
+        free = self.workers - sum(running.values())
+        if free <= 0:
+            return []
+
+        with transaction.atomic():
+            leased = []
+            for task in due_tasks(timezone.now())[:free * LEASE_LOOKAHEAD]:
+                company_id = task.payload.get('company_id')
+                if running[company_id] >= self.per_company:
+                    continue
+                running[company_id] += 1
+                leased.append(task)
+                if len(leased) == free:
+                    break
+            lease_tasks(leased, self.lease)
+        return leased
+
+    def _run(self, task: OutboxTask):
+        close_old_connections()
+        try:
+            error = None
+            try:
+                run_task(task)
+            except Exception as exc:
+                logger.exception('Task %s failed', task)
+                error = exc
+            # Task, which ran longer than its lease, may be taken by
+            # other worker, then result is saved only by that worker
+            complete_task(task, error)
+        finally:
+            with self._lock:
+                self.running[task.payload.get('company_id')] -= 1
+            close_old_connections()
+
+    def run_once(self) -> int:
+        """
+        Start due tasks on free threads.
+
+        :return: Number of started tasks
+        """
+        tasks = self.lease_tasks()
+        for task in tasks:
+            with self._lock:
+                self.running[task.payload.get('company_id')] += 1
+            self.executor.submit(self._run, task)
+        return len(tasks)
+
+    def log_stats(self):
+        """Log statistics of tasks, run by this worker since its start"""
+        for name, company_id, stats in get_task_stats():
+            logger.info(
+                'Task %s of company %s: calls %d, failures %d, '
+                'avg time %.3fs, max time %.3fs, total time %.3fs',
+                name,
+                company_id,
+                stats.calls,
+                stats.failures,
+                stats.avg_time,
+                stats.max_time,
+                stats.total_time,
+            )
+
+    def is_idle(self) -> bool:
+        with self._lock:
+            return not sum(self.running.values())
+
+    def run(self, poll_interval: float = 1, stop_when_idle: bool = False):
+        """
+        Run tasks until stopped.
+
+        :param poll_interval: Seconds between checks for new tasks, when
+            there are no due tasks or free threads
+        :param stop_when_idle: Stop, when all due tasks are done
+        """
+        stats_logged_at = time.monotonic()
+        try:
+            while True:
+                if time.monotonic() - stats_logged_at >= self.stats_interval:
+                    self.log_stats()
+                    stats_logged_at = time.monotonic()
+                if self.run_once():
+                    continue
+                if stop_when_idle and self.is_idle():
+                    # Tasks, started just before, may enqueue new ones
+                    if not self.run_once():
+                        break
+                time.sleep(poll_interval)
+        finally:
+            self.executor.shutdown(wait=True)
+            self.log_stats()
@@ -220,6 +220,11 @@ GOOGLE_ANALYTICS_SITE_SPEED_SAMPLE_RATE = 100
 
 BACKGROUND_MODE: bool = False # True for run as background tasks worker
 USE_GOOGLE_TASKS: bool = False
+# Without Google Tasks run tasks by run_task_worker command, not in request
+USE_TASK_WORKER: bool = False
+# Seconds to wait for other tasks to combine with, see enqueue_coalesced.
+# Delayed tasks are dispatched by task worker or by outbox cron job
+TASK_COALESCE_WINDOW: int = 0
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
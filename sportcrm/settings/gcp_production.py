@@ -42,6 +42,8 @@ USE_GOOGLE_TASKS: bool = True
 GCP_TASK_PROJECT = 'sportadmin'
 GCP_TASK_QUEUE = 'sa-prod-queue'
 GCP_TASK_LOCATION = 'europe-west1'
+# Delayed tasks are dispatched by outbox cron job every minute
+TASK_COALESCE_WINDOW = 30
 
 SOCIAL_AUTH_VK_OAUTH2_KEY = '6910281'
 SOCIAL_AUTH_VK_OAUTH2_SECRET = 'FlahTFK72JyNibzjWXhE'
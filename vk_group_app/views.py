@@ -10,7 +10,7 @@ from rest_framework.generics import CreateAPIView, GenericAPIView
 from rest_framework.response import Response
 from gcp.tasks import enqueue
 
-from contrib.vk_utils import get_vk_user_info
+from contrib.vk_utils import resolve_vk_users
 from crm.models import Attendance, Client, Company, Event, EventClass
 from vk_group_app.const import VK_USER_GUEST, VK_USER_ADMIN
 from vk_group_app.serializers import (
@@ -114,9 +114,8 @@ class VkPageView(TemplateView):
         day_end = day_start + timedelta(weeks=1)
 
         # Prepare events
-        events = []
-        for ec in EventClass.objects.in_range(day_start, day_end):
-            events.extend(list(ec.get_calendar(day_start, day_end).values()))
+        events = EventClass.objects.in_range(
+            day_start, day_end).get_calendar(day_start, day_end)
         events = sorted(
             events, key=lambda x: datetime.combine(x.date, x.start_time))
 
@@ -211,7 +210,8 @@ class ClientMixin:
     def create_client(self, serializer):
         vk_id = serializer.validated_data['vkId']
         client = Client.objects.create(vk_user_id=vk_id)
-        info = get_vk_user_info(vk_id)[vk_id]
+        info = resolve_vk_users(
+            [vk_id], 'photo_100,bdate,domain')[str(vk_id)]
         client.name = f'{info["first_name"]} {info["last_name"]}'
         bdate = info.get('bdate')
         if bdate: